@@ -8,6 +8,7 @@ import operator
 import numpy
 import theano
 from theano import tensor
+from theano.sparse import SparseType, SparseVariable, structured_dot
 
 # Local imports
 from pylearn2.base import Block, StackedBlocks
@@ -34,7 +35,8 @@ class Autoencoder(Block, Model):
     much of the necessary functionality and override what they need.
     """
     def __init__(self, nvis, nhid, act_enc, act_dec,
-                 tied_weights=False, irange=1e-3, rng=9001):
+                 tied_weights=False, irange=1e-3, rng=9001,
+                 sparse_input=False):
         """
         Allocate an autoencoder object.
 
@@ -68,12 +70,16 @@ class Autoencoder(Block, Model):
         rng : RandomState object or seed
             NumPy random number generator object (or seed to create one) used
             to initialize the model parameters.
+        sparse_input : bool, optional
+            If `True`, the model takes sparse (CSR) batches, e.g. from a
+            `SparseDesignMatrix`, and encodes them with a structured dot
+            product.
         """
         super(Autoencoder, self).__init__()
         assert nvis >= 0, "Number of visible units must be non-negative"
         assert nhid > 0, "Number of hidden units must be positive"
 
-        self.input_space = VectorSpace(nvis)
+        self.input_space = VectorSpace(nvis, sparse=sparse_input)
 
         # Save a few parameters needed for resizing
         self.nhid = nhid
@@ -228,6 +234,9 @@ class Autoencoder(Block, Model):
         y : tensor_like
             (Symbolic) input flowing into the hidden layer nonlinearity.
         """
+        if isinstance(x.type, SparseType):
+            # Only touches the weights of the nonzero inputs.
+            return self.hidbias + structured_dot(x, self.weights)
         return self.hidbias + tensor.dot(x, self.weights)
 
     def encode(self, inputs):
@@ -248,7 +257,7 @@ class Autoencoder(Block, Model):
             Theano symbolic (or list thereof) representing the corresponding
             minibatch(es) after encoding.
         """
-        if isinstance(inputs, tensor.Variable):
+        if isinstance(inputs, (tensor.Variable, SparseVariable)):
             return self._hidden_activation(inputs)
         else:
             return [self.encode(v) for v in inputs]
@@ -1,15 +1,28 @@
 from theano import tensor
+from theano.sparse import SparseType, dense_from_sparse
+
+
+def _dense(X):
+    """
+    Returns X as a dense batch, to compare reconstructions to. Sparse
+    batches are still encoded sparsely by the model.
+    """
+    if isinstance(X.type, SparseType):
+        return dense_from_sparse(X)
+    return X
+
 
 class MeanSquaredReconstructionError(object):
     def __call__(self, model, X):
-        return ((model.reconstruct(X) - X) ** 2).sum(axis=1).mean()
+        return ((model.reconstruct(X) - _dense(X)) ** 2).sum(axis=1).mean()
 
 
 class MeanBinaryCrossEntropy(object):
     def __call__(self, model, X):
+        target = _dense(X)
         return (
-            - X * tensor.log(model.reconstruct(X)) -
-            (1 - X) * tensor.log(1 - model.reconstruct(X))
+            - target * tensor.log(model.reconstruct(X)) -
+            (1 - target) * tensor.log(1 - model.reconstruct(X))
         ).sum(axis=1).mean()
 
 
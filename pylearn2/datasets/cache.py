@@ -0,0 +1,323 @@
+"""
+A persistent, on-disk cache of the arrays dataset constructors build,
+and of fitted preprocessors and the design matrices they produce.
+
+Datasets such as MNIST, CIFAR10, STL10, NORBSmall or TFD parse their
+source files (pickles, .mat files, filetensors) and cast the examples to
+float32 every time they are constructed, which takes long and briefly
+needs twice the memory of the design matrix. When the
+PYLEARN2_DATASET_CACHE environment variable names a directory, the
+arrays they end up with are stored there as .npy files the first time,
+and later constructions memory-map them instead of building them again.
+When PYLEARN2_DATASET_CACHE is not set, `cached_arrays` just builds
+them.
+
+Entries are keyed by the class of the dataset, the constructor
+arguments that determine its contents, and the path, size and
+modification time of its source files, so that changing a source file
+invalidates its entries. Arrays are mapped copy-on-write (mode 'c'):
+code modifying the design matrix of a dataset in place gets private
+copies of the pages it writes, and never changes the cache.
+
+`apply_preprocessor`, which DenseDesignMatrix.apply_preprocessor goes
+through, similarly stores the state of a preprocessor after applying it
+(e.g. a fitted ZCA) and, optionally, the preprocessed design matrix.
+Applying an identical preprocessor to an identical dataset later then
+restores the fitted state rather than fitting it again, or even maps
+the preprocessed design matrix. These entries are keyed by the pickled
+preprocessor and a fingerprint of the design matrix, see `fingerprint`.
+
+If PYLEARN2_DATASET_CACHE_SIZE is set to a number of megabytes, the
+least recently used entries are deleted whenever an entry is stored
+and the cache is larger than that.
+
+Hits and misses are logged (at the INFO level) and accumulated in
+`statistics`.
+"""
+import cPickle
+import hashlib
+import logging
+import os
+import shutil
+import tempfile
+import numpy
+from pylearn2.utils.string_utils import preprocess
+
+log = logging.getLogger(__name__)
+
+# Running totals for this process.
+statistics = {'hits': 0, 'misses': 0}
+
+# Changing the way entries are built or stored invalidates them.
+_FORMAT_VERSION = 1
+
+
+def cached_arrays(cls, args, sources, build):
+    """
+    Returns the arrays built by `build`, going through the on-disk cache
+    if PYLEARN2_DATASET_CACHE is set.
+
+    Parameters
+    ----------
+    cls : class
+        The dataset class the arrays are built for.
+    args : dict
+        The constructor arguments the arrays depend on. Their repr must
+        identify them.
+    sources : list of str
+        The files (or directories) the arrays are read from, which may
+        contain ${VARNAME} references to environment variables.
+    build : callable
+        Called without arguments on a miss, returns a dict mapping names
+        to ndarrays or to other picklable values, such as label names.
+
+    Returns
+    -------
+    data : dict
+        The dict `build` returns. On a hit, its ndarrays are memory
+        mapped copy-on-write from the cache.
+    """
+    label = cls.__name__
+    cache_dir = os.environ.get('PYLEARN2_DATASET_CACHE')
+    if not cache_dir:
+        return build()
+    path = os.path.join(cache_dir, label + '-' +
+                        _entry_key(cls, args, sources))
+
+    if os.path.exists(os.path.join(path, 'meta.pkl')):
+        try:
+            data = _load(path)
+        except Exception, e:
+            log.warning('could not load %s from the dataset cache (%s), '
+                        'building it again', label, e)
+        else:
+            statistics['hits'] += 1
+            log.info('dataset cache hit for %s %s', label, str(args))
+            return data
+
+    data = build()
+    statistics['misses'] += 1
+    log.info('dataset cache miss for %s %s', label, str(args))
+    try:
+        _store(path, data)
+    except Exception, e:
+        log.warning('could not store %s in the dataset cache: %s', label, e)
+    return data
+
+
+def fingerprint(X, num_blocks=16, block_rows=16):
+    """
+    Returns a hash of the shape and dtype of the array X and of
+    `num_blocks` blocks of `block_rows` rows spread evenly over it,
+    including its first and last rows. Only those rows are read, so
+    that fingerprinting a memory-mapped array is fast, but arrays that
+    only differ elsewhere get the same fingerprint.
+    """
+    h = hashlib.sha1('%s %s' % (X.dtype.str, str(X.shape)))
+    if X.shape[0] > 0:
+        starts = numpy.linspace(0, max(X.shape[0] - block_rows, 0),
+                                num_blocks).astype('int64')
+        for start in numpy.unique(starts):
+            h.update(numpy.ascontiguousarray(
+                X[start:start + block_rows]).tostring())
+    return h.hexdigest()
+
+
+def apply_preprocessor(dataset, preprocessor, can_fit=False,
+                       cache_output=False):
+    """
+    Applies `preprocessor` to the DenseDesignMatrix `dataset`, going
+    through the on-disk cache if PYLEARN2_DATASET_CACHE is set.
+
+    On a hit, the attributes of `preprocessor`, and of the items of a
+    Pipeline, are set to those it had after being applied the first
+    time, so that it doesn't need to be fitted again. The preprocessed
+    design matrix and view converter are then taken from the cache if
+    the entry has them, otherwise the preprocessor is applied.
+
+    Parameters
+    ----------
+    dataset : DenseDesignMatrix
+        The dataset to preprocess.
+    preprocessor : object
+        The preprocessor. It must be picklable to be cached.
+    can_fit : bool, optional
+        Passed to preprocessor.apply.
+    cache_output : bool, optional
+        Whether to also store the preprocessed design matrix, which is
+        then memory mapped copy-on-write on a hit.
+    """
+    label = type(preprocessor).__name__
+    cache_dir = os.environ.get('PYLEARN2_DATASET_CACHE')
+    if cache_dir and not hasattr(dataset, 'X'):
+        # Datasets loading their design matrix on first use, such as
+        # NpyDataset, only have X once loaded.
+        dataset.get_design_matrix()
+    if not cache_dir or getattr(dataset, 'X', None) is None:
+        preprocessor.apply(dataset, can_fit)
+        return
+    try:
+        key = _preprocessor_key(dataset, preprocessor, can_fit,
+                                cache_output)
+    except Exception, e:
+        log.info('not caching %s: %s', label, e)
+        preprocessor.apply(dataset, can_fit)
+        return
+    path = os.path.join(cache_dir, label + '-' + key)
+
+    if os.path.exists(os.path.join(path, 'meta.pkl')):
+        try:
+            data = _load(path)
+        except Exception, e:
+            log.warning('could not load %s from the dataset cache (%s), '
+                        'applying it again', label, e)
+        else:
+            statistics['hits'] += 1
+            log.info('dataset cache hit for %s', label)
+            _restore(preprocessor, data['preprocessor'])
+            if 'X' in data:
+                dataset.view_converter = data['view_converter']
+                dataset.set_design_matrix(data['X'])
+            else:
+                preprocessor.apply(dataset, can_fit)
+            return
+
+    preprocessor.apply(dataset, can_fit)
+    statistics['misses'] += 1
+    log.info('dataset cache miss for %s', label)
+    data = {'preprocessor': preprocessor}
+    if cache_output:
+        data['X'] = dataset.get_design_matrix()
+        data['view_converter'] = dataset.view_converter
+    try:
+        _store(path, data)
+    except Exception, e:
+        log.warning('could not store %s in the dataset cache: %s', label, e)
+
+
+def _preprocessor_key(dataset, preprocessor, can_fit, cache_output):
+    lines = [str(_FORMAT_VERSION), 'preprocessor',
+             hashlib.sha1(cPickle.dumps(preprocessor, 2)).hexdigest(),
+             fingerprint(dataset.X),
+             hashlib.sha1(cPickle.dumps(dataset.view_converter,
+                                        2)).hexdigest(),
+             str(can_fit), str(cache_output)]
+    if getattr(dataset, 'quantized', None) is not None:
+        lines.append(hashlib.sha1(cPickle.dumps(
+            (dataset.compress_min, dataset.compress_max), 2)).hexdigest())
+    return hashlib.sha1('\n'.join(lines)).hexdigest()
+
+
+def _restore(preprocessor, fitted):
+    """
+    Gives `preprocessor` the attributes of `fitted`, recursing into the
+    items of pipelines so that references to them see their new state.
+    """
+    state = dict(fitted.__dict__)
+    items = getattr(preprocessor, 'items', None)
+    fitted_items = state.get('items')
+    if (isinstance(items, list) and isinstance(fitted_items, list) and
+            len(items) == len(fitted_items)):
+        for item, fitted_item in zip(items, fitted_items):
+            _restore(item, fitted_item)
+        del state['items']
+    preprocessor.__dict__.update(state)
+
+
+def _entry_key(cls, args, sources):
+    lines = [str(_FORMAT_VERSION), cls.__module__ + '.' + cls.__name__,
+             repr(sorted(args.items()))]
+    for source in sources:
+        source = os.path.abspath(preprocess(source))
+        stat = os.stat(source)
+        lines.append('%s %d %r' % (source, stat.st_size, stat.st_mtime))
+    return hashlib.sha1('\n'.join(lines)).hexdigest()
+
+
+def _is_mappable(value):
+    # Empty files can't be mapped.
+    return (isinstance(value, numpy.ndarray) and value.size > 0 and
+            not value.dtype.hasobject)
+
+
+def _store(path, data):
+    directory = os.path.dirname(path)
+    if not os.path.isdir(directory):
+        try:
+            os.makedirs(directory)
+        except OSError:
+            # Another process may have created it in the meantime.
+            if not os.path.isdir(directory):
+                raise
+    # Write to a temporary directory then rename it, so that concurrent
+    # processes never see a partial entry.
+    tmp_path = tempfile.mkdtemp(dir=directory, suffix='.tmp')
+    try:
+        meta = {}
+        for name, value in data.items():
+            if _is_mappable(value):
+                numpy.save(os.path.join(tmp_path, name + '.npy'), value)
+            else:
+                meta[name] = value
+        with open(os.path.join(tmp_path, 'meta.pkl'), 'wb') as f:
+            cPickle.dump({'arrays': [name for name, value in data.items()
+                                     if _is_mappable(value)],
+                          'values': meta}, f, 2)
+        try:
+            os.rename(tmp_path, path)
+        except OSError:
+            # Another process stored the same entry first.
+            if not os.path.exists(os.path.join(path, 'meta.pkl')):
+                raise
+            shutil.rmtree(tmp_path)
+    except:
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        raise
+    max_size = os.environ.get('PYLEARN2_DATASET_CACHE_SIZE')
+    if max_size:
+        _evict(directory, float(max_size) * 2 ** 20, path)
+
+
+def _evict(cache_dir, max_bytes, keep):
+    """
+    Deletes the least recently used entries of the cache until it takes
+    at most `max_bytes`, or only `keep` is left.
+    """
+    entries = []
+    for name in os.listdir(cache_dir):
+        path = os.path.join(cache_dir, name)
+        if name.endswith('.tmp'):
+            continue
+        try:
+            last_used = os.stat(os.path.join(path, 'meta.pkl')).st_mtime
+            size = sum(os.path.getsize(os.path.join(path, f))
+                       for f in os.listdir(path))
+        except OSError:
+            # Not an entry, or deleted by another process.
+            continue
+        entries.append((last_used, size, path))
+    total = sum(size for last_used, size, path in entries)
+    for last_used, size, path in sorted(entries):
+        if total <= max_bytes:
+            break
+        if path == keep:
+            continue
+        shutil.rmtree(path, ignore_errors=True)
+        total -= size
+        log.info('evicted %s from the dataset cache', path)
+
+
+def _load(path):
+    meta_path = os.path.join(path, 'meta.pkl')
+    with open(meta_path, 'rb') as f:
+        meta = cPickle.load(f)
+    try:
+        # The modification time of meta.pkl records the last use.
+        os.utime(meta_path, None)
+    except OSError:
+        pass
+    data = dict(meta['values'])
+    for name in meta['arrays']:
+        data[name] = numpy.load(os.path.join(path, name + '.npy'),
+                                mmap_mode='c')
+    return data
@@ -1,28 +1,40 @@
 import numpy as N
 from pylearn2.datasets import dense_design_matrix
+from pylearn2.datasets.cache import cached_arrays
 from pylearn.datasets import cifar10
 
 class CIFAR10(dense_design_matrix.DenseDesignMatrix):
     def __init__(self, which_set, center = False):
 
-        #dear pylearn.datasets.cifar: there is no such thing as the cifar10 validation set. quit pretending that there is.
-        orig = cifar10.cifar10(ntrain=50000,nvalid=0,ntest=10000)
+        def build():
+            #dear pylearn.datasets.cifar: there is no such thing as the cifar10 validation set. quit pretending that there is.
+            orig = cifar10.cifar10(ntrain=50000,nvalid=0,ntest=10000)
 
-        Xs = {
-                'train' : orig.train.x,
-                'test'  : orig.test.x
-            }
+            Xs = {
+                    'train' : orig.train.x,
+                    'test'  : orig.test.x
+                }
 
-        Ys = {
-                'train' : orig.train.y,
-                'test'  : orig.test.y
-            }
+            Ys = {
+                    'train' : orig.train.y,
+                    'test'  : orig.test.y
+                }
 
-        X = N.cast['float32'](Xs[which_set])
-        y = Ys[which_set]
+            X = N.cast['float32'](Xs[which_set])
+            y = Ys[which_set]
 
-        if center:
-            X -= 127.5
+            if center:
+                X -= 127.5
+
+            assert not N.any(N.isnan(X))
+            return {'X': X, 'y': y}
+
+        #pylearn.datasets.cifar10 finds its files itself, and they never
+        #change, so the cache entries only depend on the arguments
+        data = cached_arrays(CIFAR10, {'which_set': which_set,
+                                       'center': center}, [], build)
+        X = data['X']
+        y = data['y']
 
         view_converter = dense_design_matrix.DefaultViewConverter((32,32,3))
 
@@ -30,5 +42,3 @@ class CIFAR10(dense_design_matrix.DenseDesignMatrix):
 
         self.label_names = [ 'airplane', 'automobile', 'bird', 'cat', 'deer', 'dog',
                 'frog','horse','ship','truck']
-
-        assert not N.any(N.isnan(self.X))
@@ -13,3 +13,21 @@ def push_load_data(setting):
 
 def get_load_data():
     return load_data[-1]
+
+# Memory mapping mode (see numpy.load) used when unpickled datasets
+# load their design matrix from a separate .npy file. None loads the
+# whole array into memory.
+mmap_mode = [ None ]
+
+def pop_mmap_mode():
+    global mmap_mode
+
+    del mmap_mode[-1]
+
+def push_mmap_mode(setting):
+    global mmap_mode
+
+    mmap_mode.append(setting)
+
+def get_mmap_mode():
+    return mmap_mode[-1]
@@ -26,16 +26,20 @@ class Dataset(object):
         return self.iterator()
 
     def set_iteration_scheme(self, mode=None, batch_size=None,
-                             num_batches=None, topo=False):
+                             num_batches=None, topo=False, shard_index=None,
+                             num_shards=None):
         """
         Modify the default iteration behaviour for the dataset.
 
         Parameters
         ----------
         mode : str or object, optional
-            One of 'sequential', 'random_slice', or 'random_uniform',
-            *or* a class that instantiates an iterator that returns
-            slices or index sequences on every call to next().
+            One of 'sequential', 'random_slice', 'random_uniform',
+            'shuffled_sequential' (each example once per epoch, in a
+            random order) or 'block_shuffled' (the same, reading
+            contiguous blocks of examples), *or* a class that
+            instantiates an iterator that returns slices or index
+            sequences on every call to next().
         batch_size : int, optional
             The size of an individual batch. Unnecessary if `mode` is
             'sequential' and `num_batches` is specified.
@@ -46,6 +50,14 @@ class Dataset(object):
             Whether batches returned by the iterator should present
             examples in a topological view or not. Defaults to
             `False`.
+        shard_index : int, optional
+            Restricts the batches to shard `shard_index` (from 0) of
+            `num_shards` contiguous, disjoint shards of the dataset,
+            e.g. the rank of the process in distributed training. The
+            other shards' examples are never read. See
+            `pylearn2.utils.iteration.ShardedSubsetIterator`.
+        num_shards : int, optional
+            Number of shards. Must be given along with `shard_index`.
 
         Notes
         -----
@@ -60,7 +72,7 @@ class Dataset(object):
         raise NotImplementedError()
 
     def iterator(self, mode=None, batch_size=None, num_batches=None,
-                 topo=None, rng=None):
+                 topo=None, rng=None, shard_index=None, num_shards=None):
         """
         Return an iterator for this dataset with the specified
         behaviour. Unspecified values are filled-in by the default.
@@ -68,9 +80,12 @@ class Dataset(object):
         Parameters
         ----------
         mode : str or object, optional
-            One of 'sequential', 'random_slice', or 'random_uniform',
-            *or* a class that instantiates an iterator that returns
-            slices or index sequences on every call to next().
+            One of 'sequential', 'random_slice', 'random_uniform',
+            'shuffled_sequential' (each example once per epoch, in a
+            random order) or 'block_shuffled' (the same, reading
+            contiguous blocks of examples), *or* a class that
+            instantiates an iterator that returns slices or index
+            sequences on every call to next().
         batch_size : int, optional
             The size of an individual batch. Unnecessary if `mode` is
             'sequential' and `num_batches` is specified.
@@ -92,6 +107,14 @@ class Dataset(object):
             through the dataset and may potentially be shared by
             multiple iterator objects simultaneously (see "Notes"
             below).
+        shard_index : int, optional
+            Restricts the batches to shard `shard_index` (from 0) of
+            `num_shards` contiguous, disjoint shards of the dataset,
+            e.g. the rank of the process in distributed training. The
+            other shards' examples are never read. See
+            `pylearn2.utils.iteration.ShardedSubsetIterator`.
+        num_shards : int, optional
+            Number of shards. Must be given along with `shard_index`.
 
         Returns
         -------
@@ -1,5 +1,6 @@
 """TODO: module-level docstring."""
 import functools
+import os
 
 import warnings
 import numpy as np
@@ -9,6 +10,7 @@ from pylearn2.utils.iteration import (
     RandomSliceSubsetIterator,
     RandomUniformSubsetIterator,
     FiniteDatasetIterator,
+    make_subset_iterator,
     resolve_iterator_class
 )
 N = np
@@ -16,6 +18,7 @@ N = np
 import copy
 
 from pylearn2.datasets.dataset import Dataset
+from pylearn2.datasets import cache
 from pylearn2.datasets import control
 from theano import config
 
@@ -29,7 +32,8 @@ class DenseDesignMatrix(Dataset):
     _default_seed = (17, 2, 946)
 
     def __init__(self, X=None, topo_view=None, y=None,
-                 view_converter=None, rng=_default_seed):
+                 view_converter=None, rng=_default_seed,
+                 channel_last=False):
         """
         Parameters
         ----------
@@ -37,7 +41,9 @@ class DenseDesignMatrix(Dataset):
         X : ndarray, 2-dimensional, optional
             Should be supplied if `topo_view` is not. A design
             matrix of shape (number examples, number features)
-            that defines the dataset.
+            that defines the dataset. May be a `numpy.memmap`, in which
+            case batches are read from disk and cast to floatX one at
+            a time.
         topo_view : ndarray, optional
             Should be supplied if X is not.  An array whose first
             dimension is of length number examples. The remaining
@@ -56,6 +62,12 @@ class DenseDesignMatrix(Dataset):
         rng : object, optional
             A random number generator used for picking random
             indices into the design matrix when choosing minibatches.
+        channel_last : bool, optional
+            If `topo_view` is given, store the design matrix with the
+            channels of each pixel next to each other (see
+            DefaultViewConverter), so that topological views of it need
+            no copy. If `topo_view` is contiguous, X is then a view of
+            it.
         """
         self.X = X
         if view_converter is not None:
@@ -63,10 +75,14 @@ class DenseDesignMatrix(Dataset):
             self.view_converter = view_converter
         else:
             if topo_view is not None:
-                self.set_topological_view(topo_view)
+                self.set_topological_view(topo_view, channel_last)
         self.y = y
         self.compress = False
+        self.quantized = None
+        self.compress_min = None
+        self.compress_max = None
         self.design_loc = None
+        self.design_mmap_mode = None
         if hasattr(rng, 'random_integers'):
             self.rng = rng
         else:
@@ -79,7 +95,8 @@ class DenseDesignMatrix(Dataset):
 
     @functools.wraps(Dataset.set_iteration_scheme)
     def set_iteration_scheme(self, mode=None, batch_size=None,
-                             num_batches=None, topo=False, targets=False):
+                             num_batches=None, topo=False, targets=False,
+                             shard_index=None, num_shards=None):
         if mode is not None:
             self._iter_subset_class = mode = resolve_iterator_class(mode)
         elif hasattr(self, '_iter_subset_class'):
@@ -92,15 +109,19 @@ class DenseDesignMatrix(Dataset):
         self._iter_num_batches = num_batches
         self._iter_topo = topo
         self._iter_targets = targets
+        self._iter_shard_index = shard_index
+        self._iter_num_shards = num_shards
         # Try to create an iterator with these settings.
         rng = self.rng if mode.stochastic else None
-        print rng
         test = self.iterator(mode, batch_size, num_batches, topo, rng=rng)
 
     @functools.wraps(Dataset.iterator)
     def iterator(self, mode=None, batch_size=None, num_batches=None,
-                 topo=None, targets=None, rng=None):
+                 topo=None, targets=None, rng=None, buffers=0,
+                 shard_index=None, num_shards=None):
         # TODO: Refactor, deduplicate with set_iteration_scheme
+        # `buffers` is passed to FiniteDatasetIterator: if nonzero,
+        # batches are views into that many reused output arrays.
         if mode is None:
             if hasattr(self, '_iter_subset_class'):
                 mode = self._iter_subset_class
@@ -117,24 +138,45 @@ class DenseDesignMatrix(Dataset):
             topo = getattr(self, '_iter_topo', False)
         if targets is None:
             targets = getattr(self, '_iter_targets', False)
+        if shard_index is None and num_shards is None:
+            shard_index = getattr(self, '_iter_shard_index', None)
+            num_shards = getattr(self, '_iter_num_shards', None)
         if rng is None and mode.stochastic:
             rng = self.rng
-        return FiniteDatasetIterator(self,
-                                     mode(self.X.shape[0], batch_size,
-                                     num_batches, rng),
-                                     topo, targets)
+        return self._make_iterator(make_subset_iterator(mode,
+                                                        self.num_examples,
+                                                        batch_size,
+                                                        num_batches, rng,
+                                                        shard_index,
+                                                        num_shards),
+                                   topo, targets, buffers)
 
-    def use_design_loc(self, path):
+    def _make_iterator(self, subset_iterator, topo, targets, buffers):
+        """
+        Returns the iterator over the batches of `subset_iterator`.
+        Subclasses that don't hold their design matrix in X override
+        this.
+        """
+        return FiniteDatasetIterator(self, subset_iterator, topo, targets,
+                                     buffers)
+
+    def use_design_loc(self, path, mmap_mode=None):
         """
         When pickling, save the design matrix to path as a .npy file rather
         than pickling the design matrix along with the rest of the dataset
         object. This avoids pickle's unfortunate behavior of using 2X the RAM
         when unpickling.
 
+        If `mmap_mode` is given (see `numpy.load`), the unpickled dataset
+        memory-maps the .npy file instead of loading it. Datasets pickled
+        without it can be memory-mapped by unpickling them with
+        `pylearn2.datasets.control.push_mmap_mode`.
+
         TODO: Get rid of this logic, use custom array-aware picklers (joblib,
         custom pylearn2 serialization format).
         """
         self.design_loc = path
+        self.design_mmap_mode = mmap_mode
 
     def enable_compression(self):
         """
@@ -147,25 +189,113 @@ class DenseDesignMatrix(Dataset):
         """
         self.compress = True
 
+    def quantize(self, dtype='uint8', block_size=10000):
+        """
+        Stores the design matrix in memory with fewer bits per element.
+        Batches returned by iterators and get_batch_design are converted
+        back to floatX one at a time, while get_design_matrix and
+        get_topological_view convert the whole dataset.
+
+        Parameters
+        ----------
+        dtype : str, optional
+            'uint8' scales each feature linearly to 0..255 using its
+            minimum (compress_min) and range (compress_max) over the
+            dataset. 'float16' rounds the values to half precision.
+        block_size : int, optional
+            Number of examples quantized at a time, which bounds the
+            size of the temporary arrays.
+
+        Notes
+        -----
+        set_design_matrix and set_topological_view store floating point
+        design matrices again, e.g. after preprocessing.
+        """
+        if self.quantized is not None:
+            raise ValueError("the dataset is already quantized to " +
+                             self.quantized)
+        if dtype == 'uint8':
+            X, compress_min, compress_max = _quantize(self.X, block_size)
+            self.set_quantized_design_matrix(X, compress_min, compress_max)
+        elif dtype == 'float16':
+            X = N.empty(self.X.shape, dtype='float16')
+            for start in xrange(0, X.shape[0], block_size):
+                X[start:start + block_size] = self.X[start:start + block_size]
+            self.set_quantized_design_matrix(X)
+        else:
+            raise ValueError("can't quantize to %s, only to uint8 or "
+                             "float16" % str(dtype))
+
+    def set_quantized_design_matrix(self, X, compress_min=None,
+                                    compress_max=None):
+        """
+        Sets the dataset to X, a quantized design matrix, e.g. data that
+        is stored as 8 bit integers on disk.
+
+        Parameters
+        ----------
+        X : ndarray
+            A uint8 design matrix, where each feature i stands for
+            compress_min[i] + X[:, i] * compress_max[i] / 255., or a
+            float16 design matrix.
+        compress_min : ndarray or float, optional
+            Value of each feature (or of all of them) when X is 0.
+            Required if X is uint8.
+        compress_max : ndarray or float, optional
+            Range of each feature (or of all of them), i.e. their value
+            when X is 255 minus compress_min. Required if X is uint8.
+        """
+        assert len(X.shape) == 2
+        if X.dtype == 'uint8':
+            if compress_min is None or compress_max is None:
+                raise ValueError("compress_min and compress_max are needed "
+                                 "to dequantize uint8 design matrices")
+            ones = N.ones(X.shape[1], dtype='float32')
+            self.compress_min = ones * compress_min
+            self.compress_max = ones * compress_max
+        elif X.dtype == 'float16':
+            self.compress_min = None
+            self.compress_max = None
+        else:
+            raise ValueError("expected a uint8 or float16 design matrix, "
+                             "got " + str(X.dtype))
+        self.X = X
+        self.quantized = str(X.dtype)
+
+    def dequantize(self, batch):
+        """
+        Returns `batch`, a batch of examples of the stored (possibly
+        quantized) design matrix, as a floatX design matrix. Batches
+        that are already floatX are converted in place.
+        """
+        if batch.dtype != config.floatX:
+            batch = N.cast[config.floatX](batch)
+        if self.quantized == 'uint8':
+            batch *= self.compress_max / 255.
+            batch += self.compress_min
+        return batch
+
     def __getstate__(self):
         rval = copy.copy(self.__dict__)
         # TODO: Not sure this should be implemented as something a base dataset
         # does. Perhaps as a mixin that specific datasets (i.e. CIFAR10)
         # inherit from.
-        if self.compress:
-            rval['compress_min'] = rval['X'].min(axis=0)
-            # important not to do -= on this line, as that will modify the
-            # original object
-            rval['X'] = rval['X'] - rval['compress_min']
-            rval['compress_max'] = rval['X'].max(axis=0)
-            rval['compress_max'][rval['compress_max'] == 0] = 1
-            rval['X'] *= 255. / rval['compress_max']
-            rval['X'] = N.cast['uint8'](rval['X'])
+        if self.compress and self.quantized is None:
+            rval['X'], rval['compress_min'], rval['compress_max'] = \
+                _quantize(rval['X'])
 
         if self.design_loc is not None:
             # TODO: Get rid of this logic, use custom array-aware picklers
             # (joblib, custom pylearn2 serialization format).
-            N.save(self.design_loc, rval['X'])
+            X = rval['X']
+            compressed = self.compress and self.quantized is None
+            if not compressed and _is_mapped_from(X, self.design_loc):
+                # X is mapped from design_loc already; saving it there
+                # would overwrite the file while reading it.
+                if X.mode != 'r':
+                    X.flush()
+            else:
+                N.save(self.design_loc, X)
             del rval['X']
 
         return rval
@@ -174,17 +304,30 @@ class DenseDesignMatrix(Dataset):
 
         if d['design_loc'] is not None:
             if control.get_load_data():
-                d['X'] = N.load(d['design_loc'])
+                mmap_mode = control.get_mmap_mode()
+                if mmap_mode is None:
+                    mmap_mode = d.get('design_mmap_mode')
+                if (mmap_mode is not None and d['compress'] and
+                        not d.get('quantized')):
+                    warnings.warn("compressed datasets can't be memory "
+                                  "mapped, loading %s into memory" %
+                                  d['design_loc'])
+                    mmap_mode = None
+                d['X'] = N.load(d['design_loc'], mmap_mode=mmap_mode)
             else:
                 d['X'] = None
+        d.setdefault('design_mmap_mode', None)
+        d.setdefault('quantized', None)
 
-        if d['compress']:
+        if d['compress'] and d['quantized'] is None:
             X = d['X']
             mx = d['compress_max']
             mn = d['compress_min']
             del d['compress_max']
             del d['compress_min']
             d['X'] = 0
+            d['compress_min'] = None
+            d['compress_max'] = None
             self.__dict__.update(d)
             if X is not None:
                 self.X = N.cast['float32'](X) * mx / 255. + mn
@@ -220,7 +363,7 @@ class DenseDesignMatrix(Dataset):
             train = dataset_iter.next()
             valid = dataset_iter.next()
         elif split_prop !=0:
-            size = np.ceil(self.num_examples * split_prop)
+            size = int(np.ceil(self.num_examples * split_prop))
             dataset_iter = self.iterator(mode=_mode,
                     batch_size=(self.num_examples - size))
             train = dataset_iter.next()
@@ -317,8 +460,15 @@ class DenseDesignMatrix(Dataset):
             self.default_rng = N.random.RandomState([17, 2, 946])
         self.rng = copy.copy(self.default_rng)
 
-    def apply_preprocessor(self, preprocessor, can_fit=False):
-        preprocessor.apply(self, can_fit)
+    def apply_preprocessor(self, preprocessor, can_fit=False,
+                           cache_output=False):
+        """
+        Applies `preprocessor` to this dataset. If the
+        PYLEARN2_DATASET_CACHE environment variable is set, its fitted
+        state and, if `cache_output` is True, the preprocessed design
+        matrix are cached on disk, see pylearn2.datasets.cache.
+        """
+        cache.apply_preprocessor(self, preprocessor, can_fit, cache_output)
 
     def get_topological_view(self, mat=None):
         """
@@ -337,7 +487,7 @@ class DenseDesignMatrix(Dataset):
             raise Exception("Tried to call get_topological_view on a dataset "
                             "that has no view converter")
         if mat is None:
-            mat = self.X
+            mat = self.get_design_matrix()
         return self.view_converter.design_mat_to_topo_view(mat)
 
     def get_weights_view(self, mat):
@@ -352,7 +502,7 @@ class DenseDesignMatrix(Dataset):
 
         return self.view_converter.design_mat_to_weights_view(mat)
 
-    def set_topological_view(self, V):
+    def set_topological_view(self, V, channel_last=False):
         """
         Sets the dataset to represent V, where V is a batch
         of topological views of examples.
@@ -363,12 +513,16 @@ class DenseDesignMatrix(Dataset):
             An array containing a design matrix representation of training
             examples. If unspecified, the entire dataset (`self.X`) is used
             instead.
+        channel_last : bool, optional
+            Whether to store the design matrix with the channels of each
+            pixel next to each other. See DefaultViewConverter.
         TODO: why is this parameter named 'V'?
         """
-        assert not N.any(N.isnan(V))
-        self.view_converter = DefaultViewConverter(V.shape[1:])
+        assert not _has_nan(V)
+        self.view_converter = DefaultViewConverter(V.shape[1:],
+                                                   channel_last)
         self.X = self.view_converter.topo_view_to_design_mat(V)
-        assert not N.any(N.isnan(self.X))
+        self.quantized = None
 
     def get_design_matrix(self, topo=None):
         """
@@ -389,12 +543,15 @@ class DenseDesignMatrix(Dataset):
                                 "view converter")
             return self.view_converter.topo_view_to_design_mat(topo)
 
+        if self.quantized is not None:
+            return self.dequantize(self.X)
         return self.X
 
     def set_design_matrix(self, X):
         assert len(X.shape) == 2
-        assert not N.any(N.isnan(X))
+        assert not _has_nan(X)
         self.X = X
+        self.quantized = None
 
     def get_targets(self):
         return self.y
@@ -406,6 +563,8 @@ class DenseDesignMatrix(Dataset):
     def get_batch_design(self, batch_size, include_labels=False):
         idx = self.rng.randint(self.X.shape[0] - batch_size + 1)
         rx = self.X[idx:idx + batch_size, :]
+        if self.quantized is not None:
+            rx = self.dequantize(rx)
         if include_labels:
             ry = self.y[idx:idx + batch_size]
             return rx, ry
@@ -425,12 +584,32 @@ class DenseDesignMatrix(Dataset):
 
 
 class DefaultViewConverter(object):
-    def __init__(self, shape):
+    """
+    Converts between design matrices and topological views of shape
+    (batch size,) + `shape`, the last axis of `shape` being the
+    channels.
+
+    By default, the features of a design matrix are stored channel by
+    channel: all the pixels of the first channel, then those of the
+    second one, etc. With `channel_last`, the channels of each pixel
+    are stored next to each other instead, so that the topological view
+    of a contiguous design matrix is a plain reshape.
+
+    Both conversions return views of their argument whenever its
+    strides allow it, and otherwise make a single copy.
+    """
+    def __init__(self, shape, channel_last=False):
         self.shape = shape
+        self.channel_last = channel_last
         self.pixels_per_channel = 1
         for dim in self.shape[:-1]:
             self.pixels_per_channel *= dim
 
+    def __setstate__(self, d):
+        # Converters pickled before channel_last existed.
+        d.setdefault('channel_last', False)
+        self.__dict__.update(d)
+
     def view_shape(self):
         return self.shape
 
@@ -440,47 +619,95 @@ class DefaultViewConverter(object):
     def design_mat_to_topo_view(self, X):
         assert len(X.shape) == 2
         batch_size = X.shape[0]
-        channel_shape = [batch_size]
-        for dim in self.shape[:-1]:
-            channel_shape.append(dim)
-        channel_shape.append(1)
         if self.shape[-1] * self.pixels_per_channel != X.shape[1]:
             raise ValueError('View converter with ' + str(self.shape[-1]) +
                              ' channels and ' + str(self.pixels_per_channel) +
                              ' pixels per channel asked to convert design'
                              ' matrix with ' + str(X.shape[1]) + ' columns.')
-        start = lambda i: self.pixels_per_channel * i
-        stop = lambda i: self.pixels_per_channel * (i + 1)
-        channels = [X[:, start(i):stop(i)].reshape(*channel_shape)
-                    for i in xrange(self.shape[-1])]
-
-        rval = N.concatenate(channels, axis=len(self.shape))
+        if self.channel_last:
+            return X.reshape((batch_size,) + tuple(self.shape))
+        # (batch, channel, pixels...) -> (batch, pixels..., channel)
+        ndim = len(self.shape) + 1
+        channel_major = X.reshape((batch_size, self.shape[-1]) +
+                                  tuple(self.shape[:-1]))
+        rval = channel_major.transpose([0] + range(2, ndim) + [1])
         assert rval.shape[0] == X.shape[0]
-        assert len(rval.shape) == len(self.shape) + 1
+        assert len(rval.shape) == ndim
         return rval
 
     def design_mat_to_weights_view(self, X):
         return self.design_mat_to_topo_view(X)
 
     def topo_view_to_design_mat(self, V):
-        num_channels = self.shape[-1]
         if N.any(N.asarray(self.shape) != N.asarray(V.shape[1:])):
             raise ValueError('View converter for views of shape batch size '
                              'followed by ' + str(self.shape) +
                              ' given tensor of shape ' + str(V.shape))
         batch_size = V.shape[0]
-
-        rval = N.zeros((batch_size, self.pixels_per_channel * num_channels),
-                       dtype=V.dtype)
-
-        for i in xrange(num_channels):
-            ppc = self.pixels_per_channel
-            rval[:, i * ppc:(i + 1) * ppc] = V[..., i].reshape(batch_size, ppc)
+        if not self.channel_last:
+            # (batch, pixels..., channel) -> (batch, channel, pixels...)
+            ndim = len(V.shape)
+            V = V.transpose([0, ndim - 1] + range(1, ndim - 1))
+        rval = V.reshape(batch_size,
+                         self.pixels_per_channel * self.shape[-1])
         assert rval.dtype == V.dtype
 
         return rval
 
 
+def _quantize(X, block_size=10000):
+    """
+    Scales each column of `X` linearly to 0..255 and rounds it to uint8,
+    `block_size` rows at a time.
+
+    Returns
+    -------
+    Q : ndarray
+        The uint8 design matrix.
+    compress_min : ndarray
+        The minimum of each column.
+    compress_max : ndarray
+        The range of each column, 1 for constant columns.
+    """
+    compress_min = N.cast['float32'](X.min(axis=0))
+    compress_max = X.max(axis=0) - compress_min
+    compress_max[compress_max == 0] = 1
+    Q = N.empty(X.shape, dtype='uint8')
+    for start in xrange(0, X.shape[0], block_size):
+        block = X[start:start + block_size] - compress_min
+        block *= 255. / compress_max
+        Q[start:start + block_size] = N.round(block)
+    return Q, compress_min, compress_max
+
+
+def _has_nan(X, block_size=10000):
+    """
+    Returns True if `X` contains a NaN. Looks at `block_size` examples
+    at a time, so that checking a memory-mapped array doesn't need
+    temporaries as large as it.
+    """
+    if X.dtype.kind not in 'fc':
+        return False
+    for start in xrange(0, X.shape[0], block_size):
+        if N.any(N.isnan(X[start:start + block_size])):
+            return True
+    return False
+
+
+def _is_mapped_from(X, path):
+    """
+    Returns True if `X` is a memory map of the whole array stored in
+    the .npy file `path`.
+    """
+    if not isinstance(X, N.memmap) or getattr(X, 'filename', None) is None:
+        return False
+    if not os.path.exists(path) or \
+            os.path.abspath(X.filename) != os.path.abspath(path):
+        return False
+    on_disk = N.load(path, mmap_mode='r')
+    return on_disk.shape == X.shape and on_disk.dtype == X.dtype
+
+
 def from_dataset(dataset, num_examples):
     try:
         V = dataset.get_batch_topo(num_examples)
@@ -0,0 +1,381 @@
+"""
+A dataset reading its examples from an array in an HDF5 file, such as a
+MATLAB v7.3 .mat file, without loading the whole array into memory.
+
+The array is read in aligned chunks of consecutive examples, which are
+cast to floatX when they are read and kept in an LRU cache of bounded
+size, so that iterating over the dataset only keeps a few chunks in
+memory at a time.
+"""
+import copy
+import functools
+from collections import OrderedDict
+
+import numpy
+from theano import config
+
+from pylearn2.datasets.dataset import Dataset
+from pylearn2.datasets.dense_design_matrix import DefaultViewConverter
+from pylearn2.utils.iteration import (make_subset_iterator,
+                                      resolve_iterator_class)
+from pylearn2.utils.string_utils import preprocess
+
+
+class ChunkCache(object):
+    """
+    A least recently used cache of decoded chunks, holding at most
+    `max_bytes` bytes of them. The most recently used chunk is always
+    kept, even if it is larger than `max_bytes` on its own.
+    """
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.num_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._chunks = OrderedDict()
+
+    def get(self, index, load):
+        """
+        Returns chunk `index`, calling `load(index)` to read it if it
+        isn't in the cache.
+        """
+        chunk = self._chunks.pop(index, None)
+        if chunk is not None:
+            self.hits += 1
+        else:
+            self.misses += 1
+            chunk = load(index)
+            self.num_bytes += chunk.nbytes
+        self._chunks[index] = chunk
+        while self.num_bytes > self.max_bytes and len(self._chunks) > 1:
+            oldest, evicted = self._chunks.popitem(last=False)
+            self.num_bytes -= evicted.nbytes
+        return chunk
+
+    def clear(self):
+        self._chunks.clear()
+        self.num_bytes = 0
+
+    def __len__(self):
+        return len(self._chunks)
+
+
+class HDF5Dataset(Dataset):
+    """
+    A dataset whose design matrix is an array in an HDF5 file, read on
+    demand.
+    """
+    _default_seed = (17, 2, 946)
+
+    def __init__(self, filename, key, y_key=None, transpose=False,
+                 view_shape=None, example_range=None, chunk_size=None,
+                 cache_bytes=256 * 2 ** 20, rng=_default_seed):
+        """
+        Parameters
+        ----------
+        filename : str
+            Path of the HDF5 file. Environment variables such as
+            ${PYLEARN2_DATA_PATH} are expanded.
+        key : str
+            Name of the array holding the examples in the file.
+        y_key : str, optional
+            Name of the array holding the targets, which are loaded into
+            memory.
+        transpose : bool, optional
+            Whether the examples are the columns of the array rather
+            than its rows. MATLAB v7.3 files store matrices this way.
+        view_shape : tuple, optional
+            Shape of the topological view of one example, e.g.
+            (96, 96, 3). Required to iterate with topo=True.
+        example_range : tuple, optional
+            (start, stop) of the examples to use.
+        chunk_size : int, optional
+            Number of consecutive examples read at a time. Rounded up to
+            a multiple of the HDF5 chunk size along the examples, so
+            that reads are aligned with the file's own chunks. Defaults
+            to about 4MB of decoded examples.
+        cache_bytes : int, optional
+            Number of bytes of decoded chunks to keep in memory.
+        rng : object, optional
+            A random number generator used for picking random indices
+            into the design matrix when choosing minibatches.
+        """
+        self.filename = filename
+        self.key = key
+        self.y_key = y_key
+        self.transpose = transpose
+        self.cache_bytes = cache_bytes
+        self._open()
+
+        shape = self._data.shape
+        if len(shape) != 2:
+            raise ValueError("%s in %s has shape %s, expected a matrix" %
+                             (key, filename, str(shape)))
+        if transpose:
+            total, self.dim = shape[1], shape[0]
+        else:
+            total, self.dim = shape
+        if example_range is None:
+            example_range = (0, total)
+        self.start, self.stop = example_range
+        if not 0 <= self.start <= self.stop <= total:
+            raise ValueError("example_range %s out of the %d examples of %s" %
+                             (str(example_range), total, key))
+
+        row_bytes = self.dim * numpy.dtype(config.floatX).itemsize
+        if chunk_size is None:
+            chunk_size = max(1, 4 * 2 ** 20 // row_bytes)
+        hdf5_chunks = self._data.chunks
+        if hdf5_chunks is not None:
+            aligned = hdf5_chunks[1 if transpose else 0]
+            chunk_size = -(-chunk_size // aligned) * aligned
+        self.chunk_size = chunk_size
+
+        if y_key is not None:
+            y = numpy.asarray(self._file[y_key])
+            if transpose:
+                y = y.T
+            if y.ndim == 2 and y.shape[1] == 1:
+                y = y[:, 0]
+            self.y = y[self.start:self.stop]
+        else:
+            self.y = None
+
+        if view_shape is not None:
+            self.view_converter = DefaultViewConverter(view_shape)
+        else:
+            self.view_converter = None
+
+        if hasattr(rng, 'random_integers'):
+            self.rng = rng
+        else:
+            self.rng = numpy.random.RandomState(rng)
+        self.default_rng = copy.copy(self.rng)
+
+    def _open(self):
+        import h5py
+        self._file = h5py.File(preprocess(self.filename), 'r')
+        self._data = self._file[self.key]
+        self._cache = ChunkCache(self.cache_bytes)
+
+    def close(self):
+        """Closes the HDF5 file and empties the chunk cache."""
+        self._cache.clear()
+        self._file.close()
+
+    def __getstate__(self):
+        d = self.__dict__.copy()
+        for name in ['_file', '_data', '_cache']:
+            del d[name]
+        return d
+
+    def __setstate__(self, d):
+        self.__dict__.update(d)
+        self._open()
+
+    @property
+    def num_examples(self):
+        return self.stop - self.start
+
+    def _chunk_range(self, index):
+        """
+        Returns the (start, stop) examples of the file in chunk `index`.
+        Chunks are aligned on the examples of the file rather than on
+        example_range, so that they match the file's own chunks.
+        """
+        start = max(index * self.chunk_size, self.start)
+        stop = min((index + 1) * self.chunk_size, self.stop)
+        return start, stop
+
+    def _load_chunk(self, index):
+        """Reads chunk `index` from the file and casts it to floatX."""
+        start, stop = self._chunk_range(index)
+        if self.transpose:
+            raw = self._data[:, start:stop].T
+        else:
+            raw = self._data[start:stop]
+        return numpy.cast[config.floatX](raw)
+
+    def _chunk(self, index):
+        return self._cache.get(index, self._load_chunk)
+
+    def get_rows(self, index):
+        """
+        Returns the examples selected by `index`, either a slice or a
+        sequence of indices, as a new floatX design matrix.
+
+        The chunks are read in order. In particular, the indices of a
+        random batch are grouped by chunk so that each chunk is read
+        once per batch, while the rows come back in the order asked for.
+        """
+        if isinstance(index, slice):
+            start, stop, step = index.indices(self.num_examples)
+            if step != 1:
+                return self.get_rows(numpy.arange(start, stop, step))
+            out = numpy.empty((max(stop - start, 0), self.dim),
+                              dtype=config.floatX)
+            # Positions in the file.
+            pos, stop = start + self.start, stop + self.start
+            offset = pos
+            while pos < stop:
+                chunk_index = pos // self.chunk_size
+                chunk_start, chunk_stop = self._chunk_range(chunk_index)
+                chunk_stop = min(chunk_stop, stop)
+                chunk = self._chunk(chunk_index)
+                out[pos - offset:chunk_stop - offset] = \
+                    chunk[pos - chunk_start:chunk_stop - chunk_start]
+                pos = chunk_stop
+            return out
+
+        index = numpy.asarray(index, dtype='int64')
+        if index.ndim != 1:
+            raise ValueError("expected a slice or a vector of indices, got "
+                             "an array of shape %s" % str(index.shape))
+        if len(index) > 0 and (index.min() < 0 or
+                               index.max() >= self.num_examples):
+            raise IndexError("example index out of range for a dataset of "
+                             "%d examples" % self.num_examples)
+        out = numpy.empty((len(index), self.dim), dtype=config.floatX)
+        index = index + self.start
+        chunk_indices = index // self.chunk_size
+        order = numpy.argsort(chunk_indices, kind='mergesort')
+        bounds = numpy.flatnonzero(numpy.diff(chunk_indices[order])) + 1
+        for positions in numpy.split(order, bounds):
+            if len(positions) == 0:
+                continue
+            chunk_index = chunk_indices[positions[0]]
+            chunk_start, chunk_stop = self._chunk_range(chunk_index)
+            chunk = self._chunk(chunk_index)
+            out[positions] = chunk[index[positions] - chunk_start]
+        return out
+
+    @functools.wraps(Dataset.set_iteration_scheme)
+    def set_iteration_scheme(self, mode=None, batch_size=None,
+                             num_batches=None, topo=False, targets=False,
+                             shard_index=None, num_shards=None):
+        if mode is not None:
+            self._iter_subset_class = mode = resolve_iterator_class(mode)
+        elif hasattr(self, '_iter_subset_class'):
+            mode = self._iter_subset_class
+        else:
+            raise ValueError('iteration mode not provided and no default '
+                             'mode set for %s' % str(self))
+        self._iter_batch_size = batch_size
+        self._iter_num_batches = num_batches
+        self._iter_topo = topo
+        self._iter_targets = targets
+        self._iter_shard_index = shard_index
+        self._iter_num_shards = num_shards
+        # Try to create an iterator with these settings.
+        rng = self.rng if mode.stochastic else None
+        self.iterator(mode, batch_size, num_batches, topo, targets, rng=rng)
+
+    @functools.wraps(Dataset.iterator)
+    def iterator(self, mode=None, batch_size=None, num_batches=None,
+                 topo=None, targets=None, rng=None, shard_index=None,
+                 num_shards=None):
+        if mode is None:
+            if hasattr(self, '_iter_subset_class'):
+                mode = self._iter_subset_class
+            else:
+                raise ValueError('iteration mode not provided and no default '
+                                 'mode set for %s' % str(self))
+        else:
+            mode = resolve_iterator_class(mode)
+        if batch_size is None:
+            batch_size = getattr(self, '_iter_batch_size', None)
+        if num_batches is None:
+            num_batches = getattr(self, '_iter_num_batches', None)
+        if topo is None:
+            topo = getattr(self, '_iter_topo', False)
+        if targets is None:
+            targets = getattr(self, '_iter_targets', False)
+        if shard_index is None and num_shards is None:
+            shard_index = getattr(self, '_iter_shard_index', None)
+            num_shards = getattr(self, '_iter_num_shards', None)
+        if rng is None and mode.stochastic:
+            rng = self.rng
+        subset_iterator = make_subset_iterator(mode, self.num_examples,
+                                               batch_size, num_batches, rng,
+                                               shard_index, num_shards)
+        return HDF5DatasetIterator(self, subset_iterator, topo, targets)
+
+    def get_design_matrix(self, topo=None):
+        """
+        Returns topo in design matrix format or, if topo is None, the
+        whole dataset, which is then read into memory.
+        """
+        if topo is not None:
+            return self._get_view_converter().topo_view_to_design_mat(topo)
+        return self.get_rows(slice(0, self.num_examples))
+
+    def get_topological_view(self, mat=None):
+        """
+        Returns mat in topological view format or, if mat is None, the
+        whole dataset, which is then read into memory.
+        """
+        if mat is None:
+            mat = self.get_design_matrix()
+        return self._get_view_converter().design_mat_to_topo_view(mat)
+
+    def _get_view_converter(self):
+        if self.view_converter is None:
+            raise Exception("%s has no view_shape, so it has no topological "
+                            "view" % self.key)
+        return self.view_converter
+
+    def get_targets(self):
+        return self.y
+
+    def get_batch_design(self, batch_size, include_labels=False):
+        idx = self.rng.randint(self.num_examples - batch_size + 1)
+        rx = self.get_rows(slice(idx, idx + batch_size))
+        if include_labels:
+            if self.y is None:
+                raise ValueError("include_labels=True on a dataset with no "
+                                 "targets")
+            return rx, self.y[idx:idx + batch_size]
+        return rx
+
+    def get_batch_topo(self, batch_size):
+        batch_design = self.get_batch_design(batch_size)
+        return self.get_topological_view(batch_design)
+
+    def get_stream_position(self):
+        return copy.copy(self.rng)
+
+    def set_stream_position(self, pos):
+        self.rng = copy.copy(pos)
+
+    def restart_stream(self):
+        self.rng = copy.copy(self.default_rng)
+
+
+class HDF5DatasetIterator(object):
+    """
+    Iterates over the batches of an HDF5Dataset selected by one of the
+    mode iterators of pylearn2.utils.iteration.
+    """
+    def __init__(self, dataset, subset_iterator, topo=False, targets=False):
+        self._dataset = dataset
+        self._subset_iterator = subset_iterator
+        self._topo = topo
+        self._targets = targets
+        if topo:
+            # Fail now rather than on the first batch.
+            dataset._get_view_converter()
+        if targets and dataset.get_targets() is None:
+            raise ValueError("Can't iterate with targets=True on a "
+                             "dataset object with no targets")
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        next_index = self._subset_iterator.next()
+        features = self._dataset.get_rows(next_index)
+        if self._topo:
+            features = self._dataset.get_topological_view(features)
+        if self._targets:
+            return features, self._dataset.get_targets()[next_index]
+        return features
@@ -1,5 +1,6 @@
 import numpy as N
 from pylearn2.datasets import dense_design_matrix
+from pylearn2.datasets.cache import cached_arrays
 from pylearn2.utils import serial
 
 class MNIST(dense_design_matrix.DenseDesignMatrix):
@@ -7,19 +8,25 @@ class MNIST(dense_design_matrix.DenseDesignMatrix):
 
         path = "${PYLEARN2_DATA_PATH}/mnist/mnist-python/"+which_set
 
-        obj = serial.load(path)
-        X = obj['data']
-        X = N.cast['float32'](X)
-        y = N.asarray(obj['labels'])
+        def build():
+            obj = serial.load(path)
+            X = obj['data']
+            X = N.cast['float32'](X)
+            y = N.asarray(obj['labels'])
 
-        if center:
-            X -= X.mean(axis=0)
+            if center:
+                X -= X.mean(axis=0)
 
-        view_converter = dense_design_matrix.DefaultViewConverter((28,28,1))
+            assert not N.any(N.isnan(X))
+            return {'X': X, 'y': y}
 
-        super(MNIST,self).__init__(X = X, y = y, view_converter = view_converter)
+        data = cached_arrays(MNIST, {'which_set': which_set, 'center': center},
+                             [path], build)
 
-        assert not N.any(N.isnan(self.X))
+        view_converter = dense_design_matrix.DefaultViewConverter((28,28,1))
+
+        super(MNIST,self).__init__(X = data['X'], y = data['y'],
+                                   view_converter = view_converter)
 
 
 class MNIST_rotated_background(dense_design_matrix.DenseDesignMatrix):
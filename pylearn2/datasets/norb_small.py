@@ -2,6 +2,7 @@ import numpy
 import os
 
 from pylearn2.datasets import dense_design_matrix
+from pylearn2.datasets.cache import cached_arrays
 from pylearn.io import filetensor
 from pylearn2.datasets import retina
 
@@ -11,7 +12,7 @@ class NORBSmall(dense_design_matrix.DenseDesignMatrix):
     """
 
     @classmethod
-    def load(cls, which_set, desc):
+    def path(cls, which_set, desc):
 
         assert desc in ['dat','cat','info']
 
@@ -21,7 +22,12 @@ class NORBSmall(dense_design_matrix.DenseDesignMatrix):
         else:
             base += '5x01235x9x18x6x2x96x96-testing'
 
-        fp = open(base + '-%s.mat' % desc, 'r')
+        return base + '-%s.mat' % desc
+
+    @classmethod
+    def load(cls, which_set, desc):
+
+        fp = open(cls.path(which_set, desc), 'r')
         data = filetensor.read(fp)
         fp.close()
 
@@ -35,30 +41,40 @@ class NORBSmall(dense_design_matrix.DenseDesignMatrix):
         """
         assert which_set in ['train','test']
 
-        X = NORBSmall.load(which_set, 'dat')
+        def build():
+            X = NORBSmall.load(which_set, 'dat')
+
+            # put things in pylearn2's DenseDesignMatrix format
+            X = numpy.cast['float32'](X)
+            X = X.reshape(-1, 2*96*96)
 
-        # put things in pylearn2's DenseDesignMatrix format
-        X = numpy.cast['float32'](X)
-        X = X.reshape(-1, 2*96*96)
+            #this is uint8
+            y = NORBSmall.load(which_set, 'cat')
+            if multi_target:
+                y_extra = NORBSmall.load(which_set, 'info')
+                y = numpy.hstack((y[:,numpy.newaxis],y_extra))
 
-        #this is uint8
-        y = NORBSmall.load(which_set, 'cat')
-        if multi_target:
-            y_extra = NORBSmall.load(which_set, 'info')
-            y = numpy.hstack((y[:,numpy.newaxis],y_extra))
+            if center:
+                X -= 127.5
 
-        if center:
-            X -= 127.5
+            return {'X': X, 'y': y}
+
+        data = cached_arrays(NORBSmall, {'which_set': which_set,
+                                         'center': center,
+                                         'multi_target': multi_target},
+                             _label_paths(which_set, multi_target) +
+                             [NORBSmall.path(which_set, 'dat')], build)
 
         view_converter = dense_design_matrix.DefaultViewConverter((96,96,2))
 
-        super(NORBSmall,self).__init__(X = X, y = y, view_converter = view_converter)
+        super(NORBSmall,self).__init__(X = data['X'], y = data['y'],
+                                       view_converter = view_converter)
 
 
 class FoveatedNORB(dense_design_matrix.DenseDesignMatrix):
 
     @classmethod
-    def load(cls, which_set):
+    def path(cls, which_set):
 
         base = '%s/norb_small/foveated/smallnorb-' % os.getenv('PYLEARN2_DATA_PATH')
         if which_set == 'train':
@@ -66,7 +82,12 @@ class FoveatedNORB(dense_design_matrix.DenseDesignMatrix):
         else:
             base += '5x01235x9x18x6x2x96x96-testing-dat'
 
-        data = numpy.load(base + '.npy', 'r')
+        return base + '.npy'
+
+    @classmethod
+    def load(cls, which_set):
+
+        data = numpy.load(cls.path(which_set), 'r')
         return data
 
     def __init__(self, which_set, center=False, multi_target = False):
@@ -77,21 +98,39 @@ class FoveatedNORB(dense_design_matrix.DenseDesignMatrix):
         """
         assert which_set in ['train','test']
 
-        X = FoveatedNORB.load(which_set)
+        def build():
+            X = FoveatedNORB.load(which_set)
 
-        # put things in pylearn2's DenseDesignMatrix format
-        X = numpy.cast['float32'](X)
+            # put things in pylearn2's DenseDesignMatrix format
+            X = numpy.cast['float32'](X)
 
-        #this is uint8
-        y = NORBSmall.load(which_set, 'cat')
-        if multi_target:
-            y_extra = NORBSmall.load(which_set, 'info')
-            y = numpy.hstack((y[:,numpy.newaxis],y_extra))
+            #this is uint8
+            y = NORBSmall.load(which_set, 'cat')
+            if multi_target:
+                y_extra = NORBSmall.load(which_set, 'info')
+                y = numpy.hstack((y[:,numpy.newaxis],y_extra))
 
-        if center:
-            X -= 127.5
+            if center:
+                X -= 127.5
+
+            return {'X': X, 'y': y}
+
+        data = cached_arrays(FoveatedNORB, {'which_set': which_set,
+                                            'center': center,
+                                            'multi_target': multi_target},
+                             _label_paths(which_set, multi_target) +
+                             [FoveatedNORB.path(which_set)], build)
 
         view_converter = retina.RetinaCodingViewConverter((96,96,2), (8,4,2,2))
 
-        super(FoveatedNORB,self).__init__(X = X, y = y, view_converter = view_converter)
+        super(FoveatedNORB,self).__init__(X = data['X'], y = data['y'],
+                                          view_converter = view_converter)
+
+
+def _label_paths(which_set, multi_target):
+    """Returns the paths of the files the labels of small NORB are read from."""
+    paths = [NORBSmall.path(which_set, 'cat')]
+    if multi_target:
+        paths.append(NORBSmall.path(which_set, 'info'))
+    return paths
 
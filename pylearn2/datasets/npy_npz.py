@@ -1,8 +1,10 @@
 """Objects for datasets serialized in the NumPy native format (.npy/.npz)."""
 import functools
+import warnings
 import numpy
 from theano import config
-from pylearn2.datasets.dense_design_matrix import DenseDesignMatrix
+from pylearn2.datasets.dense_design_matrix import (DenseDesignMatrix,
+                                                  DefaultViewConverter)
 
 class NpyDataset(DenseDesignMatrix):
     """A dense dataset based on a single array stored as a .npy file."""
@@ -18,20 +20,32 @@ class NpyDataset(DenseDesignMatrix):
         mmap_mode : str, optional
             Memory mapping options for memory-mapping an array on disk,
             rather than loading it into memory. See the `numpy.load`
-            docstring for details.
+            docstring for details. Batches are then read from disk and
+            cast to floatX one at a time.
         """
         self._path = file
+        self._mmap_mode = mmap_mode
         self._loaded = False
 
     def _deferred_load(self):
         self._loaded = True
-        loaded = numpy.load(self._path)
+        loaded = numpy.load(self._path, mmap_mode=self._mmap_mode)
         assert isinstance(loaded, numpy.ndarray), (
             "single arrays (.npy) only"
         )
         if len(loaded.shape) == 2:
             super(NpyDataset, self).__init__(X=loaded)
+        elif isinstance(loaded, numpy.memmap) and loaded.shape[-1] == 1:
+            # With a single channel, the design matrix is a view of the
+            # topological view, so the data can stay on disk.
+            X = loaded.reshape(loaded.shape[0], -1)
+            converter = DefaultViewConverter(loaded.shape[1:])
+            super(NpyDataset, self).__init__(X=X, view_converter=converter)
         else:
+            if isinstance(loaded, numpy.memmap):
+                warnings.warn("%s holds a topological view with several "
+                              "channels, which must be converted to a design "
+                              "matrix in memory" % str(self._path))
             super(NpyDataset, self).__init__(topo_view=loaded)
 
     @functools.wraps(DenseDesignMatrix.get_design_matrix)
@@ -1,27 +1,297 @@
 import warnings
 import copy
+import os
 import numpy as np
+from numpy.lib.stride_tricks import as_strided
 from scipy import linalg
+from theano import config
 from theano import function
 import theano.tensor as T
+from pylearn2.utils.string_utils import preprocess
 
 class Pipeline(object):
-    def __init__(self):
-        self.items = []
-    #
+    def __init__(self, items=None, chunk_size=None, output_path=None):
+        """
+        Parameters
+        ----------
+        items : list, optional
+            The preprocessors to apply, in order. More can be appended
+            to `self.items`.
+        chunk_size : int, optional
+            If given, the design matrix is preprocessed `chunk_size`
+            examples at a time rather than by applying each item to the
+            whole dataset, see `transform_dataset`. All the items must
+            then be ExamplewisePreprocessors.
+        output_path : str, optional
+            With `chunk_size`, write the preprocessed design matrix to a
+            new .npy file at this path, and memory-map it.
+        """
+        if items is None:
+            items = []
+        self.items = items
+        self.chunk_size = chunk_size
+        self.output_path = output_path
+
+    def __setstate__(self, d):
+        # Pipelines pickled before chunking existed.
+        d.setdefault('chunk_size', None)
+        d.setdefault('output_path', None)
+        self.__dict__.update(d)
 
     def apply(self, dataset, can_fit = False):
+        if self.chunk_size is None:
+            for item in self.items:
+                item.apply(dataset, can_fit)
+        else:
+            dataset.set_design_matrix(self.transform_dataset(dataset,
+                                                             can_fit))
+
+    def transform_dataset(self, dataset, can_fit = False):
+        """
+        Returns the design matrix of `dataset` preprocessed by all the
+        items, `chunk_size` examples at a time, without modifying the
+        dataset. `dataset` may be any dataset with a design matrix, such
+        as a DenseDesignMatrix, possibly memory-mapped or quantized, an
+        HDF5Dataset or a VirtualDesignMatrix.
+
+        The items that need statistics of the dataset (e.g. Standardize,
+        or ZCA if it isn't fitted yet) are fitted first, each in its own
+        pass over the chunks preprocessed by the items before it. A last
+        pass preprocesses the chunks with all the items and copies them
+        to the output, which is memory mapped from `output_path` if it
+        is set. Besides the output, memory use is bounded by a few
+        chunks.
+        """
+        if self.chunk_size is None:
+            raise ValueError("transform_dataset needs a chunk_size")
         for item in self.items:
-            item.apply(dataset, can_fit)
+            if not isinstance(item, ExamplewisePreprocessor):
+                raise ValueError("%s can't be applied a chunk at a time" %
+                                 str(item))
+        num_examples = dataset.num_examples
+
+        def chunks(items):
+            for start in xrange(0, num_examples, self.chunk_size):
+                stop = min(start + self.chunk_size, num_examples)
+                X = _design_rows(dataset, start, stop)
+                for item in items:
+                    X = item.transform(X)
+                yield start, stop, X
+
+        for i, item in enumerate(self.items):
+            accumulator = item.fit_accumulator(can_fit)
+            if accumulator is not None:
+                for start, stop, X in chunks(self.items[:i]):
+                    accumulator.update(X)
+                item.finish_fit(accumulator)
+
+        output = None
+        for start, stop, X in chunks(self.items):
+            if output is None:
+                output = self._allocate_output(dataset,
+                                               (num_examples, X.shape[1]),
+                                               X.dtype)
+            output[start:stop] = X
+        if output is None:
+            raise ValueError("can't preprocess a dataset with no examples")
+        return output
+
+    def _allocate_output(self, dataset, shape, dtype):
+        if self.output_path is None:
+            return np.empty(shape, dtype=dtype)
+        path = preprocess(self.output_path)
+        source = getattr(dataset, 'X', None)
+        if (isinstance(source, np.memmap) and source.filename is not None
+                and os.path.exists(path)
+                and os.path.samefile(source.filename, path)):
+            raise ValueError("the output path %s is the file the design "
+                             "matrix is read from" % path)
+        return np.lib.format.open_memmap(path, mode='w+', dtype=dtype,
+                                         shape=shape)
+
+
+def _design_rows(dataset, start, stop):
+    """
+    Returns a copy of examples start:stop of the design matrix of
+    `dataset`, as floats.
+    """
+    X = getattr(dataset, 'X', None)
+    if X is None:
+        # Datasets reading their examples on demand, such as
+        # HDF5Dataset or VirtualDesignMatrix, return new arrays.
+        rows = dataset.get_rows(slice(start, stop))
+    elif getattr(dataset, 'quantized', None) is not None:
+        rows = dataset.dequantize(X[start:stop])
+    else:
+        rows = np.array(X[start:stop])
+    if rows.dtype.kind != 'f':
+        rows = np.cast[config.floatX](rows)
+    return rows
+
+
+class FeatureMoments(object):
+    """
+    Accumulates the number of examples and the mean and variance (or
+    covariance matrix) of the features of design matrices given one
+    chunk at a time, in float64.
+
+    Chunks are merged with the pairwise update of Chan, Golub and
+    LeVeque, which stays accurate when the means are large compared to
+    the standard deviations. Large chunks are processed `block_size`
+    rows at a time to bound the temporaries.
+    """
+    def __init__(self, covariance=False, block_size=10000):
+        self.covariance = covariance
+        self.block_size = block_size
+        self.n = 0
+        self.mean = None
+        # Sum of the squared deviations from the mean, per feature, or
+        # of the products of the deviations with covariance=True.
+        self.m2 = None
+
+    def update(self, X):
+        """Adds the examples of the design matrix X."""
+        for start in xrange(0, X.shape[0], self.block_size):
+            self._update_block(X[start:start + self.block_size])
+
+    def _update_block(self, X):
+        n = X.shape[0]
+        if n == 0:
+            return
+        centered = np.array(X, dtype='float64')
+        mean = centered.mean(axis=0)
+        centered -= mean
+        if self.covariance:
+            m2 = np.dot(centered.T, centered)
+        else:
+            m2 = np.square(centered).sum(axis=0)
+        if self.n == 0:
+            self.n, self.mean, self.m2 = n, mean, m2
+            return
+        total = self.n + n
+        delta = mean - self.mean
+        if self.covariance:
+            m2 += np.outer(delta, delta) * (self.n * float(n) / total)
+        else:
+            m2 += np.square(delta) * (self.n * float(n) / total)
+        self.m2 += m2
+        self.mean += delta * (float(n) / total)
+        self.n = total
+
+    def variance(self):
+        """
+        Returns the variance of each feature, or with covariance=True
+        the covariance matrix, normalized by the number of examples.
+        """
+        if self.n == 0:
+            raise ValueError("no examples were accumulated")
+        return self.m2 / self.n
+
+    def global_mean(self):
+        """Returns the mean of all the elements."""
+        return self.mean.mean()
+
+    def global_variance(self):
+        """Returns the variance of all the elements."""
+        variance = self.variance()
+        if self.covariance:
+            variance = np.diag(variance)
+        return (variance + np.square(self.mean - self.global_mean())).mean()
+
+
+class ExamplewisePreprocessor(object):
+    """
+    Base class of the preprocessors that transform each example
+    independently of the others, possibly using statistics fitted on a
+    dataset. Besides being applied to a whole dataset, they can be
+    applied to a dataset one chunk of examples at a time, see
+    Pipeline.transform_dataset.
+
+    Subclasses implement `transform` and, if they need statistics of
+    the dataset, `fit_accumulator` and `finish_fit`.
+    """
+    def fit_accumulator(self, can_fit):
+        """
+        Returns an object with an `update(X)` method to give the
+        examples of the dataset to, one chunk at a time, before calling
+        `finish_fit` with it. Returns None if no statistics are needed.
+        """
+        return None
+
+    def finish_fit(self, accumulator):
+        """Stores the statistics gathered by `accumulator`."""
+        pass
+
+    def transform(self, X):
+        """
+        Returns the preprocessed examples of the design matrix X, which
+        may be overwritten.
+        """
+        raise NotImplementedError()
+
+    def apply(self, dataset, can_fit = False):
+        X = dataset.get_design_matrix()
+        accumulator = self.fit_accumulator(can_fit)
+        if accumulator is not None:
+            accumulator.update(X)
+            self.finish_fit(accumulator)
+        dataset.set_design_matrix(self.transform(X))
+
+def _allocate_topo(shape, dtype, output_path):
+    """
+    Returns an uninitialized array of the given shape, in memory or,
+    if `output_path` is not None, memory mapped from a new .npy file.
+    """
+    if output_path is None:
+        return np.empty(shape, dtype=dtype)
+    return np.lib.format.open_memmap(preprocess(output_path), mode='w+',
+                                     dtype=dtype, shape=tuple(shape))
+
+
+def _batches(num_examples, batch_size):
+    """Yields (start, stop) ranges of at most `batch_size` examples."""
+    if batch_size is None:
+        batch_size = max(num_examples, 1)
+    for start in xrange(0, num_examples, batch_size):
+        yield start, min(start + batch_size, num_examples)
+
 
 class ExtractGridPatches(object):
     """ Converts a dataset into a dataset of patches
         extracted along a regular grid from each image.
         The order of the images is preserved.
     """
-    def __init__(self, patch_shape, patch_stride):
+    def __init__(self, patch_shape, patch_stride, batch_size=None,
+                 output_path=None):
+        """
+        Parameters
+        ----------
+        patch_shape : list
+            The shape of the patches along each topological dimension.
+        patch_stride : list
+            The distance between two patches along each topological
+            dimension.
+        batch_size : int, optional
+            If given, the patches are copied `batch_size` images at a
+            time rather than all at once, so that the images are read
+            from a memory-mapped design matrix one chunk at a time.
+        output_path : str, optional
+            If given, the patches are written to a new .npy file at this
+            path, which is memory mapped by the dataset, so that the
+            patches don't need to fit in memory. The design matrix is
+            then stored with the channels of each pixel next to each
+            other (see DefaultViewConverter), as a view of the file.
+        """
         self.patch_shape = patch_shape
         self.patch_stride = patch_stride
+        self.batch_size = batch_size
+        self.output_path = output_path
+
+    def __setstate__(self, d):
+        # Preprocessors pickled before chunking existed.
+        d.setdefault('batch_size', None)
+        d.setdefault('output_path', None)
+        self.__dict__.update(d)
 
     def apply(self, dataset, can_fit = False):
 
@@ -34,9 +304,7 @@ class ExtractGridPatches(object):
                 +""" topological dimensions called on dataset with """+
                 str(num_topological_dimensions)+""".""")
 
-        num_patches = X.shape[0]
-
-        max_strides = [X.shape[0]-1]
+        grid_shape = []
 
         for i in xrange(num_topological_dimensions):
             patch_width = self.patch_shape[i]
@@ -50,75 +318,69 @@ class ExtractGridPatches(object):
             if stride == 0:
                 max_stride_this_axis = 0
             else:
-                max_stride_this_axis = last_valid_coord / stride
+                max_stride_this_axis = last_valid_coord // stride
 
-            num_strides_this_axis = max_stride_this_axis + 1
+            grid_shape.append(max_stride_this_axis + 1)
 
-            max_strides.append(max_stride_this_axis)
-
-            num_patches *= num_strides_this_axis
+        patches_per_example = int(np.prod(grid_shape))
 
         #batch size
-        output_shape = [ num_patches ]
+        output_shape = [ X.shape[0] * patches_per_example ]
         #topological dimensions
         for dim in self.patch_shape:
             output_shape.append(dim)
         #number of channels
         output_shape.append(X.shape[-1])
 
-        output = np.zeros(output_shape, dtype = X.dtype)
-
-        channel_slice = slice(0,X.shape[-1])
-
-        coords = [ 0 ]  *  (num_topological_dimensions + 1)
-
-        keep_going = True
-        i = 0
-        while keep_going:
-
-            args = [ coords[0] ]
-
-            for j in xrange(num_topological_dimensions):
-                coord = coords[j+1] * self.patch_stride[j]
-                args.append(slice(coord,coord+self.patch_shape[j]))
-            #end for j
-
-            args.append(channel_slice)
-
-            patch = X[args]
-            output[i,:] = patch
-            i += 1
-
-            #increment coordinates
-            j = 0
+        output = _allocate_topo(output_shape, X.dtype, self.output_path)
 
-            keep_going = False
+        # A view of X of shape (examples,) + grid_shape + patch_shape +
+        # (channels,): the patches of each image, in the order of their
+        # coordinates on the grid.
+        topo_strides = X.strides[1:-1]
+        windows = as_strided(X,
+                shape = (X.shape[0],) + tuple(grid_shape) +
+                        tuple(self.patch_shape) + (X.shape[-1],),
+                strides = (X.strides[0],) +
+                          tuple(s * stride for s, stride
+                                in zip(topo_strides, self.patch_stride)) +
+                          topo_strides + (X.strides[-1],))
 
-            while not keep_going:
-                if coords[-(j+1)] < max_strides[-(j+1)]:
-                    coords[-(j+1)] += 1
-                    keep_going = True
-                else:
-                    coords[-(j+1)] = 0
+        for start, stop in _batches(X.shape[0], self.batch_size):
+            out = output[start * patches_per_example:
+                         stop * patches_per_example]
+            out.reshape(windows[start:stop].shape)[...] = windows[start:stop]
 
-                    if j == num_topological_dimensions:
-                        break
-
-                    j = j + 1
-                    #end if j
-                #end if coords
-            #end while not continue
-        #end while continue
-
-        dataset.set_topological_view(output)
+        dataset.set_topological_view(output,
+                                     channel_last = self.output_path is not None)
 
 class ReassembleGridPatches(object):
     """ Converts a dataset of patches into a dataset of full examples
         This is the inverse of ExtractGridPatches for patch_stride=patch_shape
     """
-    def __init__(self, orig_shape, patch_shape):
+    def __init__(self, orig_shape, patch_shape, batch_size=None,
+                 output_path=None):
+        """
+        Parameters
+        ----------
+        orig_shape : list
+            The shape of the images along each topological dimension.
+        patch_shape : list
+            The shape of the patches along each topological dimension.
+        batch_size, output_path : optional
+            As for ExtractGridPatches: the number of images assembled at
+            a time, and a .npy file to write the images to.
+        """
         self.patch_shape = patch_shape
         self.orig_shape = orig_shape
+        self.batch_size = batch_size
+        self.output_path = output_path
+
+    def __setstate__(self, d):
+        # Preprocessors pickled before chunking existed.
+        d.setdefault('batch_size', None)
+        d.setdefault('output_path', None)
+        self.__dict__.update(d)
 
     def apply(self, dataset, can_fit = False):
 
@@ -135,6 +397,8 @@ class ReassembleGridPatches(object):
 
         num_examples = num_patches
 
+        grid_shape = []
+
         for im_dim, patch_dim in zip(self.orig_shape, self.patch_shape):
 
             if im_dim % patch_dim != 0:
@@ -142,13 +406,16 @@ class ReassembleGridPatches(object):
                         str(self.patch_shape)+' into images of shape '+\
                         str(self.orig_shape))
 
-            patches_this_dim = im_dim / patch_dim
+            patches_this_dim = im_dim // patch_dim
 
             if num_examples % patches_this_dim != 0:
                 raise Exception('Trying to re-assemble '+str(num_patches) + \
                         ' patches of shape '+str(self.patch_shape)+\
                         ' into images of shape '+str(self.orig_shape))
-            num_examples /= patches_this_dim
+            num_examples //= patches_this_dim
+            grid_shape.append(patches_this_dim)
+
+        patches_per_example = int(np.prod(grid_shape))
 
         #batch size
         reassembled_shape = [ num_examples ]
@@ -158,62 +425,32 @@ class ReassembleGridPatches(object):
         #number of channels
         reassembled_shape.append(patches.shape[-1])
 
-        reassembled = np.zeros(reassembled_shape, dtype = patches.dtype)
-
-        channel_slice = slice(0,patches.shape[-1])
-
-        coords = [ 0 ]  *  (num_topological_dimensions + 1)
-
-
-        max_strides = [ num_examples - 1]
-        for dim, pd in zip(self.orig_shape, self.patch_shape):
-            assert dim % pd == 0
-            max_strides.append(dim/pd-1)
-
-        keep_going = True
-        i = 0
-        while keep_going:
-
-            args = [ coords[0] ]
-
-            for j in xrange(num_topological_dimensions):
-                coord = coords[j+1]
-                args.append(slice(coord*self.patch_shape[j],(coord+1)*self.patch_shape[j]))
-                assert (coord + 1) * self.patch_shape[j] <= reassembled.shape[j+1]
-            #end for j
-
-            args.append(channel_slice)
-
-            try:
-                patch = patches[i,:]
-            except IndexError:
-                raise IndexError('Gave index of '+str(i)+',: into thing of shape '+str(patches.shape))
-
-            reassembled[args] = patch
-            i += 1
-
-            #increment coordinates
-            j = 0
-
-            keep_going = False
-
-            while not keep_going:
-                if coords[-(j+1)] < max_strides[-(j+1)]:
-                    coords[-(j+1)] += 1
-                    keep_going = True
-                else:
-                    coords[-(j+1)] = 0
-
-                    if j == num_topological_dimensions:
-                        break
-
-                    j = j + 1
-                    #end if j
-                #end if coords
-            #end while not continue
-        #end while continue
-
-        dataset.set_topological_view(reassembled)
+        reassembled = _allocate_topo(reassembled_shape, patches.dtype,
+                                     self.output_path)
+
+        # Patch (example, grid coordinates, patch coordinates) goes to
+        # image coordinates grid * patch_shape + patch, i.e. to the
+        # (example, g1, p1, g2, p2, ...) view of the images.
+        interleaved_shape = []
+        axes = [ 0 ]
+        for j in xrange(num_topological_dimensions):
+            interleaved_shape.extend([grid_shape[j], self.patch_shape[j]])
+            axes.extend([1 + j, 1 + num_topological_dimensions + j])
+        axes.append(1 + 2 * num_topological_dimensions)
+
+        for start, stop in _batches(num_examples, self.batch_size):
+            chunk = patches[start * patches_per_example:
+                            stop * patches_per_example]
+            chunk = chunk.reshape([stop - start] + grid_shape +
+                                  list(self.patch_shape) +
+                                  [patches.shape[-1]])
+            out = reassembled[start:stop]
+            out = out.reshape([stop - start] + interleaved_shape +
+                              [patches.shape[-1]])
+            out[...] = chunk.transpose(axes)
+
+        dataset.set_topological_view(reassembled,
+                                     channel_last = self.output_path is not None)
 
 class ExtractPatches(object):
     """ Converts an image dataset into a dataset of patches
@@ -271,15 +508,14 @@ class ExtractPatches(object):
 
         dataset.set_topological_view(output)
 
-class MakeUnitNorm(object):
+class MakeUnitNorm(ExamplewisePreprocessor):
     def __init__(self):
         pass
 
-    def apply(self, dataset, can_fit):
-        X = dataset.get_design_matrix()
+    def transform(self, X):
         X_norm = np.sqrt(np.sum(X**2, axis=1))
         X /= X_norm[:,None]
-        dataset.set_design_matrix(X)
+        return X
 
 class RemoveMean(object):
     def __init__(self, axis=0):
@@ -290,36 +526,46 @@ class RemoveMean(object):
         X -= X.mean(axis=self.axis)
         dataset.set_design_matrix(X)
 
-class Standardize(object):
+class Standardize(ExamplewisePreprocessor):
 
     def __init__(self, global_mean=False, global_std=False, std_eps=1e-4):
         self.global_mean= global_mean
         self.global_std = global_std
         self.std_eps = std_eps
 
-    def apply(self, dataset, can_fit):
-        X = dataset.get_design_matrix()
+    def fit_accumulator(self, can_fit):
+        # The statistics of each dataset standardize that dataset.
+        return FeatureMoments()
 
+    def finish_fit(self, accumulator):
         # remove mean across all dataset, or along each dimension
-        mean= np.mean(X) if self.global_mean else np.mean(X, axis=0)
+        if self.global_mean:
+            self.mean_ = accumulator.global_mean()
+        else:
+            self.mean_ = accumulator.mean
         # divide by std across all dataset, or along each dimension
-        std = np.std(X)  if self.global_std  else np.std(X, axis=0)
+        if self.global_std:
+            self.std_ = np.sqrt(accumulator.global_variance())
+        else:
+            self.std_ = np.sqrt(accumulator.variance())
 
-        dataset.set_design_matrix( (X - mean) / (self.std_eps + std) )
+    def transform(self, X):
+        mean = np.cast[X.dtype](self.mean_)
+        std = np.cast[X.dtype](self.std_eps + self.std_)
+        return (X - mean) / std
 
 
-class RemapInterval(object):
+class RemapInterval(ExamplewisePreprocessor):
     def __init__(self, map_from, map_to):
         assert map_from[0] < map_from[1] and len(map_from) == 2
         assert map_to[0] < map_to[1] and len(map_to) == 2
         self.map_from = [np.float(x) for x in map_from]
         self.map_to   = [np.float(x) for x in map_to]
 
-    def apply(self, dataset, can_fit):
-        X = dataset.get_design_matrix()
+    def transform(self, X):
         X = (X - self.map_from[0]) / np.diff(self.map_from)
         X = X * np.diff(self.map_to) + self.map_to[0]
-        dataset.set_design_matrix(X)
+        return X
 
 class PCA_ViewConverter(object):
     def __init__(self, to_pca, to_input, to_weights, orig_view_converter):
@@ -437,7 +683,7 @@ class Downsample(object):
 
         dataset.set_topological_view(X)
 
-class GlobalContrastNormalization(object):
+class GlobalContrastNormalization(ExamplewisePreprocessor):
     def __init__(self, subtract_mean = True, std_bias = 10.0, use_norm = False):
         """
 
@@ -465,9 +711,7 @@ class GlobalContrastNormalization(object):
         self.std_bias = std_bias
         self.use_norm = use_norm
 
-    def apply(self, dataset, can_fit = False):
-        X = dataset.get_design_matrix()
-
+    def transform(self, X):
         assert X.dtype == 'float32' or X.dtype == 'float64'
 
         if self.subtract_mean:
@@ -484,11 +728,28 @@ class GlobalContrastNormalization(object):
 
         X /= scale[:,None]
 
-        dataset.set_design_matrix(X)
+        return X
+
+
 
+def _maps_file_writably(X):
+    """
+    Returns True if the array X is, or is a view of, a memmap whose
+    writes go to its file (opened with mode 'r+' or 'w+').
+    """
+    while X is not None:
+        if isinstance(X, np.memmap) and getattr(X, 'mode', None) in \
+                ('r+', 'w+'):
+            return True
+        X = getattr(X, 'base', None)
+    return False
 
 
-class ZCA(object):
+class ZCA(ExamplewisePreprocessor):
+    # Number of examples whose covariance is accumulated, or which are
+    # whitened, at a time.
+    block_size = 10000
+
     def __init__(self, n_components=None, n_drop_components=None, filter_bias=0.1):
         warnings.warn("""This ZCA preprocessor class is known to yield very different results on different platforms. If you plan to conduct experiments with this preprocessing on multiple machines, it is probably a good idea to do the preprocessing on a single machine and copy the preprocessed datasets to the others, rather than preprocessing the data independently in each location.""")
         #TODO: test to see if differences across platforms
@@ -498,27 +759,49 @@ class ZCA(object):
         # different version numbers of scipy or something
         self.n_components = n_components
         self.n_drop_components =n_drop_components
-        self.copy = True
         self.filter_bias = filter_bias
         self.has_fit_ = False
 
-    def fit(self, X):
-        assert X.dtype in ['float32','float64']
-        assert not np.any(np.isnan(X))
+    def __getstate__(self):
+        rval = copy.copy(self.__dict__)
+        rval.pop('_whitening_cache', None)
+        return rval
 
-        assert len(X.shape) == 2
+    def __setstate__(self, d):
+        self.__dict__.update(d)
+        # ZCAs pickled before the bias was precomputed.
+        if self.has_fit_ and not hasattr(self, 'bias_'):
+            self.bias_ = np.dot(self.mean_, self.P_)
 
-        n_samples = X.shape[0]
+    def fit(self, X):
+        """
+        Fits the whitening to X, a design matrix, which may be memory
+        mapped, or an iterable of design matrices, such as the batches
+        of dataset.iterator(mode='sequential', batch_size=...).
 
-        if self.copy:
-            X = X.copy()
+        The mean and covariance are accumulated in float64, a block of
+        examples at a time (see FeatureMoments), so that X is neither
+        copied nor centered as a whole.
+        """
+        moments = FeatureMoments(covariance=True,
+                                 block_size=self.block_size)
+        if hasattr(X, 'shape'):
+            assert X.dtype in ['float32','float64']
+            assert len(X.shape) == 2
+            moments.update(X)
+        else:
+            for batch in X:
+                moments.update(batch)
+        self.finish_fit(moments)
 
-        # Center data
-        self.mean_ = np.mean(X, axis=0)
-        X -= self.mean_
+    def _fit_covariance(self, mean, covariance):
+        """Computes the whitening matrix from the mean and covariance."""
+        assert not np.any(np.isnan(mean))
+        assert not np.any(np.isnan(covariance))
+        self.mean_ = mean
 
         print 'computing zca'
-        eigs, eigv = linalg.eigh(np.dot(X.T, X)/X.shape[0])
+        eigs, eigv = linalg.eigh(covariance)
 
         assert not np.any(np.isnan(eigs))
         assert not np.any(np.isnan(eigv))
@@ -544,9 +827,39 @@ class ZCA(object):
 
         assert not np.any(np.isnan(self.P_))
 
+        # Whitening X is dot(X - mean_, P_) = dot(X, P_) - bias_, which
+        # needs no centered copy of X.
+        self.bias_ = np.dot(self.mean_, self.P_)
+        self._whitening_cache = {}
+
         self.has_fit_ = True
     #
 
+    def _whitening(self, dtype):
+        """Returns P_ and bias_ cast to `dtype`, computed once."""
+        cache = self.__dict__.setdefault('_whitening_cache', {})
+        key = np.dtype(dtype).str
+        if key not in cache:
+            cache[key] = (np.asarray(self.P_, dtype=dtype),
+                          np.asarray(self.bias_, dtype=dtype))
+        return cache[key]
+
+    def fit_accumulator(self, can_fit):
+        if self.has_fit_:
+            return None
+        assert can_fit
+        return FeatureMoments(covariance=True, block_size=self.block_size)
+
+    def finish_fit(self, accumulator):
+        self._fit_covariance(accumulator.mean, accumulator.variance())
+
+    def transform(self, X):
+        assert X.dtype in ['float32','float64']
+        P, bias = self._whitening(X.dtype)
+        rval = np.dot(X, P)
+        rval -= bias
+        return rval
+
     def apply(self, dataset, can_fit = False):
         X = dataset.get_design_matrix()
         assert X.dtype in ['float32','float64']
@@ -556,9 +869,15 @@ class ZCA(object):
             self.fit(X)
         #
 
-        new_X =  np.dot(X-self.mean_, self.P_)
-
-        #print 'mean absolute difference between new and old X'+str(np.abs(X-new_X).mean())
+        # Whiten X in place, a block at a time, unless it is read-only
+        # or writing to it would change a file on disk.
+        if X.flags.writeable and not _maps_file_writably(X):
+            new_X = X
+        else:
+            new_X = np.empty(X.shape, dtype=X.dtype)
+        for start in xrange(0, X.shape[0], self.block_size):
+            stop = min(start + self.block_size, X.shape[0])
+            new_X[start:stop] = self.transform(X[start:stop])
 
         dataset.set_design_matrix(new_X)
     #
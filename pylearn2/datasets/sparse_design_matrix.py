@@ -0,0 +1,177 @@
+"""
+A dataset for design matrices stored as scipy.sparse matrices, such as
+the sparse UTLC datasets (see pylearn2.utils.utlc.load_data), whose
+batches are CSR matrices.
+
+Models train on them through a sparse input space, e.g.
+VectorSpace(dim, sparse=True), which makes the training algorithms and
+the monitor use Theano sparse variables for the batches.
+"""
+import copy
+import functools
+
+import numpy
+from scipy import sparse
+from theano import config
+
+from pylearn2.datasets.dataset import Dataset
+from pylearn2.utils.iteration import (make_subset_iterator,
+                                      resolve_iterator_class)
+
+
+class SparseDesignMatrix(Dataset):
+    """
+    A dataset whose design matrix is a sparse matrix of shape (number
+    examples, number features), stored in CSR format.
+    """
+    _default_seed = (17, 2, 946)
+
+    # Batches are scipy.sparse CSR matrices.
+    sparse = True
+
+    def __init__(self, X, y=None, rng=_default_seed):
+        """
+        Parameters
+        ----------
+        X : scipy.sparse matrix
+            The design matrix. Converted to CSR format and to floatX if
+            needed, once.
+        y : ndarray, optional
+            Labels or targets for each example.
+        rng : object, optional
+            A random number generator used for picking random indices
+            into the design matrix when choosing minibatches.
+        """
+        if not sparse.issparse(X):
+            raise TypeError("SparseDesignMatrix needs a scipy.sparse "
+                            "matrix, got " + str(type(X)))
+        X = X.tocsr()
+        if X.dtype != config.floatX:
+            X = X.astype(config.floatX)
+        X.sort_indices()
+        self.X = X
+        self.y = y
+        if hasattr(rng, 'random_integers'):
+            self.rng = rng
+        else:
+            self.rng = numpy.random.RandomState(rng)
+        self.default_rng = copy.copy(self.rng)
+
+    @property
+    def num_examples(self):
+        return self.X.shape[0]
+
+    def get_rows(self, index):
+        """
+        Returns the examples selected by `index`, a slice or a sequence
+        of indices, as a CSR matrix. Only the selected rows are copied.
+        """
+        if isinstance(index, slice):
+            return self.X[index]
+        return self.X[numpy.asarray(index)]
+
+    @functools.wraps(Dataset.set_iteration_scheme)
+    def set_iteration_scheme(self, mode=None, batch_size=None,
+                             num_batches=None, topo=False, targets=False,
+                             shard_index=None, num_shards=None):
+        if mode is not None:
+            self._iter_subset_class = mode = resolve_iterator_class(mode)
+        elif hasattr(self, '_iter_subset_class'):
+            mode = self._iter_subset_class
+        else:
+            raise ValueError('iteration mode not provided and no default '
+                             'mode set for %s' % str(self))
+        self._iter_batch_size = batch_size
+        self._iter_num_batches = num_batches
+        self._iter_topo = topo
+        self._iter_targets = targets
+        self._iter_shard_index = shard_index
+        self._iter_num_shards = num_shards
+        # Try to create an iterator with these settings.
+        rng = self.rng if mode.stochastic else None
+        self.iterator(mode, batch_size, num_batches, topo, targets, rng=rng)
+
+    @functools.wraps(Dataset.iterator)
+    def iterator(self, mode=None, batch_size=None, num_batches=None,
+                 topo=None, targets=None, rng=None, shard_index=None,
+                 num_shards=None):
+        if mode is None:
+            if hasattr(self, '_iter_subset_class'):
+                mode = self._iter_subset_class
+            else:
+                raise ValueError('iteration mode not provided and no default '
+                                 'mode set for %s' % str(self))
+        else:
+            mode = resolve_iterator_class(mode)
+        if batch_size is None:
+            batch_size = getattr(self, '_iter_batch_size', None)
+        if num_batches is None:
+            num_batches = getattr(self, '_iter_num_batches', None)
+        if topo is None:
+            topo = getattr(self, '_iter_topo', False)
+        if targets is None:
+            targets = getattr(self, '_iter_targets', False)
+        if topo:
+            raise ValueError("sparse datasets have no topological view")
+        if shard_index is None and num_shards is None:
+            shard_index = getattr(self, '_iter_shard_index', None)
+            num_shards = getattr(self, '_iter_num_shards', None)
+        if rng is None and mode.stochastic:
+            rng = self.rng
+        subset_iterator = make_subset_iterator(mode, self.num_examples,
+                                               batch_size, num_batches, rng,
+                                               shard_index, num_shards)
+        return SparseDatasetIterator(self, subset_iterator, targets)
+
+    def get_design_matrix(self):
+        """Returns the sparse design matrix."""
+        return self.X
+
+    def get_topological_view(self, mat=None):
+        raise NotImplementedError("sparse datasets have no topological view")
+
+    def get_targets(self):
+        return self.y
+
+    def get_batch_design(self, batch_size, include_labels=False):
+        idx = self.rng.randint(self.num_examples - batch_size + 1)
+        rx = self.X[idx:idx + batch_size]
+        if include_labels:
+            return rx, self.y[idx:idx + batch_size]
+        return rx
+
+    def get_batch_topo(self, batch_size):
+        raise NotImplementedError("sparse datasets have no topological view")
+
+    def get_stream_position(self):
+        return copy.copy(self.rng)
+
+    def set_stream_position(self, pos):
+        self.rng = copy.copy(pos)
+
+    def restart_stream(self):
+        self.rng = copy.copy(self.default_rng)
+
+
+class SparseDatasetIterator(object):
+    """
+    Iterates over the CSR batches of a SparseDesignMatrix selected by
+    one of the mode iterators of pylearn2.utils.iteration.
+    """
+    def __init__(self, dataset, subset_iterator, targets=False):
+        self._dataset = dataset
+        self._subset_iterator = subset_iterator
+        self._targets = targets
+        if targets and dataset.get_targets() is None:
+            raise ValueError("Can't iterate with targets=True on a "
+                             "dataset object with no targets")
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        next_index = self._subset_iterator.next()
+        features = self._dataset.get_rows(next_index)
+        if self._targets:
+            return features, self._dataset.get_targets()[next_index]
+        return features
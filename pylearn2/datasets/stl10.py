@@ -1,98 +1,142 @@
 import numpy as np
 from pylearn2.datasets import dense_design_matrix
+from pylearn2.datasets.cache import cached_arrays
 from pylearn2.utils.serial import load
 
 class STL10(dense_design_matrix.DenseDesignMatrix):
-    def __init__(self, which_set, center = False, example_range = None):
+    def __init__(self, which_set, center = False, example_range = None,
+            quantize = False):
+        """
+        quantize: if True, keep the examples as uint8 in memory (a quarter
+            of the memory of float32) and convert them to floatX one batch
+            at a time, see DenseDesignMatrix.quantize
+        """
+
+        if quantize:
+            convert = np.ascontiguousarray
+        else:
+            convert = np.cast['float32']
 
-        if which_set == 'train':
-            train = load('${PYLEARN2_DATA_PATH}/stl10/stl10_matlab/train.mat')
+        view_converter = dense_design_matrix.DefaultViewConverter((96,96,3))
 
-            #Load the class names
-            self.class_names = [array[0].encode('utf-8') for array in train['class_names'][0] ]
+        paths = {
+                'train' : '${PYLEARN2_DATA_PATH}/stl10/stl10_matlab/train.mat',
+                'test' : '${PYLEARN2_DATA_PATH}/stl10_matlab/test.mat',
+                'unlabeled' : '${PYLEARN2_DATA_PATH}/stl10_matlab/unlabeled.mat'
+                }
+        if which_set not in paths:
+            raise ValueError('"'+which_set+'" is not an STL10 dataset. '
+                    'Recognized values are "train", "test", and "unlabeled".')
+        path = paths[which_set]
 
-            #Load the fold indices
-            fold_indices = train['fold_indices']
-            assert fold_indices.shape == (1,10)
-            self.fold_indices = np.zeros((10,1000),dtype='uint16')
-            for i in xrange(10):
-                indices = fold_indices[0,i]
-                assert indices.shape == (1000,1)
-                assert indices.dtype == 'uint16'
-                self.fold_indices[i,:] = indices[:,0]
+        def build():
+            data = {}
+            if which_set == 'train':
+                train = load(path)
 
-            #The data is stored as uint8
-            #If we leave it as uint8, it will cause the CAE to silently fail
-            #since theano will treat derivatives wrt X as 0
-            X = np.cast['float32'](train['X'])
+                #Load the class names
+                data['class_names'] = [array[0].encode('utf-8') for array in train['class_names'][0] ]
 
-            assert X.shape == (5000, 96*96*3)
+                #Load the fold indices
+                fold_indices = train['fold_indices']
+                assert fold_indices.shape == (1,10)
+                data['fold_indices'] = np.zeros((10,1000),dtype='uint16')
+                for i in xrange(10):
+                    indices = fold_indices[0,i]
+                    assert indices.shape == (1000,1)
+                    assert indices.dtype == 'uint16'
+                    data['fold_indices'][i,:] = indices[:,0]
 
-            if example_range is not None:
-                X = X[example_range[0]:example_range[1],:]
+                #The data is stored as uint8
+                #If we leave it as uint8, it will cause the CAE to silently fail
+                #since theano will treat derivatives wrt X as 0
+                X = convert(train['X'])
 
-            #this is uint8
-            y = train['y'][:,0]
-            assert y.shape == (5000,)
-        elif which_set == 'test':
-            test = load('${PYLEARN2_DATA_PATH}/stl10_matlab/test.mat')
+                assert X.shape == (5000, 96*96*3)
 
-            #Load the class names
-            self.class_names = [array[0].encode('utf-8') for array in test['class_names'][0] ]
+                if example_range is not None:
+                    X = X[example_range[0]:example_range[1],:]
 
-            #The data is stored as uint8
-            #If we leave it as uint8, it will cause the CAE to silently fail
-            #since theano will treat derivatives wrt X as 0
+                #this is uint8
+                y = train['y'][:,0]
+                assert y.shape == (5000,)
+            elif which_set == 'test':
+                test = load(path)
 
-            X = np.cast['float32'](test['X'])
-            assert X.shape == (8000, 96*96*3)
+                #Load the class names
+                data['class_names'] = [array[0].encode('utf-8') for array in test['class_names'][0] ]
 
-            if example_range is not None:
-                X = X[example_range[0]:example_range[1],:]
+                #The data is stored as uint8
+                #If we leave it as uint8, it will cause the CAE to silently fail
+                #since theano will treat derivatives wrt X as 0
 
-            #this is uint8
-            y = test['y'][:,0]
-            assert y.shape == (8000,)
+                X = convert(test['X'])
+                assert X.shape == (8000, 96*96*3)
 
-        elif which_set == 'unlabeled':
-            unlabeled = load('${PYLEARN2_DATA_PATH}/stl10_matlab/unlabeled.mat')
+                if example_range is not None:
+                    X = X[example_range[0]:example_range[1],:]
 
-            X =  unlabeled['X']
+                #this is uint8
+                y = test['y'][:,0]
+                assert y.shape == (8000,)
 
-            #this file is stored in HDF format, which transposes everything
-            assert X.shape == (96*96*3, 100000)
+            else:
+                unlabeled = load(path)
+
+                X =  unlabeled['X']
+
+                #this file is stored in HDF format, which transposes everything
+                assert X.shape == (96*96*3, 100000)
+                assert X.dtype == 'uint8'
+
+                #Slicing the HDF5 dataset only reads the requested examples
+                #(see also pylearn2.datasets.hdf5 to read them on demand)
+                if example_range is None:
+                    X = X.value
+                else:
+                    X = X[:,example_range[0]:example_range[1]]
+                X = convert(X.T)
+
+                unlabeled.close()
+
+                y = None
+            if center and not quantize:
+                X -= 127.5
+
+            for i in xrange(X.shape[0]):
+                mat = X[i:i+1,:]
+                topo = view_converter.design_mat_to_topo_view(mat)
+                for j in xrange(topo.shape[3]):
+                    temp = topo[0,:,:,j].T.copy()
+                    topo[0,:,:,j] = temp
+                mat = view_converter.topo_view_to_design_mat(topo)
+                X[i:i+1,:] = mat
+
+            assert not np.any(np.isnan(X))
+
+            data['X'] = X
+            data['y'] = y
+            return data
+
+        data = cached_arrays(STL10, {'which_set': which_set,
+                                     'center': center,
+                                     'example_range': example_range,
+                                     'quantize': quantize}, [path], build)
+        X = data['X']
+        if 'class_names' in data:
+            self.class_names = data['class_names']
+        if 'fold_indices' in data:
+            self.fold_indices = data['fold_indices']
+
+        super(STL10,self).__init__(X = X, y = data['y'], view_converter = view_converter)
+
+        if quantize:
             assert X.dtype == 'uint8'
-
-            if example_range is None:
-                X = X.value
+            if center:
+                compress_min = -127.5
             else:
-                X = X.value[:,example_range[0]:example_range[1]]
-            X = np.cast['float32'](X.T)
-
-            unlabeled.close()
-
-            y = None
-        else:
-            raise ValueError('"'+which_set+'" is not an STL10 dataset. '
-                    'Recognized values are "train", "test", and "unlabeled".')
-        if center:
-            X -= 127.5
-
-        view_converter = dense_design_matrix.DefaultViewConverter((96,96,3))
-
-        super(STL10,self).__init__(X = X, y = y, view_converter = view_converter)
-
-
-        for i in xrange(self.X.shape[0]):
-            mat = X[i:i+1,:]
-            topo = self.get_topological_view(mat)
-            for j in xrange(topo.shape[3]):
-                temp = topo[0,:,:,j].T.copy()
-                topo[0,:,:,j] = temp
-            mat = self.get_design_matrix(topo)
-            X[i:i+1,:] = mat
-
-        assert not np.any(np.isnan(self.X))
+                compress_min = 0.
+            self.set_quantized_design_matrix(X, compress_min, 255.)
     #
 
 #
@@ -0,0 +1,138 @@
+"""Tests for the on-disk cache of dataset arrays"""
+import os
+import shutil
+import tempfile
+import numpy as np
+
+from pylearn2.datasets import cache
+from pylearn2.datasets.cache import cached_arrays
+from pylearn2.datasets.dense_design_matrix import DenseDesignMatrix
+from pylearn2.datasets.npy_npz import NpyDataset
+from pylearn2.datasets.preprocessing import (GlobalContrastNormalization,
+                                             Pipeline, ZCA)
+
+
+class _ToyDataset(DenseDesignMatrix):
+    def __init__(self, path, scale):
+        def build():
+            built.append(path)
+            X = np.cast['float32'](np.load(path)) * scale
+            return {'X': X, 'y': np.arange(len(X)), 'names': ['a', 'b']}
+        built = []
+        data = cached_arrays(_ToyDataset, {'scale': scale}, [path], build)
+        self.built = len(built) > 0
+        self.names = data['names']
+        super(_ToyDataset, self).__init__(X=data['X'], y=data['y'])
+
+
+def _set_env(name, value):
+    old = os.environ.get(name)
+    if value is None:
+        os.environ.pop(name, None)
+    else:
+        os.environ[name] = value
+    return old
+
+
+def test_cached_arrays():
+    #tests that a second construction maps the arrays from the cache,
+    #that writing to them doesn't change the cache, and that changing
+    #the source or the arguments builds them again
+    tmp_dir = tempfile.mkdtemp()
+    old = os.environ.get('PYLEARN2_DATASET_CACHE')
+    os.environ['PYLEARN2_DATASET_CACHE'] = os.path.join(tmp_dir, 'cache')
+    try:
+        path = os.path.join(tmp_dir, 'source.npy')
+        rng = np.random.RandomState([1,2,3])
+        np.save(path, rng.randint(0, 256, size=(10, 4)).astype('uint8'))
+        d1 = _ToyDataset(path, 2.)
+        assert d1.built
+        hits = cache.statistics['hits']
+        d2 = _ToyDataset(path, 2.)
+        assert not d2.built
+        assert cache.statistics['hits'] == hits + 1
+        assert isinstance(d2.X, np.memmap)
+        assert np.all(d2.X == d1.X)
+        assert np.all(d2.y == d1.y)
+        assert d2.names == ['a', 'b']
+        d2.X[0] = -1.
+        assert np.all(_ToyDataset(path, 2.).X == d1.X)
+        assert _ToyDataset(path, 3.).built
+        np.save(path, np.zeros((5, 4), dtype='uint8'))
+        d3 = _ToyDataset(path, 2.)
+        assert d3.built
+        assert d3.X.shape == (5, 4)
+    finally:
+        if old is None:
+            del os.environ['PYLEARN2_DATASET_CACHE']
+        else:
+            os.environ['PYLEARN2_DATASET_CACHE'] = old
+        shutil.rmtree(tmp_dir)
+
+
+def test_cached_preprocessor():
+    #tests that applying an identical pipeline to an identical dataset
+    #restores the fitted items or maps the stored output, and that the
+    #least recently used entries are evicted
+    tmp_dir = tempfile.mkdtemp()
+    old = _set_env('PYLEARN2_DATASET_CACHE', tmp_dir)
+    old_size = _set_env('PYLEARN2_DATASET_CACHE_SIZE', None)
+    try:
+        rng = np.random.RandomState([1,2,3])
+        X = rng.randn(40, 5)
+
+        def pipeline():
+            return Pipeline([GlobalContrastNormalization(), ZCA()])
+
+        p1 = pipeline()
+        d1 = DenseDesignMatrix(X=X.copy())
+        d1.apply_preprocessor(p1, can_fit=True)
+        hits = cache.statistics['hits']
+        p2 = pipeline()
+        zca = p2.items[1]
+        d2 = DenseDesignMatrix(X=X.copy())
+        d2.apply_preprocessor(p2, can_fit=True)
+        assert cache.statistics['hits'] == hits + 1
+        assert zca.has_fit_
+        assert np.all(zca.P_ == p1.items[1].P_)
+        assert np.allclose(d2.X, d1.X)
+
+        d3 = DenseDesignMatrix(X=X.copy())
+        d3.apply_preprocessor(pipeline(), can_fit=True, cache_output=True)
+        d4 = DenseDesignMatrix(X=X.copy())
+        d4.apply_preprocessor(pipeline(), can_fit=True, cache_output=True)
+        assert isinstance(d4.X, np.memmap)
+        assert np.allclose(d4.X, d1.X)
+
+        # Another dataset misses, and only the newest entry is kept.
+        _set_env('PYLEARN2_DATASET_CACHE_SIZE', '0.000001')
+        DenseDesignMatrix(X=X[:20].copy()).apply_preprocessor(
+            pipeline(), can_fit=True)
+        assert len(os.listdir(tmp_dir)) == 1
+    finally:
+        _set_env('PYLEARN2_DATASET_CACHE', old)
+        _set_env('PYLEARN2_DATASET_CACHE_SIZE', old_size)
+        shutil.rmtree(tmp_dir)
+
+
+def test_cached_preprocessor_unloaded():
+    #tests that a dataset loading its design matrix on first use, such
+    #as an NpyDataset, is loaded before being fingerprinted
+    tmp_dir = tempfile.mkdtemp()
+    old = _set_env('PYLEARN2_DATASET_CACHE', os.path.join(tmp_dir, 'cache'))
+    try:
+        path = os.path.join(tmp_dir, 'X.npy')
+        X = np.random.RandomState([1,2,3]).randn(20, 4)
+        np.save(path, X)
+        hits = cache.statistics['hits']
+        for i in xrange(2):
+            d = NpyDataset(path)
+            d.apply_preprocessor(GlobalContrastNormalization(),
+                                 cache_output=True)
+        assert cache.statistics['hits'] == hits + 1
+        expected = DenseDesignMatrix(X=X.copy())
+        GlobalContrastNormalization().apply(expected)
+        assert np.allclose(d.get_design_matrix(), expected.X)
+    finally:
+        _set_env('PYLEARN2_DATASET_CACHE', old)
+        shutil.rmtree(tmp_dir)
@@ -1,8 +1,14 @@
+import cPickle
+import os
+import shutil
+import tempfile
 import numpy as np
 
+from pylearn2.datasets import control
 from pylearn2.datasets.dense_design_matrix import DenseDesignMatrix
 from pylearn2.datasets.dense_design_matrix import DefaultViewConverter
 from pylearn2.utils import serial
+from theano import config
 
 
 def test_init_with_X_or_topo():
@@ -26,6 +32,130 @@ def test_init_with_X_or_topo():
 def test_init_with_vc():
     d = DenseDesignMatrix(view_converter = DefaultViewConverter([1,2,3]))
 
+def test_view_converter_views():
+    #tests that both storage layouts convert design matrices to
+    #topological views and back without copying
+    rng = np.random.RandomState([1,2,3])
+    X = rng.randn(5, 24)
+    for channel_last in [False, True]:
+        converter = DefaultViewConverter((2,3,4), channel_last)
+        topo = converter.design_mat_to_topo_view(X)
+        assert topo.shape == (5,2,3,4)
+        assert np.may_share_memory(topo, X)
+        for c in xrange(4):
+            if channel_last:
+                channel = X[:, c::4]
+            else:
+                channel = X[:, 6*c:6*(c+1)]
+            assert np.all(topo[..., c] == channel.reshape(5,2,3))
+        X2 = converter.topo_view_to_design_mat(topo)
+        assert np.may_share_memory(X2, X)
+        assert np.all(X2 == X)
+    topo = rng.randn(5,2,3,4)
+    d = DenseDesignMatrix(topo_view=topo, channel_last=True)
+    assert np.may_share_memory(d.X, topo)
+    for batch in d.iterator(mode='sequential', batch_size=2, topo=True):
+        assert batch.shape[1:] == (2,3,4)
+
+
+def test_design_loc_mmap():
+    #tests that a dataset pickled with use_design_loc can memory map its
+    #design matrix, and that iterating over it gives the same batches
+    rng = np.random.RandomState([1,2,3])
+    topo_view = rng.randn(10,2,2,3).astype('float32')
+    d1 = DenseDesignMatrix(topo_view = topo_view)
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        d1.use_design_loc(os.path.join(tmp_dir, 'X.npy'))
+        s = cPickle.dumps(d1)
+        control.push_mmap_mode('r')
+        try:
+            d2 = cPickle.loads(s)
+        finally:
+            control.pop_mmap_mode()
+        assert isinstance(d2.X, np.memmap)
+        for topo in [False, True]:
+            b1 = list(d1.iterator(mode='sequential', batch_size=3,
+                                  topo=topo))
+            b2 = list(d2.iterator(mode='sequential', batch_size=3,
+                                  topo=topo))
+            assert len(b1) == len(b2)
+            for x1, x2 in zip(b1, b2):
+                assert type(x2) is np.ndarray
+                assert np.all(x1 == x2)
+        # Pickling again doesn't rewrite the mapped file.
+        cPickle.loads(cPickle.dumps(d2))
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+def test_iterator_buffers():
+    #tests that gathering random batches into the iterator's buffers
+    #gives the examples asked for, cast to floatX, and that a ring of
+    #buffers is reused
+    rng = np.random.RandomState([1,2,3])
+    X = rng.randint(0, 256, size=(20, 6)).astype('uint8')
+    y = np.arange(20)
+    d = DenseDesignMatrix(X=X, y=y)
+    for buffers in [0, 2]:
+        batches = []
+        for batch, targets in d.iterator(mode='random_uniform', batch_size=5,
+                                         num_batches=4, targets=True,
+                                         rng=[4,5,6], buffers=buffers):
+            assert batch.dtype == config.floatX
+            assert np.all(batch == X[targets])
+            batches.append(batch)
+        shared = np.may_share_memory(batches[0], batches[2])
+        assert shared == bool(buffers)
+    batches = list(d.iterator(mode='sequential', batch_size=7, buffers=1))
+    assert batches[-1].shape == (6, 6)
+    assert np.all(batches[-1] == X[14:])
+
+
+def test_iterator_shards():
+    #tests that the shard set by set_iteration_scheme is only used when
+    #the iterator is given neither shard_index nor num_shards
+    X = np.arange(40).reshape(20, 2).astype(config.floatX)
+    d = DenseDesignMatrix(X=X)
+    d.set_iteration_scheme('sequential', batch_size=5, shard_index=0,
+                           num_shards=2)
+    batches = list(d.iterator())
+    assert np.all(np.concatenate(batches) == X[:10])
+    batches = list(d.iterator(shard_index=1, num_shards=2))
+    assert np.all(np.concatenate(batches) == X[10:])
+    for kwargs in [{'shard_index': 1}, {'num_shards': 4}]:
+        try:
+            d.iterator(**kwargs)
+        except ValueError:
+            pass
+        else:
+            assert False, "expected a ValueError for %s" % str(kwargs)
+
+
+def test_quantize():
+    #tests that quantized datasets keep X compact, and dequantize
+    #batches to floatX close to the original data
+    rng = np.random.RandomState([1,2,3])
+    X = rng.uniform(-1., 3., size=(30, 8)).astype(config.floatX)
+    for dtype, tol in [('uint8', 4. / 255), ('float16', 1e-2)]:
+        d = DenseDesignMatrix(X=X.copy())
+        d.quantize(dtype, block_size=7)
+        assert d.X.dtype == dtype
+        d = cPickle.loads(cPickle.dumps(d))
+        assert d.X.dtype == dtype
+        full = d.get_design_matrix()
+        assert full.dtype == config.floatX
+        assert np.abs(full - X).max() <= tol
+        for mode, num_batches in [('sequential', None),
+                                  ('random_uniform', 3)]:
+            for batch in d.iterator(mode=mode, batch_size=4,
+                                    num_batches=num_batches, buffers=1):
+                assert batch.dtype == config.floatX
+        batch = d.get_batch_design(5)
+        assert batch.dtype == config.floatX
+        assert np.abs(batch).max() <= 3. + tol
+
+
 def test_split_datasets():
     #Load and create ddm from cifar100
     path = "/data/lisa/data/cifar100/cifar-100-python/train"
@@ -73,3 +203,17 @@ def test_split_nfold_datasets():
 
 #test_split_datasets()
 #test_split_nfold_datasets()
+
+
+def test_iterator_num_batches_and_holdout():
+    #tests iterating with only num_batches, and holding out a
+    #proportion of the examples, whose slice bounds are computed with
+    #ceil
+    X = np.arange(40).reshape(20, 2).astype(config.floatX)
+    d = DenseDesignMatrix(X=X)
+    batches = list(d.iterator(mode='sequential', num_batches=3))
+    assert [len(batch) for batch in batches] == [7, 7, 6]
+    assert np.all(np.concatenate(batches) == X)
+    train, valid = d.split_dataset_holdout(split_prop=.25)
+    assert len(train) == 15
+    assert len(valid) == 5
@@ -0,0 +1,54 @@
+import os
+import shutil
+import tempfile
+import numpy as np
+from nose.plugins.skip import SkipTest
+
+from pylearn2.datasets.hdf5 import HDF5Dataset
+
+
+def _make_file(tmp_dir, X, y, chunks):
+    try:
+        import h5py
+    except ImportError:
+        raise SkipTest("h5py is not available")
+    path = os.path.join(tmp_dir, 'data.h5')
+    f = h5py.File(path, 'w')
+    f.create_dataset('X', data=X, chunks=chunks)
+    f.create_dataset('y', data=y)
+    f.close()
+    return path
+
+
+def test_hdf5_iteration():
+    #tests that every mode of iteration gives the rows of the array,
+    #across chunks, with a cache smaller than the dataset
+    rng = np.random.RandomState([1,2,3])
+    X = rng.randint(0, 256, size=(50, 12)).astype('uint8')
+    y = np.arange(50)
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        path = _make_file(tmp_dir, X, y, chunks=(4, 12))
+        d = HDF5Dataset(path, 'X', y_key='y', view_shape=(2, 2, 3),
+                        example_range=(5, 45), chunk_size=6,
+                        cache_bytes=2 * 8 * 12 * 4)
+        assert d.chunk_size == 8
+        assert d.num_examples == 40
+        expected = X[5:45].astype(d.get_design_matrix().dtype)
+        assert np.all(d.get_design_matrix() == expected)
+
+        batches = list(d.iterator(mode='sequential', batch_size=7))
+        assert np.all(np.concatenate(batches) == expected)
+
+        for mode in ['random_slice', 'random_uniform']:
+            for batch, targets in d.iterator(mode=mode, batch_size=9,
+                                             num_batches=5, targets=True,
+                                             rng=[4,5,6]):
+                assert np.all(batch == expected[targets - 5])
+        assert 0 < d._cache.num_bytes <= d._cache.max_bytes
+
+        for batch in d.iterator(mode='sequential', batch_size=10, topo=True):
+            assert batch.shape == (10, 2, 2, 3)
+        d.close()
+    finally:
+        shutil.rmtree(tmp_dir)
@@ -1,7 +1,15 @@
 from pylearn2.datasets.dense_design_matrix import DenseDesignMatrix
 from pylearn2.datasets.preprocessing import GlobalContrastNormalization
 from pylearn2.datasets.preprocessing import ExtractGridPatches, ReassembleGridPatches
+from pylearn2.datasets.preprocessing import (FeatureMoments, Pipeline,
+                                             RemapInterval, Standardize, ZCA)
+from pylearn2.datasets.npy_npz import NpyDataset
 from pylearn2.utils import as_floatX
+import cPickle
+import itertools
+import os
+import shutil
+import tempfile
 import numpy as np
 
 class testGlobalContrastNormalization:
@@ -85,3 +93,156 @@ def test_extract_reassemble():
 
     if not np.all(new_topo == topo):
         assert False
+
+
+def test_extract_grid_patches_order():
+    """ Tests that ExtractGridPatches gives the patches of each image in
+    the order of their grid coordinates, for three topological
+    dimensions and a stride different from the patch shape, and that
+    extracting in chunks to a file gives the same patches """
+
+    rng = np.random.RandomState([1,3,7])
+    topo = rng.randn(3,7,6,5,2)
+    patch_shape = (3,2,5)
+    patch_stride = (2,3,0)
+
+    grid = []
+    for j in xrange(3):
+        if patch_stride[j] == 0:
+            grid.append([0])
+        else:
+            grid.append(range(0, topo.shape[j+1] - patch_shape[j] + 1,
+                              patch_stride[j]))
+    expected = []
+    for i in xrange(topo.shape[0]):
+        for coords in itertools.product(*grid):
+            expected.append(topo[i, coords[0]:coords[0]+patch_shape[0],
+                                 coords[1]:coords[1]+patch_shape[1],
+                                 coords[2]:coords[2]+patch_shape[2]])
+    expected = np.asarray(expected)
+    assert expected.shape == (3*3*2*1,) + patch_shape + (2,)
+
+    dataset = DenseDesignMatrix(topo_view = topo)
+    dataset.apply_preprocessor(ExtractGridPatches(patch_shape, patch_stride))
+    assert np.all(dataset.get_topological_view() == expected)
+
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        dataset = DenseDesignMatrix(topo_view = topo)
+        extractor = ExtractGridPatches(patch_shape, patch_stride,
+                batch_size = 2,
+                output_path = os.path.join(tmp_dir, 'patches.npy'))
+        dataset.apply_preprocessor(extractor)
+        assert isinstance(dataset.X, np.memmap)
+        assert np.all(dataset.get_topological_view() == expected)
+
+        reassemblor = ReassembleGridPatches(orig_shape = (6,4,5),
+                patch_shape = (3,2,5), batch_size = 2,
+                output_path = os.path.join(tmp_dir, 'images.npy'))
+        dataset = DenseDesignMatrix(topo_view = topo[:, :6, :4])
+        dataset.apply_preprocessor(ExtractGridPatches((3,2,5), (3,2,5),
+                                                      batch_size = 2))
+        dataset.apply_preprocessor(reassemblor)
+        assert np.all(dataset.get_topological_view() == topo[:, :6, :4])
+        del dataset
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+def test_feature_moments():
+    """ Tests that moments accumulated over chunks match those of the
+    whole matrix, even with a mean much larger than the deviations """
+
+    rng = np.random.RandomState([1,3,7])
+    X = rng.randn(100, 4) + 1e6
+    moments = FeatureMoments(block_size = 7)
+    covariance = FeatureMoments(covariance = True)
+    for start in xrange(0, 100, 30):
+        moments.update(X[start:start+30])
+        covariance.update(X[start:start+30])
+    assert moments.n == 100
+    assert np.allclose(moments.mean, X.mean(axis=0))
+    assert np.allclose(moments.variance(), X.var(axis=0))
+    assert np.allclose(moments.global_variance(), X.var())
+    assert np.allclose(covariance.variance(), np.cov(X.T, bias = 1))
+
+
+def test_chunked_pipeline():
+    """ Tests that applying a pipeline a chunk at a time, to a memory
+    mapped output, gives the same design matrix as applying its items
+    to the whole dataset """
+
+    rng = np.random.RandomState([1,3,7])
+    X = rng.randn(50, 6) * 3. + 1.
+
+    def items():
+        return [RemapInterval([-10., 10.], [0., 1.]),
+                Standardize(global_std = True),
+                GlobalContrastNormalization(),
+                ZCA()]
+
+    expected = DenseDesignMatrix(X = X.copy())
+    for item in items():
+        expected.apply_preprocessor(item, can_fit = True)
+
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        pipeline = Pipeline(items(), chunk_size = 8,
+                            output_path = os.path.join(tmp_dir, 'X.npy'))
+        dataset = DenseDesignMatrix(X = X.copy())
+        dataset.apply_preprocessor(pipeline, can_fit = True)
+        assert isinstance(dataset.X, np.memmap)
+        assert np.allclose(dataset.X, expected.X)
+        del dataset
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+def test_zca_streaming():
+    """ Tests that ZCA fitted in blocks or on batches whitens the data,
+    in place, and that the precomputed bias gives the same result as
+    centering the data """
+
+    rng = np.random.RandomState([1,3,7])
+    X = np.dot(rng.randn(300, 5), rng.randn(5, 5)) + 10.
+
+    zca = ZCA(filter_bias = 0.)
+    zca.block_size = 64
+    dataset = DenseDesignMatrix(X = X.copy())
+    original = dataset.X
+    dataset.apply_preprocessor(zca, can_fit = True)
+    assert dataset.X is original
+    assert np.allclose(dataset.X, np.dot(X - zca.mean_, zca.P_))
+    assert np.allclose(np.cov(dataset.X.T, bias = 1), np.eye(5))
+
+    batches = ZCA(filter_bias = 0.)
+    batches.fit(X[start:start+50] for start in xrange(0, 300, 50))
+    assert np.allclose(batches.P_, zca.P_)
+    assert np.allclose(batches.transform(X.copy()), dataset.X)
+
+    zca = cPickle.loads(cPickle.dumps(zca))
+    assert np.allclose(zca.transform(X.copy()), dataset.X)
+
+
+def test_zca_keeps_source_file():
+    """ Tests that ZCA doesn't whiten a design matrix memory mapped
+    read-write in place, which would overwrite its .npy file """
+
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        rng = np.random.RandomState([1,3,7])
+        X = np.dot(rng.randn(100, 5), rng.randn(5, 5)) + 10.
+        path = os.path.join(tmp_dir, 'X.npy')
+        np.save(path, X)
+        dataset = NpyDataset(path, mmap_mode = 'r+')
+        original = dataset.get_design_matrix()
+        assert isinstance(original, np.memmap)
+        zca = ZCA(filter_bias = 0.)
+        dataset.apply_preprocessor(zca, can_fit = True)
+        assert dataset.X is not original
+        assert np.allclose(dataset.X, np.dot(X - zca.mean_, zca.P_))
+        assert np.all(original == X)
+        del original, dataset
+        assert np.all(np.load(path) == X)
+    finally:
+        shutil.rmtree(tmp_dir)
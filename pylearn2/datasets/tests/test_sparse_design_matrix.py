@@ -0,0 +1,24 @@
+import numpy as np
+from scipy import sparse
+from theano import config
+
+from pylearn2.datasets.sparse_design_matrix import SparseDesignMatrix
+
+
+def test_sparse_iteration():
+    #tests that the iterators yield CSR batches holding the rows asked
+    #for, in floatX
+    rng = np.random.RandomState([1,2,3])
+    dense = rng.randn(20, 50) * (rng.uniform(size=(20, 50)) < .1)
+    d = SparseDesignMatrix(sparse.coo_matrix(dense), y=np.arange(20))
+    batches = list(d.iterator(mode='sequential', batch_size=6))
+    assert len(batches) == 4
+    for batch in batches:
+        assert sparse.isspmatrix_csr(batch)
+        assert batch.dtype == config.floatX
+    stacked = sparse.vstack(batches).toarray()
+    assert np.allclose(stacked, dense)
+    for batch, targets in d.iterator(mode='random_uniform', batch_size=5,
+                                     num_batches=3, targets=True):
+        assert np.allclose(batch.toarray(), dense[targets])
+    assert d.get_batch_design(4).shape == (4, 50)
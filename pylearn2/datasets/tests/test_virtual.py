@@ -0,0 +1,102 @@
+import cPickle
+import numpy as np
+from theano import config
+
+from pylearn2.datasets.dense_design_matrix import DenseDesignMatrix
+from pylearn2.datasets.preprocessing import GlobalContrastNormalization
+from pylearn2.datasets.virtual import ConcatenatedDataset, SubsetDataset
+from pylearn2.datasets.virtual import RandomPatchDataset
+
+
+def test_concatenated_and_subset():
+    #tests that batches gathered across the sources match the
+    #concatenated arrays, in every iteration mode
+    rng = np.random.RandomState([1,2,3])
+    topo = [rng.randn(n, 2, 2, 3) for n in [7, 1, 12]]
+    sources = [DenseDesignMatrix(topo_view=t, y=np.arange(len(t)))
+               for t in topo]
+    sources[2].quantize('float16')
+    d = ConcatenatedDataset(sources)
+    X = np.concatenate([s.get_design_matrix() for s in sources])
+    y = np.concatenate([s.y for s in sources])
+    assert d.num_examples == 20
+    assert np.allclose(d.get_design_matrix(), X)
+
+    sub = SubsetDataset(d, 3, 15)
+    picked = SubsetDataset(d, indices=[19, 0, 7, 8, 7])
+    for dataset, expected, expected_y in [(d, X, y),
+                                          (sub, X[3:15], y[3:15]),
+                                          (picked, X[[19, 0, 7, 8, 7]],
+                                           y[[19, 0, 7, 8, 7]])]:
+        batches = list(dataset.iterator(mode='sequential', batch_size=3))
+        assert np.allclose(np.concatenate(batches), expected)
+        for batch, targets in dataset.iterator(mode='random_uniform',
+                                               batch_size=4, num_batches=5,
+                                               targets=True, rng=[4,5,6]):
+            assert batch.dtype == config.floatX
+            assert np.all(np.in1d(targets, expected_y))
+        for batch in dataset.iterator(mode='sequential', batch_size=4,
+                                      topo=True):
+            assert batch.shape[1:] == (2, 2, 3)
+        assert dataset.get_batch_design(2).shape == (2, 12)
+
+    # Preprocessors can set the design matrix of a virtual dataset.
+    sub.set_design_matrix(sub.get_design_matrix() * 2.)
+    assert np.allclose(np.concatenate(list(sub.iterator(mode='sequential',
+                                                        batch_size=5))),
+                       X[3:15] * 2.)
+
+
+def test_random_patches():
+    #tests that the patches are windows of the images, the same whatever
+    #the order they are requested in, and preprocessed per batch
+    rng = np.random.RandomState([1,2,3])
+    images = rng.randn(6, 8, 7, 2)
+    source = DenseDesignMatrix(topo_view=images)
+    d = RandomPatchDataset(source, (3, 4), num_patches=30)
+    topo = d.get_topological_view(d.get_rows(slice(None)))
+    assert topo.shape == (30, 3, 4, 2)
+    for i in xrange(30):
+        assert np.any([np.allclose(topo[i], images[n, r:r+3, c:c+4])
+                       for n in xrange(6) for r in xrange(6)
+                       for c in xrange(4)])
+    X = d.get_rows(slice(None))
+    batches = list(d.iterator(mode='sequential', batch_size=7))
+    assert np.allclose(np.concatenate(batches), X)
+    for batch in d.iterator(mode='shuffled_sequential', batch_size=7,
+                            rng=[4,5,6]):
+        assert np.any([np.allclose(batch[0], row) for row in X])
+    assert np.allclose(d.get_rows([29, 3, 3]), X[[29, 3, 3]])
+    assert np.allclose(cPickle.loads(cPickle.dumps(d)).get_rows([29, 3]),
+                       X[[29, 3]])
+
+    gcn = RandomPatchDataset(source, (3, 4), num_patches=30,
+                             preprocessor=GlobalContrastNormalization(),
+                             seed=d.seed)
+    expected = DenseDesignMatrix(X=X.copy())
+    expected.apply_preprocessor(GlobalContrastNormalization())
+    assert np.allclose(gcn.get_rows(slice(5, 12)),
+                       expected.get_design_matrix()[5:12])
+
+
+def test_random_patch_locations():
+    #tests that the locations of random-order batches are computed for
+    #the patches requested only, and cover the possible locations
+    rng = np.random.RandomState([1,2,3])
+    source = DenseDesignMatrix(topo_view=rng.randn(4, 5, 6, 1))
+    d = RandomPatchDataset(source, (2, 3), num_patches=10 ** 6)
+    computed = []
+    locations = d._locations
+    def counting_locations(index):
+        computed.append(len(index))
+        return locations(index)
+    d._locations = counting_locations
+    batches = d.iterator(mode='random_uniform', batch_size=7, num_batches=5,
+                         rng=[4,5,6])
+    assert sum(len(batch) for batch in batches) == 35
+    assert computed == [7] * 5
+    index = np.arange(0, 10 ** 6, 10 ** 6 // 1000)
+    all_locations = locations(index)
+    assert np.all(locations(index[::-1]) == all_locations[::-1])
+    for j, width in enumerate([4, 4, 4]):
+        assert np.all(np.unique(all_locations[:, j]) == np.arange(width))
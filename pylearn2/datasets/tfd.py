@@ -1,5 +1,6 @@
 import numpy as np
 from pylearn2.datasets import dense_design_matrix
+from pylearn2.datasets.cache import cached_arrays
 from pylearn2.utils.serial import load
 
 class TFD(dense_design_matrix.DenseDesignMatrix):
@@ -28,47 +29,64 @@ class TFD(dense_design_matrix.DenseDesignMatrix):
         # load data
         path = '${PYLEARN2_DATA_PATH}/faces/TFD/'
         if image_size == 48:
-            data = load(path + 'TFD_48x48.mat')
+            path += 'TFD_48x48.mat'
         elif image_size == 96:
-            data = load(path + 'TFD_96x96.mat')
+            path += 'TFD_96x96.mat'
         else:
             raise ValueError("image_size should be either 48 or 96.")
 
-        # retrieve indices corresponding to `which_set` and fold number
-        set_indices = data['folds'][:, fold] == self.mapper[which_set]
+        def build():
+            data = load(path)
 
-        # limit examples returned to `example_range`
-        ex_range = slice(example_range[0], example_range[1]) \
-                         if example_range else slice(None)
+            # retrieve indices corresponding to `which_set` and fold number
+            set_indices = data['folds'][:, fold] == self.mapper[which_set]
 
-        # get images and cast to float32
-        data_x = data['images'][set_indices]
-        data_x = np.cast['float32'](data_x)
-        data_x = data_x[ex_range]
-        # create dense design matrix from topological view
-        data_x = data_x.reshape(data_x.shape[0], image_size ** 2)
-        if center:
-            data_x -= 127.5
+            # limit examples returned to `example_range`
+            ex_range = slice(example_range[0], example_range[1]) \
+                             if example_range else slice(None)
+
+            # get images and cast to float32
+            data_x = data['images'][set_indices]
+            data_x = np.cast['float32'](data_x)
+            data_x = data_x[ex_range]
+            # create dense design matrix from topological view
+            data_x = data_x.reshape(data_x.shape[0], image_size ** 2)
+            if center:
+                data_x -= 127.5
 
-        if shuffle:
-            rng = rng if rng else np.random.RandomState(seed)
-            rand_idx = rng.permutation(len(data_x))
-            data_x = data_x[rand_idx]
- 
-        # get labels
-        if which_set != 'unlabeled':
-            data_y = data['labs_ex'][set_indices]
-            data_y = data_y[ex_range]
             if shuffle:
-                data_y = data_y[rand_idx]
+                shuffle_rng = rng if rng else np.random.RandomState(seed)
+                rand_idx = shuffle_rng.permutation(len(data_x))
+                data_x = data_x[rand_idx]
+
+            # get labels
+            if which_set != 'unlabeled':
+                data_y = data['labs_ex'][set_indices]
+                data_y = data_y[ex_range]
+                if shuffle:
+                    data_y = data_y[rand_idx]
+            else:
+                data_y = None
+
+            assert not np.any(np.isnan(data_x))
+            return {'X': data_x, 'y': data_y}
+
+        if shuffle and rng is not None:
+            # The order depends on the state of rng, which can't be part
+            # of the cache key.
+            data = build()
         else:
-            data_y = None
+            data = cached_arrays(TFD, {'which_set': which_set,
+                                       'fold': fold,
+                                       'image_size': image_size,
+                                       'example_range': example_range,
+                                       'center': center,
+                                       'shuffle': shuffle,
+                                       'seed': seed}, [path], build)
 
         # create view converting for retrieving topological view
         view_converter = dense_design_matrix.DefaultViewConverter((image_size, image_size, 1))
 
         # init the super class
-        super(TFD, self).__init__(X = data_x, y = data_y, view_converter = view_converter)
-
-        assert not np.any(np.isnan(self.X))
+        super(TFD, self).__init__(X = data['X'], y = data['y'], view_converter = view_converter)
 
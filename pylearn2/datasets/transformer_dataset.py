@@ -31,14 +31,19 @@ class TransformerDataset(Dataset):
         return X.reshape(X.shape[0],X.shape[1],1,1)
 
     def set_iteration_scheme(self, mode=None, batch_size=None,
-                             num_batches=None, topo=False):
-        self.raw.set_iteration_scheme(mode, batch_size, num_batches, topo)
+                             num_batches=None, topo=False, shard_index=None,
+                             num_shards=None):
+        self.raw.set_iteration_scheme(mode, batch_size, num_batches, topo,
+                                      shard_index=shard_index,
+                                      num_shards=num_shards)
 
 
     def iterator(self, mode=None, batch_size=None, num_batches=None,
-                 topo=None, rng=None):
+                 topo=None, rng=None, shard_index=None, num_shards=None):
 
-        raw_iterator = self.raw.iterator(mode, batch_size, num_batches, topo, rng)
+        raw_iterator = self.raw.iterator(mode, batch_size, num_batches, topo,
+                                         rng=rng, shard_index=shard_index,
+                                         num_shards=num_shards)
         final_iterator = TransformerIterator(raw_iterator, self)
         return final_iterator
 
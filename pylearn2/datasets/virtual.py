@@ -0,0 +1,424 @@
+"""
+Datasets presenting other DenseDesignMatrix datasets, or parts of one,
+as a single dataset without copying their design matrices.
+
+Batches are gathered from the sources when they are requested, so that
+e.g. concatenating two large datasets doesn't briefly need the memory of
+both of them a second time. Methods that need the whole design matrix
+at once, such as get_design_matrix, return a copy of it. Setting the
+design matrix or topological view, e.g. by a preprocessor, stores it in
+the dataset like any DenseDesignMatrix, after which the sources aren't
+used anymore.
+
+RandomPatchDataset similarly presents patches drawn at random from the
+images of a dataset, cutting them out of the images, and preprocessing
+them, a batch at a time.
+"""
+import numpy as N
+from numpy.lib.stride_tricks import as_strided
+from theano import config
+
+from pylearn2.datasets.dense_design_matrix import DenseDesignMatrix
+
+
+def _num_features(dataset):
+    if dataset.X is not None:
+        return dataset.X.shape[1]
+    return dataset.num_features
+
+
+def _source_rows(dataset, index):
+    """
+    Returns the examples of `dataset` selected by `index`, a slice or
+    an array of indices, as a floatX design matrix.
+    """
+    if dataset.X is None:
+        # Itself a virtual dataset.
+        return dataset.get_rows(index)
+    rows = dataset.X[index]
+    if getattr(dataset, 'quantized', None) is not None:
+        return dataset.dequantize(rows)
+    return N.cast[config.floatX](rows)
+
+
+def _hash_indices(index, key):
+    """
+    Returns a pseudo-random uint64 for each integer of the array
+    `index`, determined by it and the integer `key` (the splitmix64
+    finalizer applied to their combination).
+    """
+    x = N.asarray(index).astype('uint64') * N.uint64(0x9e3779b97f4a7c15)
+    x += N.uint64(key)
+    x ^= x >> N.uint64(30)
+    x *= N.uint64(0xbf58476d1ce4e5b9)
+    x ^= x >> N.uint64(27)
+    x *= N.uint64(0x94d049bb133111eb)
+    x ^= x >> N.uint64(31)
+    return x
+
+
+def _slice_indices(index, size):
+    """
+    Returns (start, stop) if `index` is a slice with a step of 1,
+    otherwise an array of the indices it selects, which are checked.
+    """
+    if isinstance(index, slice):
+        start, stop, step = index.indices(size)
+        if step == 1:
+            return max(start, 0), max(stop, start)
+        return N.arange(start, stop, step)
+    index = N.asarray(index)
+    if index.ndim != 1:
+        raise ValueError("expected a slice or a vector of indices, got an "
+                         "array of shape %s" % str(index.shape))
+    if len(index) > 0 and (index.min() < -size or index.max() >= size):
+        raise IndexError("example index out of range for a dataset of %d "
+                         "examples" % size)
+    if len(index) > 0 and index.min() < 0:
+        index = index % size
+    return index
+
+
+class VirtualDesignMatrix(DenseDesignMatrix):
+    """
+    Base class of the datasets reading their examples from other
+    datasets. Subclasses implement `get_rows` and set `num_features`.
+    While `X` is None, the examples come from the sources.
+    """
+    def __init__(self, view_converter, y, num_features):
+        super(VirtualDesignMatrix, self).__init__(X=None, y=y)
+        self.view_converter = view_converter
+        self.num_features = num_features
+
+    def get_rows(self, index):
+        """
+        Returns the examples selected by `index`, a slice or a sequence
+        of indices, as a new floatX design matrix.
+        """
+        raise NotImplementedError()
+
+    def _get_num_examples(self):
+        raise NotImplementedError()
+
+    @property
+    def num_examples(self):
+        if self.X is not None:
+            return self.X.shape[0]
+        return self._get_num_examples()
+
+    def _make_iterator(self, subset_iterator, topo, targets, buffers):
+        if self.X is not None:
+            return super(VirtualDesignMatrix, self)._make_iterator(
+                subset_iterator, topo, targets, buffers)
+        return VirtualDatasetIterator(self, subset_iterator, topo, targets)
+
+    def get_design_matrix(self, topo=None):
+        """
+        Returns topo in design matrix format or, if topo is None, the
+        whole design matrix, which is a copy while the examples come
+        from the sources.
+        """
+        if topo is None and self.X is None:
+            return self.get_rows(slice(None))
+        return super(VirtualDesignMatrix, self).get_design_matrix(topo)
+
+    def get_batch_design(self, batch_size, include_labels=False):
+        if self.X is not None:
+            return super(VirtualDesignMatrix, self).get_batch_design(
+                batch_size, include_labels)
+        idx = self.rng.randint(self.num_examples - batch_size + 1)
+        rx = self.get_rows(slice(idx, idx + batch_size))
+        if include_labels:
+            return rx, self.y[idx:idx + batch_size]
+        return rx
+
+
+class ConcatenatedDataset(VirtualDesignMatrix):
+    """
+    The examples of several datasets, one after the other.
+    """
+    def __init__(self, datasets):
+        """
+        Parameters
+        ----------
+        datasets : list
+            DenseDesignMatrix datasets with the same number of features,
+            and the same view converter if they have one. The targets
+            are concatenated if all of them have targets.
+        """
+        if len(datasets) == 0:
+            raise ValueError("ConcatenatedDataset needs at least one dataset")
+        num_features = _num_features(datasets[0])
+        for dataset in datasets[1:]:
+            if _num_features(dataset) != num_features:
+                raise ValueError("can't concatenate datasets with %d and %d "
+                                 "features" % (num_features,
+                                               _num_features(dataset)))
+        view_converter = getattr(datasets[0], 'view_converter', None)
+        if view_converter is not None:
+            for dataset in datasets[1:]:
+                other = getattr(dataset, 'view_converter', None)
+                if other is None or (tuple(other.view_shape()) !=
+                                     tuple(view_converter.view_shape())):
+                    raise ValueError("can't concatenate datasets with "
+                                     "different topological views")
+        targets = [dataset.get_targets() for dataset in datasets]
+        if any(y is None for y in targets):
+            y = None
+        else:
+            y = N.concatenate(targets, axis=0)
+        super(ConcatenatedDataset, self).__init__(view_converter, y,
+                                                  num_features)
+        self.datasets = list(datasets)
+        sizes = [dataset.num_examples for dataset in self.datasets]
+        # offsets[i] is the index of the first example of datasets[i].
+        self.offsets = N.concatenate([[0], N.cumsum(sizes)]).astype('int64')
+
+    def _get_num_examples(self):
+        return int(self.offsets[-1])
+
+    def get_rows(self, index):
+        index = _slice_indices(index, self.num_examples)
+        if isinstance(index, tuple):
+            start, stop = index
+            out = N.empty((stop - start, self.num_features),
+                          dtype=config.floatX)
+            for i, dataset in enumerate(self.datasets):
+                lo = max(start, self.offsets[i])
+                hi = min(stop, self.offsets[i + 1])
+                if lo < hi:
+                    out[lo - start:hi - start] = _source_rows(
+                        dataset, slice(lo - self.offsets[i],
+                                       hi - self.offsets[i]))
+            return out
+        out = N.empty((len(index), self.num_features), dtype=config.floatX)
+        which = N.searchsorted(self.offsets[1:], index, side='right')
+        for i, dataset in enumerate(self.datasets):
+            positions = N.flatnonzero(which == i)
+            if len(positions) > 0:
+                out[positions] = _source_rows(
+                    dataset, index[positions] - self.offsets[i])
+        return out
+
+
+class SubsetDataset(VirtualDesignMatrix):
+    """
+    A range, or an arbitrary selection, of the examples of a dataset.
+    """
+    def __init__(self, dataset, start=None, stop=None, indices=None):
+        """
+        Parameters
+        ----------
+        dataset : DenseDesignMatrix
+            The source dataset.
+        start, stop : int, optional
+            The range of examples of `dataset` to use. Defaults to all
+            of them.
+        indices : array_like, optional
+            The indices of the examples of `dataset` to use, in order,
+            instead of a range.
+        """
+        size = dataset.num_examples
+        if indices is not None:
+            if start is not None or stop is not None:
+                raise ValueError("give either start and stop or indices")
+            indices = _slice_indices(indices, size)
+        else:
+            start, stop = _slice_indices(slice(start, stop), size)
+        y = dataset.get_targets()
+        if y is not None:
+            if indices is not None:
+                y = y[indices]
+            else:
+                y = y[start:stop]
+        super(SubsetDataset, self).__init__(
+            getattr(dataset, 'view_converter', None), y,
+            _num_features(dataset))
+        self.dataset = dataset
+        self.start = start
+        self.stop = stop
+        self.indices = indices
+
+    def _get_num_examples(self):
+        if self.indices is not None:
+            return len(self.indices)
+        return self.stop - self.start
+
+    def get_rows(self, index):
+        index = _slice_indices(index, self.num_examples)
+        if self.indices is not None:
+            if isinstance(index, tuple):
+                index = slice(*index)
+            return _source_rows(self.dataset, self.indices[index])
+        if isinstance(index, tuple):
+            return _source_rows(self.dataset,
+                                slice(self.start + index[0],
+                                      self.start + index[1]))
+        return _source_rows(self.dataset, self.start + index)
+
+
+class RandomPatchDataset(VirtualDesignMatrix):
+    """
+    A fixed set of patches drawn uniformly at random from the images of
+    a dataset, like those ExtractPatches extracts, optionally followed
+    by preprocessors such as GlobalContrastNormalization and ZCA. The
+    patches are only cut out and preprocessed when they are requested,
+    so that the memory used doesn't grow with their number.
+
+    The location of each patch is a hash of its index and `seed` (see
+    `_hash_indices`), so patch i is the same in every epoch and every
+    process, and finding the locations of a batch costs the same
+    whatever the order the patches are requested in.
+    """
+    def __init__(self, dataset, patch_shape, num_patches, preprocessor=None,
+                 fit_patches=None, seed=(1, 2, 3)):
+        """
+        Parameters
+        ----------
+        dataset : DenseDesignMatrix
+            The dataset whose images the patches are cut from.
+        patch_shape : list
+            The shape of the patches along each topological dimension.
+        num_patches : int
+            The number of patches in the dataset.
+        preprocessor : object, optional
+            A preprocessor applied to every batch of patches, wrapped in
+            a DenseDesignMatrix, with can_fit=False. It should already
+            be fitted, unless `fit_patches` is given.
+        fit_patches : int, optional
+            If given, `preprocessor` is first applied with can_fit=True
+            to the first `fit_patches` patches, all at once, e.g. to fit
+            a ZCA on a sample of the patches.
+        seed : int or list, optional
+            Determines the locations of the patches.
+        """
+        images = dataset.get_topological_view()
+        if len(images.shape) - 2 != len(patch_shape):
+            raise ValueError("RandomPatchDataset with %d topological "
+                             "dimensions called on dataset with %d" %
+                             (len(patch_shape), len(images.shape) - 2))
+        for i, (width, patch_width) in enumerate(zip(images.shape[1:-1],
+                                                     patch_shape)):
+            if width < patch_width:
+                raise ValueError("On topological dimension %d, the data has "
+                                 "width %d but the requested patch width is "
+                                 "%d" % (i, width, patch_width))
+        self.dataset = dataset
+        self.patch_shape = tuple(patch_shape)
+        self.num_patches = num_patches
+        self.preprocessor = preprocessor
+        self.seed = seed
+        self._images = images
+        if fit_patches is not None:
+            if preprocessor is None:
+                raise ValueError("fit_patches given without a preprocessor")
+            sample = self._patches(N.arange(min(fit_patches, num_patches)))
+            sample = DenseDesignMatrix(topo_view=sample)
+            preprocessor.apply(sample, can_fit=True)
+        # The preprocessors may change the number of features or the
+        # view converter (e.g. PCA), see what they do to one patch.
+        first = self._preprocess(self._patches(N.arange(1)))
+        super(RandomPatchDataset, self).__init__(first.view_converter, None,
+                                                 first.X.shape[1])
+
+    def __getstate__(self):
+        rval = super(RandomPatchDataset, self).__getstate__()
+        # A view of the source dataset's design matrix.
+        rval['_images'] = None
+        return rval
+
+    def _get_num_examples(self):
+        return self.num_patches
+
+    def _get_images(self):
+        if self._images is None:
+            self._images = self.dataset.get_topological_view()
+        return self._images
+
+    def _locations(self, index):
+        """
+        Returns the locations of the patches with the indices in the
+        array `index`, an array with a row (image, corner coordinates...)
+        per patch.
+        """
+        images = self._get_images()
+        widths = [images.shape[0]] + [width - patch_width + 1
+                                      for width, patch_width
+                                      in zip(images.shape[1:-1],
+                                             self.patch_shape)]
+        # One key per coordinate, so that they are drawn independently.
+        keys = N.random.RandomState(list(N.atleast_1d(self.seed))).randint(
+            2 ** 30, size=len(widths))
+        locations = N.empty((len(index), len(widths)), dtype='int64')
+        for j, (width, key) in enumerate(zip(widths, keys)):
+            locations[:, j] = (_hash_indices(index, key) %
+                               N.uint64(width)).astype('int64')
+        return locations
+
+    def _patches(self, index):
+        """
+        Returns the patches with the indices in the array `index`, as a
+        floatX topological view, without preprocessing.
+        """
+        locations = self._locations(index)
+        images = self._get_images()
+        # A view of the images of shape (examples,) + corner coordinates
+        # + patch_shape + (channels,) whose elements [image, corner] are
+        # the patches.
+        topo_strides = images.strides[1:-1]
+        windows = as_strided(images,
+                             shape=(images.shape[:1] +
+                                    tuple(width - patch_width + 1
+                                          for width, patch_width
+                                          in zip(images.shape[1:-1],
+                                                 self.patch_shape)) +
+                                    self.patch_shape + images.shape[-1:]),
+                             strides=(images.strides[:1] + topo_strides +
+                                      topo_strides + images.strides[-1:]))
+        return N.cast[config.floatX](windows[tuple(locations.T)])
+
+    def _preprocess(self, patches):
+        """Returns a DenseDesignMatrix of the preprocessed `patches`."""
+        batch = DenseDesignMatrix(topo_view=patches)
+        if self.preprocessor is not None:
+            self.preprocessor.apply(batch, can_fit=False)
+        return batch
+
+    def get_rows(self, index):
+        index = _slice_indices(index, self.num_examples)
+        if isinstance(index, tuple):
+            index = N.arange(*index)
+        if len(index) == 0:
+            return N.zeros((0, self.num_features), dtype=config.floatX)
+        X = self._preprocess(self._patches(index)).get_design_matrix()
+        return N.cast[config.floatX](X)
+
+
+class VirtualDatasetIterator(object):
+    """
+    Iterates over the batches of a VirtualDesignMatrix selected by one
+    of the mode iterators of pylearn2.utils.iteration.
+    """
+    def __init__(self, dataset, subset_iterator, topo=False, targets=False):
+        self._dataset = dataset
+        self._subset_iterator = subset_iterator
+        self._topo = topo
+        self._targets = targets
+        if topo and dataset.view_converter is None:
+            raise ValueError("Can't iterate with topo=True on a dataset "
+                             "with no view converter")
+        if targets and dataset.get_targets() is None:
+            raise ValueError("Can't iterate with targets=True on a "
+                             "dataset object with no targets")
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        next_index = self._subset_iterator.next()
+        features = self._dataset.get_rows(next_index)
+        if self._topo:
+            features = self._dataset.get_topological_view(features)
+        if self._targets:
+            return features, self._dataset.get_targets()[next_index]
+        return features
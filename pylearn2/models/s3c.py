@@ -7,12 +7,13 @@ __maintainer__ = "Ian Goodfellow"
 
 import time
 from pylearn2.models import Model
-from theano import config, function
+from theano import config
 import theano.tensor as T
 import numpy as np
 import warnings
 from theano.gof.op import get_debug_values, debug_error_message, debug_assert
 from pylearn2.utils import make_name, sharedX, as_floatX
+from pylearn2.utils.function_cache import cached_function
 from pylearn2.expr.information_theory import entropy_binary_vector
 from theano.printing import Print
 from pylearn2.base import Block
@@ -774,7 +775,8 @@ class S3C(Model, Block):
 
         print "compiling function..."
         t1 = time.time()
-        rval = function([V], updates = learning_updates)
+        rval = cached_function([V], updates = learning_updates,
+                name = 's3c_learn_func')
         t2 = time.time()
         print "... compilation took "+str(t2-t1)+" seconds"
         print "graph size: ",len(rval.maker.env.toposort())
@@ -1108,7 +1110,7 @@ class S3C(Model, Block):
 
             self.e_step.register_model(self)
 
-            self.get_B_value = function([], self.B)
+            self.get_B_value = cached_function([], self.B)
 
             X = T.matrix(name='V')
             X.tag.test_value = np.cast[config.floatX](self.rng.randn(self.test_batch_size,self.nvis))
@@ -1,10 +1,11 @@
 """TODO: module-level docstring."""
 import time
 import numpy
-from theano import function, shared
+from theano import shared
 import theano.tensor as T
 import copy
 from pylearn2.config import yaml_parse
+from pylearn2.utils.function_cache import cached_function
 
 
 class Monitor(object):
@@ -38,7 +39,7 @@ class Monitor(object):
         #Determine whether the model should use topological or vector form of examples
         #If the model acts on a space with more than the batch index and channel dimension,
         #the model has topological dimensions, so the topological view of the data should be used
-        self.topo = len(model.get_input_space().make_theano_batch().type.broadcastable) > 2
+        self.topo = model.get_input_space().make_theano_batch().ndim > 2
 
     def set_dataset(self, dataset, batches, batch_size):
         """
@@ -148,7 +149,8 @@ class Monitor(object):
             updates[channel.val_shared] = 0.0
         print "compiling begin_record_entry..."
         t1 = time.time()
-        self.begin_record_entry = function(inputs=[], updates=updates)
+        self.begin_record_entry = cached_function(inputs=[], updates=updates,
+                                                  name='begin_record_entry')
         t2 = time.time()
         print "took "+str(t2-t1)+" seconds"
         updates = {}
@@ -162,7 +164,8 @@ class Monitor(object):
             updates[channel.val_shared] = channel.val_shared + channel.val
         print "compiling accum..."
         t1 = time.time()
-        self.accum = function([X], givens=givens, updates=updates)
+        self.accum = cached_function([X], givens=givens, updates=updates,
+                                     name='accum')
         t2 = time.time()
         print "graph size: ",len(self.accum.maker.env.toposort())
         print "took "+str(t2-t1)+" seconds"
@@ -300,11 +303,15 @@ class MonitorChannel(object):
                 values, I exclude them from the pickle.
         """
         return {
+            'batch_record': self.batch_record,
             'example_record': self.example_record,
             'val_record': self.val_record
         }
 
     def __setstate__(self, d):
+        if 'batch_record' not in d:
+            # Pickled before batch_record was saved.
+            d['batch_record'] = [None] * len(d['val_record'])
         self.__dict__.update(d)
 
 # TODO: Remove this at some point
@@ -24,6 +24,9 @@ import numpy as np
 # Local imports
 import pylearn2.config.yaml_parse
 from pylearn2.utils import serial
+from pylearn2.utils import checkpoint
+from pylearn2.utils.string_utils import preprocess
+from pylearn2.utils.timing import TrainingTimer
 from pylearn2.monitor import Monitor
 
 
@@ -61,7 +64,8 @@ class Train(object):
     and each of the registered callbacks are called.
     """
     def __init__(self, dataset, model, algorithm=None, save_path=None,
-                 save_freq=0, callbacks=None):
+                 save_freq=0, callbacks=None, checkpoint_path=None,
+                 checkpoint_freq=1):
         """
         Construct a Train instance.
 
@@ -86,6 +90,15 @@ class Train(object):
         callbacks : iterable, optional
             A collection of callbacks that are called, one at a time,
             after each epoch.
+        checkpoint_path : str, optional
+            Path of the checkpoint holding the whole training state
+            (model, algorithm, callbacks and dataset stream position),
+            from which an interrupted run can be resumed with
+            `train.py --resume`. Checkpoints are written in the
+            background and replace the previous one atomically. If not
+            specified, no checkpoint is written.
+        checkpoint_freq : int, optional
+            Frequency of checkpoints, in epochs (default=1).
         """
         self.dataset = dataset
         self.model = model
@@ -107,6 +120,15 @@ class Train(object):
                 self.save_path = '.'.join(tokens)
         self.save_freq = save_freq
         self.epochs = 0
+        if checkpoint_path is not None:
+            checkpoint_path = preprocess(checkpoint_path)
+        self.checkpoint_path = checkpoint_path
+        self.checkpoint_freq = checkpoint_freq
+        self.checkpoint_writer = checkpoint.CheckpointWriter()
+        self.resumed = False
+        self.resumed_channels = None
+        # Replaced by main_loop with one writing next to save_path.
+        self.timer = TrainingTimer()
         self.callbacks = callbacks if callbacks is not None else []
 
         if hasattr(self.dataset,'yaml_src'):
@@ -118,22 +140,60 @@ class Train(object):
         """
         Repeatedly runs an epoch of the training algorithm, runs any
         epoch-level callbacks, and saves the model.
+
+        The time spent in each phase of every epoch is recorded by
+        `self.timer`, a `pylearn2.utils.timing.TrainingTimer`, and
+        written next to `save_path` (with the suffix _timing.jsonl).
         """
+        save_path = getattr(self, 'save_path', None)
+        timing_path = None
+        if save_path is not None:
+            timing_path = os.path.splitext(save_path)[0] + '_timing.jsonl'
+        self.timer = TrainingTimer(timing_path, append=self.resumed)
+        self._seen_marks = None
+        if self.algorithm is not None:
+            self.algorithm.timer = self.timer
+        try:
+            self._main_loop()
+        finally:
+            self.timer.close()
+
+    def _main_loop(self):
+        timer = self.timer
         if self.algorithm is None:
-            self.model.monitor = Monitor.get_monitor(self.model)
-            while self.model.train(dataset=self.dataset):
+            with timer.phase('setup'):
+                self.model.monitor = Monitor.get_monitor(self.model)
+            self.end_epoch(self.epochs)
+            while True:
+                with timer.phase('update'):
+                    if not self.model.train(dataset=self.dataset):
+                        break
                 self.run_callbacks_and_monitoring()
                 if self.save_freq > 0 and self.epochs % self.save_freq == 0:
                     self.save()
                 self.epochs += 1
+                self.checkpoint()
+                self.end_epoch(self.epochs)
             self.run_callbacks_and_monitoring()
             if self.save_freq > 0:
                 self.save()
         else:
-            self.algorithm.setup(model=self.model, dataset=self.dataset)
-            self.model.monitor()
+            with timer.phase('setup'):
+                self.algorithm.setup(model=self.model, dataset=self.dataset)
+            if self.resumed_channels is not None:
+                checkpoint.restore_channel_records(self.model.monitor,
+                                                   self.resumed_channels)
+                self.resumed_channels = None
+            if not self.resumed:
+                # A resumed monitor already measured this point.
+                with timer.phase('monitor'):
+                    self.model.monitor()
+            self.end_epoch(self.epochs)
             epoch_start = datetime.datetime.now()
-            while self.algorithm.train(dataset=self.dataset):
+            while True:
+                with timer.phase('update'):
+                    if not self.algorithm.train(dataset=self.dataset):
+                        break
                 epoch_end = datetime.datetime.now()
                 print 'Time this epoch:', str(epoch_end - epoch_start)
                 epoch_start = datetime.datetime.now()
@@ -141,29 +201,91 @@ class Train(object):
                 if self.save_freq > 0 and self.epochs % self.save_freq == 0:
                     self.save()
                 self.epochs += 1
+                self.checkpoint()
+                self.end_epoch(self.epochs)
             self.run_callbacks_and_monitoring()
 
             if self.save_freq > 0:
                 self.save()
+        self.checkpoint(finished=True)
+        with timer.phase('save'):
+            self.checkpoint_writer.wait()
+        self.end_epoch(self.epochs + 1)
+
+    def end_epoch(self, epoch):
+        """
+        Closes the timing record of an epoch, counting the batches and
+        examples the monitor saw since the previous one.
+        """
+        monitor = getattr(self.model, 'monitor', None)
+        batches = examples = 0
+        if monitor is not None:
+            batches, examples = monitor.batches_seen, monitor.examples_seen
+        marks = self._seen_marks
+        if marks is None:
+            marks = (batches, examples)
+        self.timer.end_epoch(epoch, batches - marks[0], examples - marks[1])
+        self._seen_marks = (batches, examples)
+
+    def resume(self):
+        """
+        Restores the training state from `checkpoint_path`, if a
+        checkpoint exists there. Must be called before `main_loop`.
+
+        Returns
+        -------
+        finished : bool
+            True if the checkpointed run had already finished, in which
+            case `main_loop` should not be called.
+        """
+        if self.checkpoint_path is None:
+            warnings.warn('resuming requires a checkpoint_path, starting '
+                          'from scratch')
+            return False
+        if not os.path.exists(self.checkpoint_path):
+            print 'no checkpoint at', self.checkpoint_path, \
+                  ', starting from scratch'
+            return False
+        self.resumed = True
+        return checkpoint.resume(self, self.checkpoint_path)
+
+    def checkpoint(self, finished=False):
+        """
+        Starts writing a checkpoint in the background, every
+        `checkpoint_freq` epochs, and at the end of training.
+        """
+        if self.checkpoint_path is None:
+            return
+        if finished or self.epochs % self.checkpoint_freq == 0:
+            with self.timer.phase('save'):
+                self.checkpoint_writer.write(self.checkpoint_path, self,
+                                             finished)
 
     def run_callbacks_and_monitoring(self):
-        self.model.monitor()
-        for callback in self.callbacks:
-            try:
-                callback(self.model, self.dataset, self.algorithm)
-            except TypeError, e:
-                print 'Failure during callback '+str(callback)
-                raise
+        # The checkpoint being written holds the monitor.
+        with self.timer.phase('save'):
+            self.checkpoint_writer.wait()
+        with self.timer.phase('monitor'):
+            self.model.monitor()
+        with self.timer.phase('callbacks'):
+            for callback in self.callbacks:
+                try:
+                    callback(self.model, self.dataset, self.algorithm)
+                except TypeError, e:
+                    print 'Failure during callback '+str(callback)
+                    raise
 
 
     def save(self):
-        """Saves the model."""
-        #TODO-- save state of dataset and training algorithm so training can be
-        # resumed after a crash
+        """
+        Saves the model. The whole training state is saved by
+        checkpoints, see `checkpoint_path`.
+        """
         if self.save_path is not None:
             print 'saving to', self.save_path, '...'
             save_start = datetime.datetime.now()
-            serial.save(self.save_path, self.model)
+            with self.timer.phase('save'):
+                serial.save(self.save_path, self.model)
             save_end = datetime.datetime.now()
             delta = (save_end - save_start)
             print '...done. saving took', str(delta)
@@ -180,6 +302,9 @@ def make_argument_parser():
                         choices=None,
                         help='A YAML configuration file specifying the '
                              'training procedure')
+    parser.add_argument('--resume', action='store_true',
+                        help='Resume each training phase from its '
+                             'checkpoint_path, if a checkpoint exists')
     return parser
 
 
@@ -213,11 +338,15 @@ if __name__ == "__main__":
             os.putenv(phase_variable, phase_value)
 
             # Execute this training phase.
-            subobj.main_loop()
+            if not (args.resume and hasattr(subobj, 'resume') and
+                    subobj.resume()):
+                subobj.main_loop()
 
             # Clean up, in case there's a lot of memory used that's
             # necessary for the next phase.
             del subobj
             gc.collect()
     else:
-        train_obj.main_loop()
+        if not (args.resume and hasattr(train_obj, 'resume') and
+                train_obj.resume()):
+            train_obj.main_loop()
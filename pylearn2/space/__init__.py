@@ -31,6 +31,7 @@ the right space.
 import numpy as np
 import theano.tensor as T
 from theano.tensor import TensorType
+from theano.sparse import SparseType
 from theano import config
 import functools
 
@@ -55,14 +56,17 @@ class Space(object):
 class VectorSpace(Space):
     """ Defines a space whose points are defined as fixed-length vectors """
 
-    def __init__(self, dim):
+    def __init__(self, dim, sparse = False):
         """
 
         dim: the length of the fixed-length vector
+        sparse: if True, batches are represented as sparse (CSR)
+            matrices, e.g. for a SparseDesignMatrix dataset
 
         """
 
         self.dim = dim
+        self.sparse = sparse
 
     @functools.wraps(Space.get_origin)
     def get_origin(self):
@@ -80,6 +84,9 @@ class VectorSpace(Space):
         if dtype is None:
             dtype = config.floatX
 
+        if getattr(self, 'sparse', False):
+            return SparseType('csr', dtype = dtype)(name = name)
+
         return T.matrix(name = name, dtype = dtype)
 
 
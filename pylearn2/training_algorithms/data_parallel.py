@@ -0,0 +1,347 @@
+"""
+Synchronous data-parallel SGD.
+
+Every minibatch is split into one slice per worker. Each worker
+computes the gradient of the cost on its slice with a compiled,
+gradient-only function, the gradients are averaged (weighted by slice
+size) and the averaged step is applied to the model by the training
+process, through the model's `censor_updates`.
+
+Two transports are available for exchanging gradients:
+
+shared_memory
+    Workers are processes forked from the training process. The batch,
+    the parameters and one gradient slot per worker live in shared
+    memory; only small control messages go through pipes.
+tcp
+    Workers connect to the training process over TCP and exchange
+    parameters, batch slices and gradients with the binary framing of
+    `pylearn2.utils.wire`. Besides the locally forked workers, workers
+    running on other nodes can join with `run_gradient_worker`.
+
+The averaged gradient is summed in a fixed order, so for a fixed number
+of workers (and identical machines) results are bit-for-bit
+reproducible.
+"""
+import multiprocessing
+import traceback
+import numpy as np
+from theano import function
+import theano.tensor as T
+from pylearn2.training_algorithms.sgd import SGD, _sgd_updates
+from pylearn2.utils import wire
+from pylearn2.utils.shared_memory import shared_arrays, share_values
+
+# Message tags of the tcp transport.
+_STEP = 0
+_STOP = 1
+_ERROR = 2
+
+
+class DataParallelSGD(SGD):
+    """
+    SGD whose minibatch gradients are computed in parallel by several
+    worker processes, possibly on several nodes, and averaged
+    synchronously before every update.
+    """
+    def __init__(self, learning_rate, cost, num_workers=2,
+                 transport='shared_memory', address=('127.0.0.1', 0),
+                 num_remote_workers=0, batch_size=None,
+                 batches_per_iter=1000, monitoring_batches=-1,
+                 monitoring_dataset=None, termination_criterion=None,
+                 update_callbacks=None):
+        """
+        Instantiates a DataParallelSGD object.
+
+        Parameters
+        ----------
+        num_workers : int, optional
+            Number of worker processes forked on this machine.
+        transport : str, optional
+            'shared_memory' or 'tcp'. See the module docstring.
+        address : tuple, optional
+            (host, port) the training process listens on with the tcp
+            transport. Port 0 picks a free port, which is only useful
+            if all the workers are local.
+        num_remote_workers : int, optional
+            With the tcp transport, number of additional workers,
+            started with `run_gradient_worker`, to wait for.
+
+        See `SGD` for the other parameters.
+        """
+        super(DataParallelSGD, self).__init__(
+            learning_rate=learning_rate, cost=cost, batch_size=batch_size,
+            batches_per_iter=batches_per_iter,
+            monitoring_batches=monitoring_batches,
+            monitoring_dataset=monitoring_dataset,
+            termination_criterion=termination_criterion,
+            update_callbacks=update_callbacks)
+        if transport not in ['shared_memory', 'tcp']:
+            raise ValueError("unknown transport: %s" % str(transport))
+        if transport == 'shared_memory' and num_remote_workers > 0:
+            raise ValueError("remote workers require the tcp transport")
+        if num_workers + num_remote_workers < 1:
+            raise ValueError("DataParallelSGD needs at least one worker")
+        self.num_workers = num_workers
+        self.transport = transport
+        self.address = tuple(address)
+        self.num_remote_workers = num_remote_workers
+        self._workers = []
+
+    def _compile_updates(self, dataset, X, cost_value, learning_rate,
+                         updates):
+        self.updated_params = [param for param in self.params
+                               if param in updates]
+        self.gradient_function = _compile_gradients(X, cost_value,
+                                                    self.updated_params)
+        # The averaged gradients are inputs of the step, which goes
+        # through the model's censorship like any SGD update.
+        grads = [param.type(name='avg_grad(%s)' % param.name)
+                 for param in self.updated_params]
+        step_updates = dict((param, param - learning_rate * grad)
+                            for param, grad in zip(self.updated_params,
+                                                   grads))
+        self.model.censor_updates(step_updates)
+        self.apply_step = function(
+            [learning_rate] + grads,
+            [step_updates.get(param, param)
+             for param in self.updated_params],
+            name='data_parallel_apply_step')
+
+        batch_size = self._get_batch_size()
+        num_slices = self.num_workers + self.num_remote_workers
+        if batch_size < num_slices:
+            raise ValueError("batch_size (%d) is smaller than the number of "
+                             "workers (%d)" % (batch_size, num_slices))
+        bounds = np.linspace(0, batch_size, num_slices + 1).astype('int64')
+        self.slices = zip(bounds[:-1], bounds[1:])
+        self.weights = [float(stop - start) / batch_size
+                        for start, stop in self.slices]
+
+        batch_shape = self.model.get_input_space().get_origin_batch(
+            batch_size).shape
+        if self.transport == 'shared_memory':
+            self.param_values = share_values(self.updated_params)
+            values = [param.get_value(borrow=True)
+                      for param in self.updated_params]
+            specs = [(batch_shape, X.dtype)]
+            for i in xrange(self.num_workers):
+                specs.extend((value.shape, value.dtype) for value in values)
+            arrays = shared_arrays(specs)
+            self.batch_buffer = arrays[0]
+            num_params = len(values)
+            self.gradient_slots = [arrays[1 + i * num_params:
+                                          1 + (i + 1) * num_params]
+                                   for i in xrange(self.num_workers)]
+        self._start_workers()
+
+    def _start_workers(self):
+        self.close()
+        if self.transport == 'shared_memory':
+            for i in xrange(self.num_workers):
+                conn, worker_conn = multiprocessing.Pipe()
+                process = multiprocessing.Process(
+                    target=_shared_memory_worker,
+                    args=(self, self.gradient_slots[i], worker_conn),
+                    name='DataParallelSGD-%d' % i)
+                process.daemon = True
+                process.start()
+                self._workers.append((process, conn))
+        else:
+            server = wire.listen(self.address)
+            address = server.getsockname()
+            processes = []
+            for i in xrange(self.num_workers):
+                process = multiprocessing.Process(
+                    target=_tcp_worker,
+                    args=(address, self.gradient_function,
+                          self.updated_params),
+                    name='DataParallelSGD-%d' % i)
+                process.daemon = True
+                process.start()
+                processes.append(process)
+            if self.num_remote_workers > 0:
+                print ('DataParallelSGD waiting for %d remote workers on '
+                       '%s:%d' % ((self.num_remote_workers,) + address))
+            for i in xrange(self.num_workers + self.num_remote_workers):
+                sock = wire.accept(server)
+                process = processes[i] if i < len(processes) else None
+                self._workers.append((process, sock))
+            server.close()
+
+    def _train_epoch(self, dataset, batch_size):
+        if not self._workers:
+            raise Exception("DataParallelSGD worker processes were shut "
+                            "down")
+        if batch_size != self.slices[-1][1]:
+            raise ValueError("DataParallelSGD was set up for batches of "
+                             "%d examples" % self.slices[-1][1])
+        for i in xrange(self.batches_per_iter):
+            if self.topo:
+                X = dataset.get_batch_topo(batch_size)
+            else:
+                X = dataset.get_batch_design(batch_size)
+            if self.transport == 'shared_memory':
+                slot_grads = self._shared_memory_gradients(X)
+            else:
+                slot_grads = self._tcp_gradients(X)
+            # Fixed summation order, for reproducibility.
+            averaged = [self.weights[0] * grad for grad in slot_grads[0]]
+            for weight, grads in zip(self.weights[1:], slot_grads[1:]):
+                for total, grad in zip(averaged, grads):
+                    total += weight * grad
+            new_values = self.apply_step(self.learning_rate, *averaged)
+            if self.transport == 'shared_memory':
+                for value, new_value in zip(self.param_values, new_values):
+                    value[...] = new_value
+            else:
+                for param, new_value in zip(self.updated_params, new_values):
+                    param.set_value(new_value, borrow=True)
+            self.monitor.batches_seen += 1
+            self.monitor.examples_seen += batch_size
+
+    def _shared_memory_gradients(self, X):
+        self.batch_buffer[...] = X
+        for (process, conn), bounds in zip(self._workers, self.slices):
+            conn.send(bounds)
+        errors = [conn.recv() for process, conn in self._workers]
+        errors = [error for error in errors if error is not None]
+        if errors:
+            self.close()
+            raise Exception("DataParallelSGD worker failed:\n" + errors[0])
+        return self.gradient_slots
+
+    def _tcp_gradients(self, X):
+        values = [param.get_value(borrow=True)
+                  for param in self.updated_params]
+        for (process, sock), (start, stop) in zip(self._workers,
+                                                  self.slices):
+            wire.send_arrays(sock, values + [X[start:stop]], _STEP)
+        slot_grads = []
+        errors = []
+        for process, sock in self._workers:
+            tag, grads = wire.recv_arrays(sock)
+            if tag == _ERROR:
+                errors.append(grads[0].tostring())
+            slot_grads.append(grads)
+        if errors:
+            self.close()
+            raise Exception("DataParallelSGD worker failed:\n" + errors[0])
+        return slot_grads
+
+    def train(self, dataset):
+        rval = super(DataParallelSGD, self).train(dataset)
+        if not rval:
+            self.close()
+        return rval
+
+    def close(self):
+        """Shuts down the workers."""
+        for process, conn in self._workers:
+            try:
+                if self.transport == 'shared_memory':
+                    conn.send(None)
+                else:
+                    wire.send_arrays(conn, [], _STOP)
+                    conn.close()
+            except (IOError, EOFError):
+                pass
+        for process, conn in self._workers:
+            if process is not None:
+                process.join()
+        self._workers = []
+
+    def __getstate__(self):
+        d = self.__dict__.copy()
+        # Processes, connections and compiled functions can't be
+        # pickled.
+        for name in ['_workers', 'gradient_function', 'apply_step']:
+            d.pop(name, None)
+        return d
+
+    def __setstate__(self, d):
+        self.__dict__.update(d)
+        self._workers = []
+
+
+def _compile_gradients(X, cost_value, params):
+    """
+    Compiles a function mapping a batch to the gradients of
+    `cost_value` with respect to `params`.
+    """
+    return function([X], T.grad(cost_value, params),
+                    name='data_parallel_gradients')
+
+
+def run_gradient_worker(address, model, cost):
+    """
+    Runs a DataParallelSGD worker in this process until the training
+    process shuts it down.
+
+    Parameters
+    ----------
+    address : tuple
+        (host, port) the training process (a DataParallelSGD with the
+        tcp transport and `num_remote_workers > 0`) listens on.
+    model : object
+        A model identical to the one being trained, e.g. built from the
+        same YAML file. Its parameter values are overwritten by the
+        training process before every batch.
+    cost : object or iterable
+        The cost(s) given to the DataParallelSGD.
+    """
+    X = model.get_input_space().make_theano_batch(name='data_parallel_X')
+    cost_value, params, updates, learning_rate = _sgd_updates(model, cost, X)
+    params = [param for param in params if param in updates]
+    _tcp_worker(address, _compile_gradients(X, cost_value, params), params)
+
+
+def _shared_memory_worker(algorithm, slot, conn):
+    """
+    Main loop of a shared memory worker: each request received on
+    `conn` holds the bounds of this worker's slice of the shared batch
+    buffer, and is answered once the gradients are in `slot` (None), or
+    with a traceback on failure. A None request stops the worker.
+    """
+    while True:
+        bounds = conn.recv()
+        if bounds is None:
+            break
+        start, stop = bounds
+        try:
+            grads = algorithm.gradient_function(
+                algorithm.batch_buffer[start:stop])
+            for out, grad in zip(slot, grads):
+                out[...] = grad
+            conn.send(None)
+        except Exception:
+            conn.send(traceback.format_exc())
+    conn.close()
+
+
+def _tcp_worker(address, gradient_function, params):
+    """
+    Main loop of a tcp worker: each _STEP message holds the current
+    parameter values followed by a batch slice, and is answered with the
+    gradients on that slice.
+    """
+    sock = wire.connect(address)
+    try:
+        while True:
+            tag, arrays = wire.recv_arrays(sock)
+            if tag == _STOP:
+                break
+            try:
+                for param, value in zip(params, arrays[:-1]):
+                    param.set_value(value, borrow=True)
+                grads = gradient_function(arrays[-1])
+            except Exception:
+                message = np.fromstring(traceback.format_exc(),
+                                        dtype='uint8')
+                wire.send_arrays(sock, [message], _ERROR)
+            else:
+                wire.send_arrays(sock, grads, _STEP)
+    except EOFError:
+        pass
+    finally:
+        sock.close()
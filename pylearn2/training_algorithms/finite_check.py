@@ -0,0 +1,86 @@
+"""
+A cheap guard against divergence compiled into the update graph, so
+that NaNs and infs are caught within a few batches without copying
+every parameter back to the host.
+"""
+import numpy
+from theano import shared
+import theano.tensor as T
+
+
+class FiniteCheck(object):
+    """
+    Flags the first update producing a non-finite parameter value.
+
+    `add_updates` adds to a compiled update a reduction per parameter
+    (a sum, which is NaN or inf if any element is) and writes the index
+    of the first offending parameter, and the index of the batch, to
+    shared scalars. Only those scalars are read back, every
+    `check_every` batches.
+    """
+    def __init__(self, params, check_every=100, first_batch=0):
+        """
+        Parameters
+        ----------
+        params : list
+            The shared variables to check.
+        check_every : int, optional
+            Number of batches between two reads of the flag. If 0, the
+            flag is only read when `check` is called explicitly.
+        first_batch : int, optional
+            Index given to the next batch, e.g. the number of batches
+            already seen by the monitor.
+        """
+        self.params = params
+        self.check_every = check_every
+        self.batch = shared(numpy.asarray(first_batch, dtype='int64'),
+                            name='finite_check_batch')
+        self.bad_param = shared(numpy.asarray(-1, dtype='int64'),
+                                name='finite_check_bad_param')
+        self.bad_batch = shared(numpy.asarray(-1, dtype='int64'),
+                                name='finite_check_bad_batch')
+        self.checked = []
+        self._unchecked_batches = 0
+
+    def add_updates(self, updates):
+        """
+        Adds the updates of the flag to `updates`, a dictionary mapping
+        parameters to their new values. They must be compiled in the
+        same function, which must apply one batch per call.
+        """
+        self.checked = [param for param in self.params if param in updates]
+        if not self.checked:
+            return
+        bad = []
+        for param in self.checked:
+            total = updates[param].sum()
+            bad.append(T.or_(T.isnan(total), T.isinf(total)))
+        bad = T.stack(*bad)
+        first_bad = T.switch(bad.max(), T.argmax(bad), -1)
+        found = T.ge(self.bad_param, 0)
+        updates[self.bad_param] = T.switch(found, self.bad_param, first_bad)
+        updates[self.bad_batch] = T.switch(
+            found, self.bad_batch,
+            T.switch(T.ge(first_bad, 0), self.batch, -1))
+        updates[self.batch] = self.batch + 1
+
+    def batches_done(self, num_batches=1):
+        """
+        Records that `num_batches` updates were applied, and checks the
+        flag if `check_every` batches went by since the last check.
+        """
+        self._unchecked_batches += num_batches
+        if self.check_every > 0 and \
+                self._unchecked_batches >= self.check_every:
+            self.check()
+
+    def check(self):
+        """
+        Raises an exception if an update produced a non-finite value.
+        """
+        self._unchecked_batches = 0
+        index = int(self.bad_param.get_value())
+        if index >= 0:
+            raise Exception("NaN or inf in %s, produced by the update of "
+                            "batch %d" % (self.checked[index].name,
+                                          int(self.bad_batch.get_value())))
@@ -0,0 +1,167 @@
+"""
+Lock-free, asynchronous data-parallel SGD across processes ("Hogwild!",
+Niu et al., 2011).
+
+The model's parameters are moved into a shared memory region. Worker
+processes forked from the training process each draw their own batches
+and add their SGD steps into the shared parameters in place, without
+any locking. The training process keeps driving the usual
+`Train.main_loop`: monitoring, callbacks and saving all see the shared
+parameters.
+
+This is meant for CPU training of models whose updates are sparse-ish
+or otherwise tolerate asynchronous, occasionally overlapping writes,
+such as autoencoders and RBMs. Set OMP_NUM_THREADS (or the equivalent
+for your BLAS) so that the workers don't oversubscribe the cores.
+"""
+import multiprocessing
+import traceback
+import numpy as np
+from theano import function
+from pylearn2.training_algorithms.sgd import SGD
+from pylearn2.utils.shared_memory import share_values
+
+
+class HogwildSGD(SGD):
+    """
+    SGD whose updates are applied asynchronously by several worker
+    processes sharing the model's parameters.
+    """
+    def __init__(self, learning_rate, cost, num_workers=None,
+                 batch_size=None, batches_per_iter=1000,
+                 monitoring_batches=-1, monitoring_dataset=None,
+                 termination_criterion=None, update_callbacks=None):
+        """
+        Instantiates a HogwildSGD object.
+
+        Parameters
+        ----------
+        num_workers : int, optional
+            Number of worker processes. Defaults to the number of
+            cores.
+
+        See `SGD` for the other parameters. `batches_per_iter` is the
+        total number of batches of an epoch, split evenly between the
+        workers.
+        """
+        super(HogwildSGD, self).__init__(
+            learning_rate=learning_rate, cost=cost, batch_size=batch_size,
+            batches_per_iter=batches_per_iter,
+            monitoring_batches=monitoring_batches,
+            monitoring_dataset=monitoring_dataset,
+            termination_criterion=termination_criterion,
+            update_callbacks=update_callbacks)
+        if num_workers is None:
+            num_workers = multiprocessing.cpu_count()
+        if num_workers < 1:
+            raise ValueError("num_workers must be at least 1, got %d" %
+                             num_workers)
+        self.num_workers = num_workers
+        self._workers = []
+
+    def _compile_updates(self, dataset, X, cost_value, learning_rate,
+                         updates):
+        # The workers need the steps rather than the new values, so that
+        # they can add them in place into the shared parameters.
+        self.updated_params = [param for param in self.params
+                               if param in updates]
+        steps = [updates[param] - param for param in self.updated_params]
+        self.sgd_step = function([X, learning_rate], steps,
+                                 name='hogwild_sgd_step')
+        self.shared_values = share_values(self.updated_params)
+        # Fork only once everything the workers need is compiled.
+        self._start_workers(dataset)
+
+    def _start_workers(self, dataset):
+        self.close()
+        for i in xrange(self.num_workers):
+            conn, worker_conn = multiprocessing.Pipe()
+            process = multiprocessing.Process(target=_hogwild_worker,
+                                              args=(self, dataset,
+                                                    worker_conn),
+                                              name='HogwildSGD-%d' % i)
+            process.daemon = True
+            process.start()
+            self._workers.append((process, conn))
+
+    def _train_epoch(self, dataset, batch_size):
+        if not self._workers:
+            raise Exception("HogwildSGD worker processes were shut down")
+        counts = [self.batches_per_iter // self.num_workers] * self.num_workers
+        for i in xrange(self.batches_per_iter % self.num_workers):
+            counts[i] += 1
+        # Seeds are drawn from the dataset's generator so that, given
+        # its stream position, each worker's batches are reproducible.
+        seeds = dataset.rng.randint(2 ** 30, size=self.num_workers)
+        for (process, conn), count, seed in zip(self._workers, counts, seeds):
+            conn.send((count, batch_size, self.learning_rate, int(seed)))
+        errors = []
+        for process, conn in self._workers:
+            error = conn.recv()
+            if error is not None:
+                errors.append(error)
+        if errors:
+            self.close()
+            raise Exception("HogwildSGD worker failed:\n" + errors[0])
+        self.monitor.batches_seen += self.batches_per_iter
+        self.monitor.examples_seen += self.batches_per_iter * batch_size
+
+    def train(self, dataset):
+        rval = super(HogwildSGD, self).train(dataset)
+        if not rval:
+            self.close()
+        return rval
+
+    def close(self):
+        """
+        Shuts down the worker processes. The shared parameters remain
+        usable by the training process.
+        """
+        for process, conn in self._workers:
+            try:
+                conn.send(None)
+            except IOError:
+                pass
+        for process, conn in self._workers:
+            process.join()
+        self._workers = []
+
+    def __getstate__(self):
+        d = self.__dict__.copy()
+        # Processes, pipes and compiled functions can't be pickled.
+        for name in ['_workers', 'sgd_step']:
+            d.pop(name, None)
+        return d
+
+    def __setstate__(self, d):
+        self.__dict__.update(d)
+        self._workers = []
+
+
+def _hogwild_worker(algorithm, dataset, conn):
+    """
+    Main loop of a worker process. Each request received on `conn` is a
+    (num_batches, batch_size, learning_rate, seed) tuple; the worker
+    applies that many steps and replies with None, or with a traceback
+    on failure. A None request stops the worker.
+    """
+    values = algorithm.shared_values
+    while True:
+        request = conn.recv()
+        if request is None:
+            break
+        num_batches, batch_size, learning_rate, seed = request
+        try:
+            batches = dataset.iterator(mode='random_slice',
+                                       batch_size=batch_size,
+                                       num_batches=num_batches,
+                                       topo=algorithm.topo,
+                                       rng=np.random.RandomState(seed))
+            for X in batches:
+                steps = algorithm.sgd_step(X, learning_rate)
+                for value, step in zip(values, steps):
+                    value += step
+            conn.send(None)
+        except Exception:
+            conn.send(traceback.format_exc())
+    conn.close()
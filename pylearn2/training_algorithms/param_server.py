@@ -0,0 +1,412 @@
+"""
+Asynchronous SGD with a parameter server, for training across several
+processes or machines.
+
+The training process runs a `ParameterServer` that owns the values of
+the model's parameters. Workers repeatedly pull the parameters, compute
+the gradient of the cost on a batch of their own and push it back over
+TCP (with the binary framing of `pylearn2.utils.wire`). The server
+applies each pushed gradient with the current learning rate, through
+the model's `censor_updates`, unless it was computed from parameters
+that are more than `max_staleness` updates old.
+
+Between epochs the server stops accepting gradients, so that
+monitoring, callbacks and saving in `Train.main_loop` see a consistent
+set of parameters.
+"""
+import multiprocessing
+import socket
+import threading
+import traceback
+import numpy as np
+from theano import function
+from pylearn2.training_algorithms.sgd import SGD, _sgd_updates
+from pylearn2.training_algorithms.data_parallel import _compile_gradients
+from pylearn2.utils import wire
+
+# Message tags. Workers send _PULL, _PUSH and _ERROR; the server
+# answers with _PARAMS, _ACK, _REJECTED or _STOP.
+_PULL = 0
+_PUSH = 1
+_ERROR = 2
+_PARAMS = 3
+_ACK = 4
+_REJECTED = 5
+_STOP = 6
+
+
+class ParameterServer(object):
+    """
+    Serves the values of a list of shared variables to workers over TCP
+    and applies the gradients they push.
+
+    Each connection is handled by its own thread; pulls and updates are
+    serialized by a lock. Gradients are only applied while the server
+    has a positive budget of updates (see `allow`).
+    """
+    def __init__(self, params, apply_gradients, address=('127.0.0.1', 0),
+                 max_staleness=None):
+        """
+        Creates the listening socket. Call `start` to start serving.
+
+        Parameters
+        ----------
+        params : list
+            The shared variables served to the workers.
+        apply_gradients : callable
+            Called with the list of gradients pushed by a worker (one
+            array per parameter) to apply them.
+        address : tuple, optional
+            (host, port) to listen on. Port 0 lets the OS pick a free
+            port; see the `address` attribute for the actual one.
+        max_staleness : int, optional
+            Gradients computed from parameters more than this many
+            updates old are rejected; the worker then pulls fresh
+            parameters. Defaults to no limit.
+        """
+        self.params = params
+        self.apply_gradients = apply_gradients
+        self.max_staleness = max_staleness
+        self.version = 0
+        self.num_accepted = 0
+        self.num_rejected = 0
+        # Largest staleness of an applied gradient.
+        self.max_applied_staleness = 0
+        self.errors = []
+        self._budget = 0
+        self._stopping = False
+        self._condition = threading.Condition()
+        self._server = wire.listen(address)
+        # Closing a socket doesn't reliably wake up a thread blocked in
+        # accept(), so the accept loop also polls the stop flag.
+        self._server.settimeout(0.5)
+        self.address = self._server.getsockname()
+        self._thread = None
+
+    def start(self):
+        """Starts accepting connections in a background thread."""
+        self._thread = threading.Thread(target=self._accept_loop,
+                                        name='ParameterServer')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def allow(self, num_updates):
+        """Allows `num_updates` more gradients to be applied."""
+        with self._condition:
+            self._budget += num_updates
+            self._condition.notify_all()
+
+    def wait(self):
+        """
+        Blocks until the budget of updates is exhausted. Raises an
+        exception if a worker reported an error.
+        """
+        with self._condition:
+            while self._budget > 0 and not self.errors:
+                self._condition.wait(0.1)
+            if self.errors:
+                raise Exception("ParameterServer worker failed:\n" +
+                                self.errors[0])
+
+    def stop(self):
+        """
+        Tells every worker to stop, at its next request, and stops
+        accepting connections.
+        """
+        with self._condition:
+            self._stopping = True
+            self._condition.notify_all()
+        try:
+            self._server.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            # Not supported on listening sockets by every platform; the
+            # accept loop then notices the flag within its timeout.
+            pass
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self._server.close()
+
+    def _accept_loop(self):
+        while not self._stopping:
+            try:
+                sock = wire.accept(self._server)
+            except socket.timeout:
+                continue
+            except socket.error:
+                # The listening socket was shut down by stop().
+                return
+            thread = threading.Thread(target=self._handle, args=(sock,),
+                                      name='ParameterServer-connection')
+            thread.daemon = True
+            thread.start()
+
+    def _handle(self, sock):
+        try:
+            while True:
+                tag, arrays = wire.recv_arrays(sock)
+                if tag == _PULL:
+                    reply = self._pull()
+                elif tag == _PUSH:
+                    reply = self._push(int(arrays[0]), arrays[1:])
+                else:
+                    assert tag == _ERROR
+                    with self._condition:
+                        self.errors.append(arrays[0].tostring())
+                        self._condition.notify_all()
+                    return
+                wire.send_arrays(sock, reply[1], reply[0])
+                if reply[0] == _STOP:
+                    return
+        except EOFError:
+            pass
+        finally:
+            sock.close()
+
+    def _pull(self):
+        with self._condition:
+            if self._stopping:
+                return _STOP, []
+            values = [param.get_value() for param in self.params]
+            return _PARAMS, [np.array(self.version, dtype='int64')] + values
+
+    def _push(self, base_version, grads):
+        with self._condition:
+            while self._budget == 0 and not self._stopping:
+                self._condition.wait(0.1)
+            if self._stopping:
+                return _STOP, []
+            staleness = self.version - base_version
+            if (self.max_staleness is not None and
+                    staleness > self.max_staleness):
+                self.num_rejected += 1
+                tag = _REJECTED
+            else:
+                self.apply_gradients(grads)
+                self.max_applied_staleness = max(self.max_applied_staleness,
+                                                 staleness)
+                self.version += 1
+                self.num_accepted += 1
+                self._budget -= 1
+                self._condition.notify_all()
+                tag = _ACK
+            return tag, [np.array(self.version, dtype='int64')]
+
+
+class ParameterServerSGD(SGD):
+    """
+    Asynchronous SGD where worker processes compute gradients and a
+    parameter server in the training process applies them.
+    """
+    def __init__(self, learning_rate, cost, num_workers=2,
+                 address=('127.0.0.1', 0), max_staleness=None,
+                 pull_every=1, batch_size=None, batches_per_iter=1000,
+                 monitoring_batches=-1, monitoring_dataset=None,
+                 termination_criterion=None, update_callbacks=None):
+        """
+        Instantiates a ParameterServerSGD object.
+
+        Parameters
+        ----------
+        num_workers : int, optional
+            Number of worker processes forked on this machine. Workers
+            on other machines can join at any time with
+            `run_parameter_worker`.
+        address : tuple, optional
+            (host, port) the parameter server listens on. Port 0 picks
+            a free port, which is only useful if all the workers are
+            local.
+        max_staleness : int, optional
+            Maximum number of updates applied between a worker's pull
+            and its push for its gradient to be accepted. Defaults to
+            no limit.
+        pull_every : int, optional
+            Number of gradients local workers push between two pulls
+            of the parameters. Larger values reduce traffic at the cost
+            of staleness.
+
+        See `SGD` for the other parameters. `batches_per_iter` is the
+        number of gradients applied per epoch, whichever workers they
+        come from.
+        """
+        super(ParameterServerSGD, self).__init__(
+            learning_rate=learning_rate, cost=cost, batch_size=batch_size,
+            batches_per_iter=batches_per_iter,
+            monitoring_batches=monitoring_batches,
+            monitoring_dataset=monitoring_dataset,
+            termination_criterion=termination_criterion,
+            update_callbacks=update_callbacks)
+        self.num_workers = num_workers
+        self.address = tuple(address)
+        self.max_staleness = max_staleness
+        self.pull_every = pull_every
+        self._processes = []
+        self.server = None
+
+    def _compile_updates(self, dataset, X, cost_value, learning_rate,
+                         updates):
+        self.updated_params = [param for param in self.params
+                               if param in updates]
+        self.gradient_function = _compile_gradients(X, cost_value,
+                                                    self.updated_params)
+        grads = [param.type(name='pushed_grad(%s)' % param.name)
+                 for param in self.updated_params]
+        step_updates = dict((param, param - learning_rate * grad)
+                            for param, grad in zip(self.updated_params,
+                                                   grads))
+        self.model.censor_updates(step_updates)
+        self.apply_step = function([learning_rate] + grads,
+                                   updates=step_updates,
+                                   name='param_server_apply_step')
+
+        self.close()
+        self.server = ParameterServer(self.updated_params,
+                                      self._apply_gradients, self.address,
+                                      self.max_staleness)
+        batch_size = self._get_batch_size()
+        seeds = dataset.rng.randint(2 ** 30, size=self.num_workers)
+        # Fork before the server starts its threads.
+        for i in xrange(self.num_workers):
+            process = multiprocessing.Process(
+                target=_parameter_worker,
+                args=(self.server.address, self.gradient_function,
+                      self.updated_params, dataset, batch_size, self.topo,
+                      int(seeds[i]), self.pull_every),
+                name='ParameterServerSGD-%d' % i)
+            process.daemon = True
+            process.start()
+            self._processes.append(process)
+        self.server.start()
+
+    def _apply_gradients(self, grads):
+        self.apply_step(self.learning_rate, *grads)
+
+    def _train_epoch(self, dataset, batch_size):
+        if self.server is None:
+            raise Exception("ParameterServerSGD server was shut down")
+        self.server.allow(self.batches_per_iter)
+        self.server.wait()
+        self.monitor.batches_seen += self.batches_per_iter
+        self.monitor.examples_seen += self.batches_per_iter * batch_size
+
+    def train(self, dataset):
+        rval = super(ParameterServerSGD, self).train(dataset)
+        if not rval:
+            self.close()
+        return rval
+
+    def close(self):
+        """Stops the parameter server and the local workers."""
+        if self.server is not None:
+            self.server.stop()
+            self.server = None
+        for process in self._processes:
+            process.join()
+        self._processes = []
+
+    def __getstate__(self):
+        d = self.__dict__.copy()
+        # Processes, servers and compiled functions can't be pickled.
+        for name in ['_processes', 'server', 'gradient_function',
+                     'apply_step']:
+            d.pop(name, None)
+        return d
+
+    def __setstate__(self, d):
+        self.__dict__.update(d)
+        self._processes = []
+        self.server = None
+
+
+def run_parameter_worker(address, model, cost, dataset, batch_size,
+                         seed=None, pull_every=1, shard_index=None,
+                         num_shards=None):
+    """
+    Runs a ParameterServerSGD worker in this process until the server
+    shuts it down.
+
+    Parameters
+    ----------
+    address : tuple
+        (host, port) of the parameter server.
+    model : object
+        A model identical to the one being trained, e.g. built from the
+        same YAML file. Its parameter values are overwritten with the
+        server's on every pull.
+    cost : object or iterable
+        The cost(s) given to the ParameterServerSGD.
+    dataset : object
+        The dataset this worker draws its batches from.
+    batch_size : int
+        Number of examples per pushed gradient.
+    seed : int, optional
+        Seed of the worker's batch selection.
+    pull_every : int, optional
+        Number of gradients pushed between two pulls.
+    shard_index, num_shards : int, optional
+        If given, the worker only draws its batches from shard
+        `shard_index` of `num_shards` contiguous, disjoint shards of
+        `dataset`, so that workers on different hosts read different
+        examples.
+    """
+    X = model.get_input_space().make_theano_batch(name='param_server_X')
+    cost_value, params, updates, learning_rate = _sgd_updates(model, cost, X)
+    params = [param for param in params if param in updates]
+    topo = len(X.type.broadcastable) > 2
+    _parameter_worker(address, _compile_gradients(X, cost_value, params),
+                      params, dataset, batch_size, topo, seed, pull_every,
+                      shard_index, num_shards)
+
+
+def _random_batches(dataset, batch_size, topo, rng, shard_index=None,
+                    num_shards=None):
+    """Yields random contiguous batches of `dataset` forever."""
+    while True:
+        for X in dataset.iterator(mode='random_slice', batch_size=batch_size,
+                                  num_batches=1000, topo=topo, rng=rng,
+                                  shard_index=shard_index,
+                                  num_shards=num_shards):
+            yield X
+
+
+def _parameter_worker(address, gradient_function, params, dataset,
+                      batch_size, topo, seed, pull_every, shard_index=None,
+                      num_shards=None):
+    """Main loop of a worker: pull, compute gradients, push."""
+    sock = wire.connect(address)
+    batches = _random_batches(dataset, batch_size, topo,
+                              np.random.RandomState(seed), shard_index,
+                              num_shards)
+    version = None
+    num_pushed = 0
+    try:
+        while True:
+            if version is None or num_pushed % pull_every == 0:
+                wire.send_arrays(sock, [], _PULL)
+                tag, arrays = wire.recv_arrays(sock)
+                if tag == _STOP:
+                    break
+                version = int(arrays[0])
+                for param, value in zip(params, arrays[1:]):
+                    param.set_value(value, borrow=True)
+            try:
+                grads = gradient_function(batches.next())
+            except Exception:
+                message = np.fromstring(traceback.format_exc(),
+                                        dtype='uint8')
+                wire.send_arrays(sock, [message], _ERROR)
+                break
+            wire.send_arrays(sock,
+                             [np.array(version, dtype='int64')] + grads,
+                             _PUSH)
+            tag, arrays = wire.recv_arrays(sock)
+            if tag == _STOP:
+                break
+            if tag == _REJECTED:
+                # Too stale: pull before computing the next gradient.
+                version = None
+            num_pushed += 1
+    except EOFError:
+        pass
+    finally:
+        sock.close()
@@ -0,0 +1,147 @@
+"""
+Support for keeping training data resident in a Theano shared variable,
+so that compiled updates only receive batch bounds as inputs instead of
+a freshly copied numpy array for every minibatch.
+"""
+import numpy
+from theano import config
+import theano.tensor as T
+from pylearn2.utils import sharedX
+
+
+class ResidentData(object):
+    """
+    Holds the examples of a dataset, or a chunk of them if the whole
+    dataset does not fit in the memory budget, in a Theano shared
+    variable. Chunks are swapped in as iteration proceeds.
+
+    Compiled functions should substitute `batch()` for their data input
+    (through `givens`) and take `start` and `stop` as inputs. The bounds
+    yielded by the iteration methods are relative to the chunk that is
+    resident at the time they are yielded.
+    """
+    def __init__(self, dataset, topo=False, budget=None):
+        """
+        Parameters
+        ----------
+        dataset : object
+            A dataset exposing its examples through `get_design_matrix`
+            (and `get_topological_view` if `topo` is True), such as a
+            `DenseDesignMatrix`.
+        topo : bool, optional
+            Whether the resident copy should be in topological view.
+        budget : int, optional
+            Maximum size in bytes of the resident copy. Defaults to no
+            limit, i.e. the whole dataset is resident.
+        """
+        self.dataset = dataset
+        self.topo = topo
+        X = dataset.get_design_matrix()
+        self.num_examples = X.shape[0]
+        if topo:
+            example_shape = tuple(dataset.view_shape())
+        else:
+            example_shape = tuple(X.shape[1:])
+        example_bytes = numpy.dtype(config.floatX).itemsize
+        for dim in example_shape:
+            example_bytes *= dim
+        if budget is None:
+            self.chunk_size = self.num_examples
+        else:
+            self.chunk_size = min(self.num_examples,
+                                  int(budget) // example_bytes)
+            if self.chunk_size < 1:
+                raise ValueError("resident budget of %d bytes cannot hold a "
+                                 "single example (%d bytes)" %
+                                 (budget, example_bytes))
+        self.data = sharedX(numpy.zeros((0,) + example_shape),
+                            name='resident_data')
+        self.start = T.lscalar('resident_start')
+        self.stop = T.lscalar('resident_stop')
+        self._loaded = None
+
+    def batch(self, like=None):
+        """
+        Returns the symbolic batch `data[start:stop]`.
+
+        Parameters
+        ----------
+        like : Variable, optional
+            If given, the batch is given the broadcastable pattern of
+            this variable, so that it can replace it in `givens`.
+        """
+        rval = self.data[self.start:self.stop]
+        if like is not None:
+            rval = T.patternbroadcast(rval, like.broadcastable)
+        return rval
+
+    def chunks(self):
+        """Returns the (start, stop) bounds of every chunk, in order."""
+        return [(start, min(start + self.chunk_size, self.num_examples))
+                for start in xrange(0, self.num_examples, self.chunk_size)]
+
+    def load(self, start, stop):
+        """
+        Makes examples `start` to `stop` of the dataset resident,
+        unless they already are.
+        """
+        if self._loaded == (start, stop):
+            return
+        chunk = self.dataset.get_design_matrix()[start:stop]
+        if self.topo:
+            chunk = self.dataset.get_topological_view(chunk)
+        # Free the previous chunk before allocating the new one.
+        self.data.set_value(numpy.zeros((0,) + chunk.shape[1:],
+                                        dtype=config.floatX), borrow=True)
+        self.data.set_value(numpy.cast[config.floatX](chunk), borrow=True)
+        self._loaded = (start, stop)
+
+    def check_batch_size(self, batch_size):
+        if batch_size > self.chunk_size:
+            raise ValueError("batch_size (%d) is larger than the number of "
+                             "resident examples (%d); increase the resident "
+                             "budget" % (batch_size, self.chunk_size))
+
+    def random_batches(self, rng, batch_size, num_batches):
+        """
+        Draws `num_batches` random contiguous batches. Yields, for each
+        chunk in turn, the list of (start, stop) bounds of its batches,
+        after making that chunk resident.
+
+        When the whole dataset is resident this draws the same batches
+        as `DenseDesignMatrix.get_batch_design` would with the same
+        `rng`. Otherwise chunks are visited in a random order and each
+        one receives a number of batches proportional to its size.
+        """
+        self.check_batch_size(batch_size)
+        chunks = [(start, stop) for start, stop in self.chunks()
+                  if stop - start >= batch_size]
+        if len(chunks) > 1:
+            chunks = [chunks[i] for i in rng.permutation(len(chunks))]
+        total = sum(stop - start for start, stop in chunks)
+        counts = [num_batches * (stop - start) // total
+                  for start, stop in chunks]
+        for i in xrange(num_batches - sum(counts)):
+            counts[i % len(counts)] += 1
+        for (start, stop), count in zip(chunks, counts):
+            if count == 0:
+                continue
+            self.load(start, stop)
+            batches = []
+            for i in xrange(count):
+                idx = rng.randint(stop - start - batch_size + 1)
+                batches.append((idx, idx + batch_size))
+            yield batches
+
+    def sequential_batches(self, batch_size):
+        """
+        Yields, for each chunk in turn, the list of (start, stop) bounds
+        of consecutive batches covering it, after making that chunk
+        resident. The last batch of a chunk may be shorter than
+        `batch_size`.
+        """
+        for start, stop in self.chunks():
+            self.load(start, stop)
+            size = stop - start
+            yield [(idx, min(idx + batch_size, size))
+                   for idx in xrange(0, size, batch_size)]
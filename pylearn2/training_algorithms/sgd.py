@@ -1,14 +1,181 @@
 from __future__ import division
 import datetime
 import numpy as np
-from theano import function, config
+from theano import config, clone, scan
 import theano.tensor as T
+from theano.sparse import SparseType
 from warnings import warn
 from pylearn2.monitor import Monitor
 from pylearn2.utils.iteration import SequentialSubsetIterator
+from pylearn2.utils.function_cache import cached_function
+from pylearn2.utils.prefetch import BatchPrefetcher
+from pylearn2.training_algorithms.resident import ResidentData
+from pylearn2.training_algorithms.finite_check import FiniteCheck
+from pylearn2.datasets.dense_design_matrix import DenseDesignMatrix
 from pylearn2.training_algorithms.training_algorithm import TrainingAlgorithm
 
 
+def _sgd_updates(model, cost, X):
+    """
+    Builds the symbolic SGD step of `model` on the batch `X`.
+
+    Parameters
+    ----------
+    model : object
+        Model to be trained.
+    cost : object or iterable
+        A cost callable, or an iterable of cost callables to be summed.
+    X : Variable
+        The symbolic batch the cost is evaluated on.
+
+    Returns
+    -------
+    cost_value : Variable
+        The (named) symbolic cost.
+    params : list
+        The model's parameters.
+    updates : dict
+        The censored SGD updates, mapping parameters to their new value.
+    learning_rate : Variable
+        The symbolic learning rate the updates depend on.
+    """
+    try:
+        cost_value = sum(c(model, X) for c in cost)
+    except TypeError:
+        cost_value = cost(model, X)
+    if cost_value.name is None:
+        cost_value.name = 'sgd_cost(' + X.name + ')'
+    params = model.get_params()
+    for i, param in enumerate(params):
+        if param.name is None:
+            param.name = 'sgd_params[%d]' % i
+    grads = dict(zip(params, T.grad(cost_value, params)))
+    for param in grads:
+        if grads[param].name is None:
+            grads[param].name = ('grad(%(costname)s, %(paramname)s)' %
+                                 {'costname': cost_value.name,
+                                  'paramname': param.name})
+    learning_rate = T.scalar('sgd_learning_rate')
+    updates = dict(zip(params, [param - learning_rate * grads[param]
+                                for param in params]))
+    for param in updates:
+        if updates[param].name is None:
+            updates[param].name = 'sgd_update(' + param.name + ')'
+    model.censor_updates(updates)
+    for param in updates:
+        if updates[param] is None:
+            updates[param].name = 'censor(sgd_update(' + param.name + '))'
+    return cost_value, params, updates, learning_rate
+
+
+def _compile_sgd_update(X, learning_rate, updates, resident_data=None,
+                        steps_per_call=1):
+    """
+    Compiles the functions applying `updates`.
+
+    Returns
+    -------
+    sgd_update : theano function
+        Applies one step. Takes `(X, learning_rate)`, or
+        `(start, stop, learning_rate)` if `resident_data` is given.
+    sgd_update_multi : theano function or None
+        Only compiled if `resident_data` is given and `steps_per_call`
+        is greater than 1. Takes `(starts, batch_size, learning_rate)`
+        and applies, in a single call, one step on each of the
+        resident batches `data[start:start + batch_size]`, with
+        `starts` of length `steps_per_call`.
+    """
+    if resident_data is None:
+        sgd_update = cached_function([X, learning_rate], updates=updates,
+                                     name='sgd_update')
+        return sgd_update, None
+    sgd_update = cached_function([resident_data.start, resident_data.stop,
+                                  learning_rate],
+                                 updates=updates,
+                                 givens={X: resident_data.batch(X)},
+                                 name='sgd_update')
+    if steps_per_call <= 1:
+        return sgd_update, None
+
+    starts = T.lvector('sgd_starts')
+    batch_size = T.lscalar('sgd_batch_size')
+    updated = list(updates.keys())
+
+    def step(start, *current):
+        batch = resident_data.data[start:start + batch_size]
+        replace = dict(zip(updated, current))
+        replace[X] = T.patternbroadcast(batch, X.broadcastable)
+        return [T.patternbroadcast(clone(updates[var], replace=replace),
+                                   var.broadcastable)
+                for var in updated]
+
+    results, scan_updates = scan(step, sequences=[starts],
+                                 outputs_info=updated,
+                                 n_steps=steps_per_call,
+                                 name='sgd_multi_step')
+    if not isinstance(results, (list, tuple)):
+        results = [results]
+    multi_updates = dict(scan_updates)
+    for var, result in zip(updated, results):
+        multi_updates[var] = result[-1]
+    sgd_update_multi = cached_function([starts, batch_size, learning_rate],
+                                       updates=multi_updates,
+                                       name='sgd_update_multi')
+    return sgd_update, sgd_update_multi
+
+
+def _resident_epoch(algorithm, chunk_batches, batch_size, callbacks=()):
+    """
+    Runs `algorithm`'s compiled updates on resident batches, grouping
+    full-size batches into multi-step calls when available, and updates
+    the monitor's counters once per call.
+
+    Parameters
+    ----------
+    algorithm : SGD or UnsupervisedExhaustiveSGD
+        A set up algorithm with resident data.
+    chunk_batches : iterable
+        For each resident chunk, a list of (start, stop) bounds, as
+        yielded by the `ResidentData` iteration methods.
+    batch_size : int
+        Size of a full batch.
+    callbacks : iterable, optional
+        Callbacks to call with `algorithm` once per batch. The learning
+        rate they set only takes effect at the next call, so it is held
+        constant within a multi-step call.
+    """
+    monitor = algorithm.monitor
+    steps = algorithm.steps_per_call
+    for batches in chunk_batches:
+        if algorithm.sgd_update_multi is None:
+            single = batches
+        else:
+            full = [start for start, stop in batches
+                    if stop - start == batch_size]
+            num_multi = len(full) // steps * steps
+            for i in xrange(0, num_multi, steps):
+                starts = np.asarray(full[i:i + steps], dtype='int64')
+                algorithm.sgd_update_multi(starts, batch_size,
+                                           algorithm.learning_rate)
+                algorithm.finite_check.batches_done(steps)
+                monitor.batches_seen += steps
+                monitor.examples_seen += steps * batch_size
+                for j in xrange(steps):
+                    for callback in callbacks:
+                        callback(algorithm)
+            single = ([(start, start + batch_size)
+                       for start in full[num_multi:]] +
+                      [(start, stop) for start, stop in batches
+                       if stop - start != batch_size])
+        for start, stop in single:
+            algorithm.sgd_update(start, stop, algorithm.learning_rate)
+            algorithm.finite_check.batches_done()
+            monitor.batches_seen += 1
+            monitor.examples_seen += stop - start
+            for callback in callbacks:
+                callback(algorithm)
+
+
 # TODO: This needs renaming based on specifics. Specifically it needs
 # "unsupervised" in its name, and some sort of qualification based on
 # its slightly unorthodox batch selection strategy.
@@ -25,7 +192,9 @@ class SGD(TrainingAlgorithm):
     def __init__(self, learning_rate, cost, batch_size=None,
                  batches_per_iter=1000, monitoring_batches=-1,
                  monitoring_dataset=None, termination_criterion=None,
-                 update_callbacks=None):
+                 update_callbacks=None, prefetch=0, prefetch_threads=1,
+                 resident=False, resident_budget=None, steps_per_call=1,
+                 check_finite_every=100):
         """
         Instantiates an SGD object.
 
@@ -50,6 +219,38 @@ class SGD(TrainingAlgorithm):
             WRITEME
         update_callback : iterable or object, optional
             WRITEME
+        prefetch : int, optional
+            If positive, batches are built in background threads, up to
+            this many batches ahead of the update, so that fetching
+            data overlaps with the compiled update. Default is 0 (build
+            each batch right before its update).
+        prefetch_threads : int, optional
+            Number of background threads building batches when
+            `prefetch` is positive. With more than one thread the order
+            in which batches are drawn is no longer reproducible.
+        resident : bool, optional
+            If True, the training set is copied once into a Theano
+            shared variable and the compiled update only receives the
+            bounds of each batch, avoiding per-batch copies on the host
+            and across the function boundary. The dataset must provide
+            `get_design_matrix`. Prefetching is not used in this mode.
+        resident_budget : int, optional
+            Maximum number of bytes of training data kept resident at
+            once when `resident` is True. Larger datasets are swapped
+            in chunk by chunk, each chunk receiving a share of the
+            epoch's batches proportional to its size. Defaults to no
+            limit.
+        steps_per_call : int, optional
+            With `resident=True`, the number of consecutive minibatch
+            updates applied by a single call to a compiled (scan-based)
+            function. Values above 1 reduce the per-batch call overhead,
+            which dominates with small batches. The learning rate is
+            held constant within a call. Default is 1.
+        check_finite_every : int, optional
+            The compiled update flags the first batch producing a NaN
+            or inf in a parameter; the flag is read back every this
+            many batches, and at the end of each epoch if 0. Default is
+            100.
 
         Notes
         -----
@@ -72,6 +273,17 @@ class SGD(TrainingAlgorithm):
         self.monitoring_batches = monitoring_batches
         self.termination_criterion = termination_criterion
         self._register_update_callbacks(update_callbacks)
+        self.prefetch = prefetch
+        self.prefetch_threads = prefetch_threads
+        self.resident = resident
+        self.resident_budget = resident_budget
+        if resident and prefetch > 0:
+            warn("prefetch has no effect on SGD with resident=True")
+        if steps_per_call > 1 and not resident:
+            raise ValueError("steps_per_call > 1 requires resident=True")
+        self.steps_per_call = steps_per_call
+        self.check_finite_every = check_finite_every
+        self.finite_check = None
         self.bSetup = False
         self.first = True
 
@@ -103,57 +315,94 @@ class SGD(TrainingAlgorithm):
         space = self.model.get_input_space()
         X = space.make_theano_batch(name='sgd_X')
 
-        self.topo = len(X.type.broadcastable) > 2
-
-        try:
-            J = sum(c(model, X) for c in self.cost)
-        except TypeError:
-            J = self.cost(model, X)
+        self.topo = X.ndim > 2
+        self._check_sparse(dataset, X)
 
-        if J.name is None:
-            J.name = 'sgd_cost(' + X.name + ')'
+        J, params, updates, learning_rate = _sgd_updates(model, self.cost, X)
         self.monitor.add_channel(name=J.name, ipt=X, val=J)
-        params = model.get_params()
-
-        for i, param in enumerate(params):
-            if param.name is None:
-                param.name = 'sgd_params[%d]' % i
-
-        grads = dict(zip(params, T.grad(J, params)))
-
-        for param in grads:
-            if grads[param].name is None:
-                grads[param].name = ('grad(%(costname)s, %(paramname)s)' %
-                                     {'costname': J.name,
-                                      'paramname': param.name})
-
-        learning_rate = T.scalar('sgd_learning_rate')
-
-        updates = dict(zip(params, [param - learning_rate * grads[param]
-                                    for param in params]))
-
-        for param in updates:
-            if updates[param].name is None:
-                updates[param].name = 'sgd_update(' + param.name + ')'
-
-        model.censor_updates(updates)
-        for param in updates:
-            if updates[param] is None:
-                updates[param].name = 'censor(sgd_update(' + param.name + '))'
-
-        self.sgd_update = function([X, learning_rate], updates=updates,
-                                   name='sgd_update')
         self.params = params
+        self._compile_updates(dataset, X, J, learning_rate, updates)
         self.bSetup = True
 
         #TODO: currently just supports doing a gradient step on J(X)
         #      needs to support "side effects", e.g. updating persistent chains
         #      for SML (if we decide to implement SML as SGD)
 
+    def _check_sparse(self, dataset, X):
+        """
+        Checks that the batches of `dataset` and the model's input space
+        are both sparse or both dense. Sparse batches are passed to the
+        update as they are, without resident data or prefetching.
+        """
+        sparse_data = getattr(dataset, 'sparse', False)
+        sparse_input = isinstance(X.type, SparseType)
+        if sparse_data and not sparse_input:
+            raise ValueError("the dataset yields sparse batches but the "
+                             "model's input space is dense; use a sparse "
+                             "input space, e.g. VectorSpace(dim, "
+                             "sparse=True)")
+        if sparse_input and not sparse_data:
+            raise ValueError("the model's input space is sparse but the "
+                             "dataset yields dense batches")
+        if sparse_data:
+            if self.resident:
+                raise ValueError("resident=True needs a dense dataset")
+            if self.prefetch > 0:
+                warn("prefetch is not supported with sparse datasets, "
+                     "batches are built right before their update")
+                self.prefetch = 0
+
+    def _compile_updates(self, dataset, X, cost_value, learning_rate,
+                         updates):
+        """
+        Compiles the functions used by `_train_epoch` to apply
+        `updates`, the censored SGD updates of the model's parameters
+        for the cost `cost_value` on the symbolic batch `X`. Subclasses
+        implementing other ways of applying the updates override this
+        method and `_train_epoch`.
+        """
+        self.finite_check = FiniteCheck(self.params, self.check_finite_every,
+                                        self.monitor.batches_seen)
+        self.finite_check.add_updates(updates)
+        if self.resident:
+            self.resident_data = ResidentData(dataset, self.topo,
+                                              self.resident_budget)
+        else:
+            self.resident_data = None
+        self.sgd_update, self.sgd_update_multi = _compile_sgd_update(
+            X, learning_rate, updates, self.resident_data,
+            self.steps_per_call)
+
     def train(self, dataset):
-        model = self.model
         if not self.bSetup:
             raise Exception("SGD.train called without first calling SGD.setup")
+        batch_size = self._get_batch_size()
+        if self.finite_check is None:
+            # Subclasses applying the updates their own way don't
+            # compile the in-graph check.
+            for param in self.params:
+                value = param.get_value(borrow=True)
+                if np.any(np.isnan(value)) or np.any(np.isinf(value)):
+                    raise Exception("NaN in " + param.name)
+
+        self.first = False
+        self._train_epoch(dataset, batch_size)
+        if self.finite_check is not None:
+            self.finite_check.check()
+
+        for callback in self.update_callbacks:
+            try:
+                callback(self)
+            except Exception as e:
+                print ("WARNING: callback " + str(callback) + " failed with "
+                       + str(type(e)) + ", mesage: " + str(e))
+        if self.termination_criterion is None:
+            return True
+        else:
+            return self.termination_criterion(self.model)
+
+    def _get_batch_size(self):
+        model = self.model
         if self.batch_size is None:
             batch_size = model.force_batch_size
         else:
@@ -164,49 +413,79 @@ class SGD(TrainingAlgorithm):
                             # TODO: more informative assertion error
                             "invalid force_batch_size attribute"
                         )
-        for param in self.params:
-            value = param.get_value(borrow=True)
-            if np.any(np.isnan(value)) or np.any(np.isinf(value)):
-                raise Exception("NaN in " + param.name)
+        return batch_size
 
-        self.first = False
-        for i in xrange(self.batches_per_iter):
-            if self.topo:
-                X = dataset.get_batch_topo(batch_size)
-            else:
-                X = dataset.get_batch_design(batch_size)
-
-            #print '\n----------------'
-            self.sgd_update(X, self.learning_rate)
-            #print '----------------\n'
-
-            #comment out this check when not debugging
-            """for param in self.params:
-                value = param.get_value(borrow=True)
-                if N.any(N.isnan(value)):
-                    raise Exception("NaN in "+param.name)
-                #
-            #"""
+    def _train_epoch(self, dataset, batch_size):
+        """
+        Applies the `batches_per_iter` updates of one epoch.
+        """
+        if self.resident:
+            self._train_resident(dataset, batch_size)
+        else:
+            self._train_batches(dataset, batch_size)
 
-            self.monitor.batches_seen += 1
-            self.monitor.examples_seen += batch_size
+    def _train_resident(self, dataset, batch_size):
+        """
+        Runs the epoch's updates on batches of the resident data.
+        """
+        chunk_batches = self.resident_data.random_batches(
+            dataset.rng, batch_size, self.batches_per_iter)
+        _resident_epoch(self, chunk_batches, batch_size)
 
-        for callback in self.update_callbacks:
-            try:
-                callback(self)
-            except Exception as e:
-                print ("WARNING: callback " + str(callback) + " failed with "
-                       + str(type(e)) + ", mesage: " + str(e))
-        if self.termination_criterion is None:
-            return True
+    def _train_batches(self, dataset, batch_size):
+        """
+        Runs the epoch's updates on batches passed from the host.
+        """
+        batches = self._batches(dataset, batch_size)
+        try:
+            for X in self._timed(batches):
+                self.sgd_update(X, self.learning_rate)
+                self.finite_check.batches_done()
+                self.monitor.batches_seen += 1
+                self.monitor.examples_seen += batch_size
+        finally:
+            if isinstance(batches, BatchPrefetcher):
+                batches.close()
+
+    def _batches(self, dataset, batch_size):
+        """
+        Returns an iterator over the `batches_per_iter` batches of one
+        epoch, prefetched in the background if requested.
+        """
+        transform = None
+        if not self.topo:
+            get_batch = dataset.get_batch_design
+        elif self.prefetch > 0 and isinstance(dataset, DenseDesignMatrix):
+            # Draw design matrix batches under the prefetcher's lock and
+            # let the producer threads do the view conversion in
+            # parallel.
+            get_batch = dataset.get_batch_design
+            transform = dataset.view_converter.design_mat_to_topo_view
         else:
-            return self.termination_criterion(self.model)
+            get_batch = dataset.get_batch_topo
+        batches = (get_batch(batch_size)
+                   for i in xrange(self.batches_per_iter))
+        if self.prefetch > 0:
+            batches = BatchPrefetcher(batches, depth=self.prefetch,
+                                      num_threads=self.prefetch_threads,
+                                      dtype=config.floatX,
+                                      transform=transform)
+        return batches
 
 
 class UnsupervisedExhaustiveSGD(TrainingAlgorithm):
     def __init__(self, learning_rate, cost, batch_size=None,
                  monitoring_batches=None, monitoring_dataset=None,
-                 termination_criterion=None, update_callbacks=None):
+                 termination_criterion=None, update_callbacks=None,
+                 prefetch=0, prefetch_threads=1, resident=False,
+                 resident_budget=None, steps_per_call=1,
+                 check_finite_every=100):
+        """
+        Instantiates an UnsupervisedExhaustiveSGD object, which makes
+        one sequential pass over the dataset per epoch.
+
+        See `SGD` for the meaning of the parameters.
+        """
         self.learning_rate = float(learning_rate)
         self.cost = cost
         self.batch_size = batch_size
@@ -214,6 +493,14 @@ class UnsupervisedExhaustiveSGD(TrainingAlgorithm):
         self.monitoring_batches = monitoring_batches
         self.termination_criterion = termination_criterion
         self._register_update_callbacks(update_callbacks)
+        self.prefetch = prefetch
+        self.prefetch_threads = prefetch_threads
+        self.resident = resident
+        self.resident_budget = resident_budget
+        if steps_per_call > 1 and not resident:
+            raise ValueError("steps_per_call > 1 requires resident=True")
+        self.steps_per_call = steps_per_call
+        self.check_finite_every = check_finite_every
         self.first = True
 
     def setup(self, model, dataset):
@@ -228,41 +515,21 @@ class UnsupervisedExhaustiveSGD(TrainingAlgorithm):
                                  batch_size=self.batch_size)
         dataset.set_iteration_scheme('sequential', batch_size=self.batch_size)
         X = T.matrix(name="%s[X]" % self.__class__.__name__)
-        try:
-            iter(self.cost)
-            iterable_cost = True
-        except TypeError:
-            iterable_cost = False
-        if iterable_cost:
-            cost_value = sum(c(model, X) for c in self.cost)
-        else:
-            cost_value = self.cost(model, X)
-        if cost_value.name is None:
-            cost_value.name = 'sgd_cost(' + X.name + ')'
+        cost_value, params, updates, learning_rate = _sgd_updates(model,
+                                                                  self.cost,
+                                                                  X)
         self.monitor.add_channel(name=cost_value.name, ipt=X, val=cost_value)
-        params = model.get_params()
-        for i, param in enumerate(params):
-            if param.name is None:
-                param.name = 'sgd_params[%d]' % i
-        grads = dict(zip(params, T.grad(cost_value, params)))
-        for param in grads:
-            if grads[param].name is None:
-                grads[param].name = ('grad(%(costname)s, %(paramname)s)' %
-                                     {'costname': cost_value.name,
-                                      'paramname': param.name})
-        learning_rate = T.scalar('sgd_learning_rate')
-        updates = dict(zip(params, [param - learning_rate * grads[param]
-                                    for param in params]))
-        for param in updates:
-            if updates[param].name is None:
-                updates[param].name = 'sgd_update(' + param.name + ')'
-        model.censor_updates(updates)
-        for param in updates:
-            if updates[param] is None:
-                updates[param].name = 'censor(sgd_update(' + param.name + '))'
-
-        self.sgd_update = function([X, learning_rate], updates=updates,
-                                   name='sgd_update')
+        self.finite_check = FiniteCheck(params, self.check_finite_every,
+                                        self.monitor.batches_seen)
+        self.finite_check.add_updates(updates)
+        if self.resident:
+            self.resident_data = ResidentData(dataset,
+                                              budget=self.resident_budget)
+        else:
+            self.resident_data = None
+        self.sgd_update, self.sgd_update_multi = _compile_sgd_update(
+            X, learning_rate, updates, self.resident_data,
+            self.steps_per_call)
         self.params = params
 
     def train(self, dataset):
@@ -283,24 +550,42 @@ class UnsupervisedExhaustiveSGD(TrainingAlgorithm):
                             # TODO: more informative assertion error
                             "invalid force_batch_size attribute"
                         )
-        for param in self.params:
-            value = param.get_value(borrow=True)
-            if np.any(np.isnan(value)) or np.any(np.isinf(value)):
-                raise Exception("NaN in " + param.name)
         self.first = False
-        dataset.set_iteration_scheme('sequential', batch_size=self.batch_size)
-        for batch in dataset:
-            grads = self.sgd_update(batch, self.learning_rate)
-            #print grads
-            self.monitor.batches_seen += 1
-            self.monitor.examples_seen += batch_size
-            for callback in self.update_callbacks:
-                callback(self)
+        if self.resident:
+            chunk_batches = self.resident_data.sequential_batches(batch_size)
+            _resident_epoch(self, chunk_batches, batch_size,
+                            self.update_callbacks)
+        else:
+            self._train_batches(dataset, batch_size)
+        self.finite_check.check()
         if self.termination_criterion is None:
             return True
         else:
             return self.termination_criterion(self.model)
 
+    def _train_batches(self, dataset, batch_size):
+        """
+        Runs the epoch's updates on batches passed from the host.
+        """
+        dataset.set_iteration_scheme('sequential', batch_size=self.batch_size)
+        batches = iter(dataset)
+        if self.prefetch > 0:
+            batches = BatchPrefetcher(batches, depth=self.prefetch,
+                                      num_threads=self.prefetch_threads,
+                                      dtype=config.floatX)
+        try:
+            for batch in self._timed(batches):
+                grads = self.sgd_update(batch, self.learning_rate)
+                #print grads
+                self.finite_check.batches_done()
+                self.monitor.batches_seen += 1
+                self.monitor.examples_seen += batch_size
+                for callback in self.update_callbacks:
+                    callback(self)
+        finally:
+            if isinstance(batches, BatchPrefetcher):
+                batches.close()
+
 
 class MonitorBasedLRAdjuster(object):
     """
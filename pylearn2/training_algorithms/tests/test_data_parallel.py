@@ -0,0 +1,60 @@
+"""Tests for synchronous data-parallel SGD"""
+import numpy as np
+from theano import config
+
+from pylearn2.autoencoder import Autoencoder
+from pylearn2.costs.autoencoder import MeanSquaredReconstructionError
+from pylearn2.datasets.dense_design_matrix import DenseDesignMatrix
+from pylearn2.training_algorithms.data_parallel import DataParallelSGD
+from pylearn2.training_algorithms.sgd import SGD
+
+
+def _train(make_algorithm, epochs=2):
+    """
+    Trains a small autoencoder, always initialized and fed with the same
+    batches, and returns its parameter values.
+    """
+    rng = np.random.RandomState([1,2,3])
+    X = rng.randn(40, 5).astype(config.floatX)
+    dataset = DenseDesignMatrix(X=X, rng=[4,5,6])
+    model = Autoencoder(5, 3, act_enc='tanh', act_dec=None, irange=.1,
+                        rng=rng)
+    algorithm = make_algorithm(learning_rate=.05,
+                               cost=MeanSquaredReconstructionError(),
+                               batch_size=8, batches_per_iter=5)
+    algorithm.setup(model=model, dataset=dataset)
+    try:
+        for i in xrange(epochs):
+            algorithm.train(dataset)
+    finally:
+        if hasattr(algorithm, 'close'):
+            algorithm.close()
+    return [param.get_value() for param in model.get_params()]
+
+
+def _check_matches_sgd(**kwargs):
+    expected = _train(SGD)
+    def make_algorithm(**sgd_kwargs):
+        sgd_kwargs.update(kwargs)
+        return DataParallelSGD(**sgd_kwargs)
+    values = _train(make_algorithm)
+    initial = _train(SGD, epochs=0)
+    assert any(np.any(x != y) for x, y in zip(expected, initial))
+    # The gradients are computed by a separate function and, with
+    # several workers, averaged over slices of the batch, so they only
+    # match those of SGD up to float rounding.
+    for x, y in zip(values, expected):
+        assert x.dtype == y.dtype
+        assert np.allclose(x, y, rtol=1e-4, atol=1e-5)
+
+
+def test_tcp_worker_matches_sgd():
+    #tests that one localhost worker over tcp applies the same updates
+    #as plain SGD on the same batches
+    _check_matches_sgd(num_workers=1, transport='tcp')
+
+
+def test_shared_memory_workers_match_sgd():
+    #tests that averaging the gradients of two workers on halves of
+    #each batch gives the updates of plain SGD on the whole batch
+    _check_matches_sgd(num_workers=2, transport='shared_memory')
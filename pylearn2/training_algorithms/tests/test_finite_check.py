@@ -0,0 +1,54 @@
+"""Tests for the check for non-finite parameters compiled into SGD"""
+import numpy as np
+from theano import config
+
+from pylearn2.autoencoder import Autoencoder
+from pylearn2.costs.autoencoder import MeanSquaredReconstructionError
+from pylearn2.datasets.dense_design_matrix import DenseDesignMatrix
+from pylearn2.training_algorithms.sgd import UnsupervisedExhaustiveSGD
+
+
+def _train(bad_example=None, **kwargs):
+    """
+    Trains a small autoencoder for one epoch of 8 sequential batches of
+    5 examples, the example `bad_example` being inf if given.
+    """
+    rng = np.random.RandomState([1,2,3])
+    X = rng.randn(40, 5).astype(config.floatX)
+    if bad_example is not None:
+        X[bad_example] = np.inf
+    dataset = DenseDesignMatrix(X=X)
+    model = Autoencoder(5, 3, act_enc='tanh', act_dec=None, irange=.1,
+                        rng=rng)
+    algorithm = UnsupervisedExhaustiveSGD(
+        learning_rate=.05, cost=MeanSquaredReconstructionError(),
+        batch_size=5, check_finite_every=0, **kwargs)
+    algorithm.setup(model=model, dataset=dataset)
+    return model, algorithm, dataset
+
+
+def test_finite_check():
+    #tests that the error names the first non-finite parameter and the
+    #batch producing it, whether batches are passed from the host or
+    #resident, one or several steps per call, and that finite training
+    #doesn't raise
+    for kwargs in [{}, {'resident': True},
+                   {'resident': True, 'steps_per_call': 4}]:
+        model, algorithm, dataset = _train(**kwargs)
+        algorithm.train(dataset)
+        for param in model.get_params():
+            assert np.all(np.isfinite(param.get_value()))
+
+        # Example 17 is in batch 3, in the first call of 4 steps.
+        model, algorithm, dataset = _train(bad_example=17, **kwargs)
+        try:
+            algorithm.train(dataset)
+        except Exception, e:
+            message = str(e)
+        else:
+            assert False, "non-finite parameters went unnoticed"
+        assert 'batch 3' in message, message
+        check = algorithm.finite_check
+        bad_param = check.checked[int(check.bad_param.get_value())]
+        assert 'NaN or inf in %s,' % bad_param.name in message, message
+        assert not np.all(np.isfinite(bad_param.get_value()))
@@ -0,0 +1,38 @@
+"""Tests for lock-free multi-process SGD"""
+import numpy as np
+from theano import config
+
+from pylearn2.autoencoder import Autoencoder
+from pylearn2.costs.autoencoder import MeanSquaredReconstructionError
+from pylearn2.datasets.dense_design_matrix import DenseDesignMatrix
+from pylearn2.training_algorithms.hogwild import HogwildSGD
+
+
+def test_hogwild_sgd():
+    #tests that two forked workers write their updates into the shared
+    #parameters, which keep their shapes and dtypes
+    rng = np.random.RandomState([1,2,3])
+    dataset = DenseDesignMatrix(X=rng.randn(50, 5).astype(config.floatX))
+    model = Autoencoder(5, 3, act_enc='tanh', act_dec=None, irange=.1,
+                        rng=rng)
+    algorithm = HogwildSGD(learning_rate=.01,
+                           cost=MeanSquaredReconstructionError(),
+                           num_workers=2, batch_size=5, batches_per_iter=20)
+    before = [param.get_value() for param in model.get_params()]
+    algorithm.setup(model=model, dataset=dataset)
+    try:
+        for param, value in zip(algorithm.updated_params,
+                                algorithm.shared_values):
+            assert param.get_value(borrow=True) is value
+        assert algorithm.train(dataset)
+        assert model.monitor.batches_seen == 20
+        assert model.monitor.examples_seen == 100
+    finally:
+        algorithm.close()
+    after = [param.get_value() for param in model.get_params()]
+    # The training process doesn't apply any update itself.
+    assert any(np.any(x != y) for x, y in zip(before, after))
+    for x, y in zip(before, after):
+        assert x.shape == y.shape
+        assert x.dtype == y.dtype
+        assert np.all(np.isfinite(y))
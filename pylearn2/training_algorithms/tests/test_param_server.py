@@ -0,0 +1,95 @@
+"""Tests for asynchronous SGD with a parameter server"""
+import numpy as np
+from theano import config, shared
+
+from pylearn2.autoencoder import Autoencoder
+from pylearn2.costs.autoencoder import MeanSquaredReconstructionError
+from pylearn2.datasets.dense_design_matrix import DenseDesignMatrix
+from pylearn2.training_algorithms import param_server
+from pylearn2.training_algorithms.param_server import (ParameterServer,
+                                                       ParameterServerSGD)
+from pylearn2.utils import wire
+
+
+def test_staleness_bound():
+    #tests that a gradient is applied as long as its parameters are at
+    #most max_staleness updates old, and rejected after that
+    param = shared(np.zeros(3, dtype=config.floatX))
+    pushed = []
+    server = ParameterServer([param], pushed.append, max_staleness=1)
+    server.start()
+    sock = wire.connect(server.address)
+    try:
+        server.allow(10)
+        wire.send_arrays(sock, [], param_server._PULL)
+        tag, arrays = wire.recv_arrays(sock)
+        assert tag == param_server._PARAMS
+        assert int(arrays[0]) == 0
+        grad = np.ones(3, dtype=config.floatX)
+        for expected_tag in [param_server._ACK, param_server._ACK,
+                             param_server._REJECTED]:
+            wire.send_arrays(sock, [np.array(0, dtype='int64'), grad],
+                             param_server._PUSH)
+            tag, arrays = wire.recv_arrays(sock)
+            assert tag == expected_tag
+        assert int(arrays[0]) == 2
+        assert server.num_accepted == 2
+        assert server.num_rejected == 1
+        assert server.max_applied_staleness == 1
+        assert len(pushed) == 2
+    finally:
+        sock.close()
+        server.stop()
+
+
+def test_stop():
+    #tests that stop() ends the accept loop and that workers are told
+    #to stop at their next request
+    server = ParameterServer([shared(np.zeros(2))], lambda grads: None)
+    server.start()
+    thread = server._thread
+    sock = wire.connect(server.address)
+    try:
+        # Makes sure the connection was accepted before stopping.
+        wire.send_arrays(sock, [], param_server._PULL)
+        tag, arrays = wire.recv_arrays(sock)
+        assert tag == param_server._PARAMS
+        server.stop()
+        assert not thread.is_alive()
+        wire.send_arrays(sock, [], param_server._PULL)
+        tag, arrays = wire.recv_arrays(sock)
+        assert tag == param_server._STOP
+    finally:
+        sock.close()
+
+
+def test_parameter_server_sgd():
+    #tests that two local workers train the model's parameters, and
+    #that the server applies exactly batches_per_iter of their
+    #gradients per epoch without exceeding the staleness bound
+    rng = np.random.RandomState([1,2,3])
+    dataset = DenseDesignMatrix(X=rng.randn(50, 5).astype(config.floatX))
+    model = Autoencoder(5, 3, act_enc='tanh', act_dec=None, irange=.1,
+                        rng=rng)
+    algorithm = ParameterServerSGD(learning_rate=.01,
+                                   cost=MeanSquaredReconstructionError(),
+                                   num_workers=2, max_staleness=1,
+                                   batch_size=5, batches_per_iter=20)
+    algorithm.setup(model=model, dataset=dataset)
+    try:
+        before = [param.get_value() for param in model.get_params()]
+        server = algorithm.server
+        assert algorithm.train(dataset)
+        assert server.num_accepted == 20
+        assert server.version == 20
+        assert model.monitor.batches_seen == 20
+        assert server.max_applied_staleness <= 1
+        after = [param.get_value() for param in model.get_params()]
+        assert any(np.any(x != y) for x, y in zip(before, after))
+        for x, y in zip(before, after):
+            assert x.shape == y.shape
+            assert np.all(np.isfinite(y))
+    finally:
+        algorithm.close()
+    assert algorithm.server is None
+    assert server._thread is None
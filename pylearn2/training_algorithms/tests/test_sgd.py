@@ -0,0 +1,139 @@
+"""Tests for the resident, multi-step and sparse updates of SGD"""
+import numpy as np
+from scipy import sparse
+from theano import config
+
+from pylearn2.autoencoder import Autoencoder
+from pylearn2.costs.autoencoder import MeanSquaredReconstructionError
+from pylearn2.datasets.dense_design_matrix import DenseDesignMatrix
+from pylearn2.datasets.sparse_design_matrix import SparseDesignMatrix
+from pylearn2.training_algorithms.resident import ResidentData
+from pylearn2.training_algorithms.sgd import SGD, UnsupervisedExhaustiveSGD
+
+
+def _train(cls, **kwargs):
+    """
+    Trains a small autoencoder for one epoch on resident data, always
+    initialized and fed with the same batches, and returns its parameter
+    values.
+    """
+    rng = np.random.RandomState([1,2,3])
+    X = rng.randn(40, 5).astype(config.floatX)
+    dataset = DenseDesignMatrix(X=X, rng=[4,5,6])
+    model = Autoencoder(5, 3, act_enc='tanh', act_dec=None, irange=.1,
+                        rng=rng)
+    algorithm = cls(learning_rate=.05, cost=MeanSquaredReconstructionError(),
+                    batch_size=5, resident=True, **kwargs)
+    algorithm.setup(model=model, dataset=dataset)
+    algorithm.train(dataset)
+    assert model.monitor.batches_seen == 8
+    assert model.monitor.examples_seen == 40
+    return [param.get_value() for param in model.get_params()]
+
+
+def _check_steps_per_call(cls, **kwargs):
+    expected = _train(cls, steps_per_call=1, **kwargs)
+    # 8 batches: two calls of 4 steps, or two calls of 3 steps and
+    # 2 single steps.
+    for steps in [4, 3]:
+        values = _train(cls, steps_per_call=steps, **kwargs)
+        for x, y in zip(values, expected):
+            assert np.allclose(x, y, rtol=1e-5, atol=1e-6)
+
+
+def test_steps_per_call_random_batches():
+    #tests that steps_per_call=k applies the same updates as k single
+    #steps on the same random resident batches
+    _check_steps_per_call(SGD, batches_per_iter=8)
+
+
+def test_steps_per_call_sequential_batches():
+    #tests that steps_per_call=k applies the same updates as k single
+    #steps on the same sequential resident batches
+    _check_steps_per_call(UnsupervisedExhaustiveSGD)
+
+
+def test_resident_chunks():
+    #tests that with a budget smaller than the dataset, the resident
+    #chunks are swapped so that every example is seen once per
+    #sequential epoch
+    X = np.arange(200).reshape(40, 5).astype(config.floatX)
+    dataset = DenseDesignMatrix(X=X)
+    itemsize = np.dtype(config.floatX).itemsize
+    resident = ResidentData(dataset, budget=12 * 5 * itemsize)
+    assert resident.chunk_size == 12
+    seen = []
+    for batches in resident.sequential_batches(5):
+        data = resident.data.get_value()
+        assert len(data) <= 12
+        seen.extend(data[start:stop] for start, stop in batches)
+    assert np.all(np.concatenate(seen) == X)
+
+
+def _train_exhaustive(epochs=2, **kwargs):
+    rng = np.random.RandomState([1,2,3])
+    X = rng.randn(40, 5).astype(config.floatX)
+    dataset = DenseDesignMatrix(X=X)
+    model = Autoencoder(5, 3, act_enc='tanh', act_dec=None, irange=.1,
+                        rng=rng)
+    algorithm = UnsupervisedExhaustiveSGD(
+        learning_rate=.05, cost=MeanSquaredReconstructionError(),
+        batch_size=5, **kwargs)
+    algorithm.setup(model=model, dataset=dataset)
+    for i in xrange(epochs):
+        algorithm.train(dataset)
+    assert model.monitor.batches_seen == 8 * epochs
+    assert model.monitor.examples_seen == 40 * epochs
+    return [param.get_value() for param in model.get_params()]
+
+
+def test_resident_budget():
+    #tests that training on chunks of resident data, swapped in as the
+    #epochs go, gives the updates of batches passed from the host
+    itemsize = np.dtype(config.floatX).itemsize
+    expected = _train_exhaustive()
+    for steps in [1, 2]:
+        values = _train_exhaustive(resident=True,
+                                   resident_budget=10 * 5 * itemsize,
+                                   steps_per_call=steps)
+        for x, y in zip(values, expected):
+            assert np.allclose(x, y, rtol=1e-5, atol=1e-6)
+
+def _train_sparse(X, sparse_input):
+    """
+    Trains a small autoencoder with SGD for one epoch on X, sparse or
+    dense, and returns its parameter values and monitored costs.
+    """
+    if sparse_input:
+        dataset = SparseDesignMatrix(sparse.csr_matrix(X), rng=[4,5,6])
+    else:
+        dataset = DenseDesignMatrix(X=X, rng=[4,5,6])
+    model = Autoencoder(30, 4, act_enc='tanh', act_dec=None, irange=.1,
+                        rng=[1,2,3], sparse_input=sparse_input)
+    algorithm = SGD(learning_rate=.05, cost=MeanSquaredReconstructionError(),
+                    batch_size=5, batches_per_iter=8,
+                    monitoring_dataset=dataset, monitoring_batches=8)
+    algorithm.setup(model=model, dataset=dataset)
+    before = [param.get_value() for param in model.get_params()]
+    model.monitor()
+    algorithm.train(dataset)
+    model.monitor()
+    after = [param.get_value() for param in model.get_params()]
+    assert any(np.any(x != y) for x, y in zip(before, after))
+    costs = [channel.val_record for channel in model.monitor.channels.values()]
+    assert len(costs) == 1
+    return after, costs[0]
+
+
+def test_sparse_sgd():
+    #tests that training on sparse batches compiles and gives the
+    #updates and costs of training on the same batches in dense form
+    rng = np.random.RandomState([1,2,3])
+    X = (rng.randn(40, 30) *
+         (rng.uniform(size=(40, 30)) < .1)).astype(config.floatX)
+    values, costs = _train_sparse(X, True)
+    expected_values, expected_costs = _train_sparse(X, False)
+    assert np.allclose(costs, expected_costs, rtol=1e-4)
+    for x, y in zip(values, expected_values):
+        assert x.shape == y.shape
+        assert np.allclose(x, y, rtol=1e-4, atol=1e-6)
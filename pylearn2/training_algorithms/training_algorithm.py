@@ -3,6 +3,13 @@ class TrainingAlgorithm(object):
     An abstract superclass that defines the interface of training
     algorithms.
     """
+    # Attributes saved in checkpoints, so that training can be resumed.
+    # Subclasses with more state should extend this list.
+    resume_attributes = ['learning_rate', 'update_callbacks',
+                         'termination_criterion', 'first']
+    # A pylearn2.utils.timing.TrainingTimer set by Train, if any.
+    timer = None
+
     def _register_update_callbacks(self, update_callbacks):
         if update_callbacks is None:
             update_callbacks = []
@@ -14,6 +21,15 @@ class TrainingAlgorithm(object):
         except TypeError:
             self.update_callbacks = [update_callbacks]
 
+    def _timed(self, batches):
+        """
+        Returns `batches`, an iterable of batches, instrumented so that
+        the time spent fetching them is reported to `timer`.
+        """
+        if self.timer is None:
+            return batches
+        return self.timer.timed(batches)
+
     def setup(self, model, dataset):
         """
         Initialize the given training algorithm.
@@ -52,3 +68,26 @@ class TrainingAlgorithm(object):
             `False` if the algorithm has converged.
         """
         raise NotImplementedError()
+
+    def get_resume_state(self):
+        """
+        Returns the state needed to resume training after a restart, as
+        a picklable dictionary. By default, the attributes listed in
+        `resume_attributes`.
+
+        Notes
+        -----
+        Called between epochs. The model and the dataset are saved
+        separately; compiled functions are rebuilt by `setup`.
+        """
+        return dict((name, getattr(self, name))
+                    for name in self.resume_attributes
+                    if hasattr(self, name))
+
+    def set_resume_state(self, state):
+        """
+        Restores a state returned by `get_resume_state`. Called before
+        `setup`.
+        """
+        for name, value in state.items():
+            setattr(self, name, value)
@@ -0,0 +1,254 @@
+"""
+Checkpoints holding everything needed to resume an interrupted run of
+`pylearn2.scripts.train.Train`: the model (with its monitor and its
+records), a snapshot of the model's parameters, the state of the
+training algorithm and its callbacks, the Train object's epoch count
+and callbacks, and the position of the dataset's random example stream.
+
+Checkpoints are written by a background thread so that training
+doesn't wait for the disk. The parameters are copied, and the model
+(without its parameter values) and the rest of the training state are
+pickled, before the thread starts, so that later updates, including
+those of the monitor's counters and records, can't leak into the
+checkpoint. Each checkpoint is first written to a
+temporary file, then renamed over the previous one, so an interruption
+never leaves a partial checkpoint behind.
+"""
+import cPickle
+import cStringIO
+import os
+import sys
+import threading
+import time
+import warnings
+
+# Format of the checkpoint files, checked when loading.
+CHECKPOINT_VERSION = 2
+
+
+class CheckpointWriter(object):
+    """
+    Writes checkpoints of a Train object in a background thread, one at
+    a time.
+    """
+    def __init__(self):
+        self._thread = None
+        self._error = None
+
+    def write(self, path, train, finished=False):
+        """
+        Snapshots the training state of `train` and starts writing it
+        to `path`. Waits for the previous write to finish first.
+
+        Parameters
+        ----------
+        path : str
+            Path of the checkpoint file.
+        train : Train
+            The Train object to checkpoint.
+        finished : bool, optional
+            Whether `train.main_loop` is done. Resuming from a finished
+            checkpoint doesn't train any further.
+        """
+        self.wait()
+        checkpoint = snapshot(train, finished)
+        self._thread = threading.Thread(target=self._write,
+                                        args=(path, checkpoint),
+                                        name='CheckpointWriter')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def wait(self):
+        """
+        Waits until the pending write, if any, is done. Raises an
+        exception if it failed.
+        """
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise Exception("writing the checkpoint failed: " + error)
+
+    def _write(self, path, checkpoint):
+        try:
+            t1 = time.time()
+            save_atomically(path, checkpoint)
+            print 'checkpoint written to %s in %.2f seconds' % (
+                path, time.time() - t1)
+        except Exception, e:
+            self._error = '%s: %s' % (type(e).__name__, str(e))
+
+
+def snapshot(train, finished=False):
+    """
+    Returns a checkpoint of `train`, a dictionary which can be pickled
+    later on while training goes on.
+    """
+    model = train.model
+    # Copies, so that the checkpoint holds the values of this moment.
+    params = [param.get_value(borrow=False) for param in model.get_params()]
+    # The model is pickled now, since the monitor's counters and records
+    # change as soon as training goes on. Its parameter values are left
+    # out and replaced by references to the copies above, so that the
+    # slow part of the pickling still happens in the background. (Values
+    # which aren't ndarrays, e.g. on the GPU, are pickled now.)
+    value_ids = dict((id(param.get_value(borrow=True)), str(i))
+                     for i, param in enumerate(model.get_params()))
+    model = dumps(model, lambda obj: value_ids.get(id(obj)))
+    state = {'epochs': train.epochs,
+             'callbacks': train.callbacks,
+             'finished': finished,
+             'algorithm': None,
+             'dataset_position': None}
+    if train.algorithm is not None:
+        state['algorithm'] = train.algorithm.get_resume_state()
+    if hasattr(train.dataset, 'get_stream_position'):
+        state['dataset_position'] = train.dataset.get_stream_position()
+    state = dumps(state)
+    return {'version': CHECKPOINT_VERSION,
+            'model': model,
+            'params': params,
+            'state': state}
+
+
+def dumps(obj, persistent_id=None):
+    """
+    Returns `obj` pickled to a string, see `dump`.
+    """
+    f = cStringIO.StringIO()
+    dump(obj, f, persistent_id)
+    return f.getvalue()
+
+
+def dump(obj, f, persistent_id=None):
+    """
+    Pickles `obj` to the file `f`, raising the recursion limit if
+    needed.
+
+    Parameters
+    ----------
+    obj : object
+        The object to pickle.
+    f : file
+        A file open for writing, which must support seek and truncate.
+    persistent_id : callable, optional
+        Set as the persistent_id of the pickler, see the pickle module.
+    """
+    def pickle():
+        pickler = cPickle.Pickler(f, cPickle.HIGHEST_PROTOCOL)
+        if persistent_id is not None:
+            pickler.persistent_id = persistent_id
+        pickler.dump(obj)
+    try:
+        pickle()
+    except RuntimeError, e:
+        # Large Theano graphs can exceed the recursion limit,
+        # see pylearn2.utils.serial.save.
+        if str(e).find('recursion') == -1:
+            raise
+        old_limit = sys.getrecursionlimit()
+        try:
+            sys.setrecursionlimit(50000)
+            f.seek(0)
+            f.truncate()
+            pickle()
+        finally:
+            sys.setrecursionlimit(old_limit)
+
+
+def save_atomically(path, obj):
+    """
+    Pickles `obj` to a temporary file next to `path`, then renames it to
+    `path`.
+    """
+    directory = os.path.dirname(path) or '.'
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    tmp_path = path + '.tmp'
+    try:
+        with open(tmp_path, 'wb') as f:
+            dump(obj, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmp_path, path)
+    except:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def load_checkpoint(path):
+    """
+    Loads a checkpoint written by `CheckpointWriter`.
+
+    Returns
+    -------
+    checkpoint : dict
+        'model' is the model, with the snapshotted parameter values,
+        and 'state' the rest of the training state.
+    """
+    with open(path, 'rb') as f:
+        checkpoint = cPickle.load(f)
+    if checkpoint.get('version') != CHECKPOINT_VERSION:
+        raise ValueError("%s is not a checkpoint in a supported format" %
+                         path)
+    params = checkpoint['params']
+    unpickler = cPickle.Unpickler(cStringIO.StringIO(checkpoint['model']))
+    unpickler.persistent_load = lambda pid: params[int(pid)]
+    model = unpickler.load()
+    return {'model': model,
+            'state': cPickle.loads(checkpoint['state'])}
+
+
+def resume(train, path):
+    """
+    Restores the training state of `train` from the checkpoint at
+    `path`. Must be called before `train.main_loop`.
+
+    Returns
+    -------
+    finished : bool
+        Whether the checkpointed run had already finished.
+    """
+    checkpoint = load_checkpoint(path)
+    state = checkpoint['state']
+    model = checkpoint['model']
+    if hasattr(train.model, 'dataset_yaml_src'):
+        model.dataset_yaml_src = train.model.dataset_yaml_src
+    train.model = model
+    train.epochs = state['epochs']
+    train.callbacks = state['callbacks']
+    if state['algorithm'] is not None:
+        if train.algorithm is None:
+            warnings.warn("the checkpoint has a training algorithm state "
+                          "but the Train object has no algorithm")
+        else:
+            train.algorithm.set_resume_state(state['algorithm'])
+    if state['dataset_position'] is not None:
+        train.dataset.set_stream_position(state['dataset_position'])
+    if train.algorithm is not None and hasattr(model, 'monitor'):
+        # The algorithm's setup adds its channels again; their records
+        # are carried over by Train.main_loop.
+        train.resumed_channels = model.monitor.channels
+        model.monitor.channels = {}
+        model.monitor.dirty = True
+    print 'resumed from %s after %d epochs' % (path, train.epochs)
+    return state['finished']
+
+
+def restore_channel_records(monitor, channels):
+    """
+    Copies the records of `channels`, the channels of a resumed
+    monitor, into the channels of the same name of `monitor`.
+    """
+    for name, channel in monitor.channels.items():
+        if name in channels:
+            old = channels[name]
+            channel.val_record = old.val_record
+            channel.batch_record = old.batch_record
+            channel.example_record = old.example_record
+    for name in channels:
+        if name not in monitor.channels:
+            warnings.warn("monitoring channel %s was not recreated after "
+                          "resuming, its records are lost" % name)
@@ -0,0 +1,375 @@
+"""
+A persistent, on-disk cache of compiled Theano functions.
+
+`cached_function` is a replacement for `theano.function` (for the
+arguments pylearn2 uses) that stores the optimized graph of every
+function it compiles in the directory named by the
+PYLEARN2_FUNCTION_CACHE environment variable. When the same function is
+requested again, in this process or another one, graph optimization is
+skipped altogether and the C code of the ops is found in Theano's own
+compiledir cache. This makes restarts, multi-phase YAML runs and
+hyperparameter sweeps much cheaper for models whose functions take long
+to compile. When PYLEARN2_FUNCTION_CACHE is not set, `cached_function`
+just calls `theano.function`.
+
+Functions are keyed by a structural hash of their graph: the ops and
+constants, the types of the inputs and shared variables, the outputs,
+updates and givens, together with floatX, the compilation mode and the
+Theano version. Names and values of variables are not part of the key.
+The values of shared variables are not stored either: a cached function
+is bound to the caller's shared variables, matched by their position in
+the graph.
+
+Hits, misses and the compilation time saved are logged (at the INFO
+level) and accumulated in `statistics`. The time taken to compile or
+load every function is also reported to `pylearn2.utils.timing`.
+"""
+import copy
+import cPickle
+import hashlib
+import logging
+import os
+import sys
+import tempfile
+import time
+import numpy
+import theano
+from theano import config
+from theano.compile.function_module import FunctionMaker
+from theano.compile.mode import Mode, get_mode
+from theano.compile.sharedvalue import SharedVariable
+from theano.gof import graph, Constant
+from pylearn2.utils.timing import record_compile
+
+log = logging.getLogger(__name__)
+
+# Running totals for this process.
+statistics = {'hits': 0, 'misses': 0, 'saved_seconds': 0.}
+
+
+class _Uncacheable(Exception):
+    """Raised when a function can't be keyed or stored reliably."""
+
+
+def cached_function(inputs, outputs=None, updates=None, givens=None,
+                    mode=None, name=None):
+    """
+    Compiles a Theano function, going through the on-disk cache if
+    PYLEARN2_FUNCTION_CACHE is set.
+
+    Parameters
+    ----------
+    inputs : list
+        The explicit input variables.
+    outputs : Variable or list, optional
+        The output(s), as for `theano.function`.
+    updates : dict or list of pairs, optional
+        Maps shared variables to their new values.
+    givens : dict or list of pairs, optional
+        Substitutions applied to the graph before compiling.
+    mode : str or Mode, optional
+        The compilation mode. Defaults to config.mode.
+    name : str, optional
+        Name of the function, used in log messages.
+
+    Returns
+    -------
+    f : theano function
+        The compiled function, equivalent to the one `theano.function`
+        would return.
+    """
+    label = name or 'anonymous function'
+
+    def compile_function():
+        t1 = time.time()
+        f = theano.function(inputs, outputs, mode=mode,
+                            updates=updates or [], givens=givens or [],
+                            name=name)
+        record_compile(label, time.time() - t1)
+        return f
+
+    cache_dir = os.environ.get('PYLEARN2_FUNCTION_CACHE')
+    if not cache_dir:
+        return compile_function()
+    try:
+        key, shared = _function_key(inputs, outputs, updates, givens, mode)
+    except _Uncacheable, e:
+        log.info('not caching %s: %s', label, e)
+        return compile_function()
+    path = os.path.join(cache_dir, key + '.pkl')
+
+    if os.path.exists(path):
+        t1 = time.time()
+        try:
+            f, compile_time = _load(path, shared, mode, name)
+        except Exception, e:
+            log.warning('could not load %s from the function cache (%s), '
+                        'recompiling', label, e)
+        else:
+            load_time = time.time() - t1
+            record_compile(label, load_time)
+            statistics['hits'] += 1
+            statistics['saved_seconds'] += max(compile_time - load_time, 0.)
+            log.info('function cache hit for %s: loaded in %.2f seconds '
+                     'instead of compiling in %.2f seconds', label,
+                     load_time, compile_time)
+            return f
+
+    t1 = time.time()
+    f = compile_function()
+    compile_time = time.time() - t1
+    statistics['misses'] += 1
+    log.info('function cache miss for %s: compiled in %.2f seconds', label,
+             compile_time)
+    try:
+        _store(path, f, inputs, shared, compile_time)
+    except Exception, e:
+        log.warning('could not store %s in the function cache: %s', label, e)
+    return f
+
+
+class _Signature(object):
+    """
+    Accumulates a textual description of a graph in which variables are
+    numbered in the order they are first visited, so that two graphs
+    with the same structure get the same description.
+    """
+    def __init__(self, inputs, digests):
+        self.ids = {}
+        self.lines = []
+        self.shared = []
+        # Digests of ops and constants, shared between signatures.
+        self.digests = digests
+        for var in inputs:
+            if not isinstance(var, theano.Variable):
+                raise _Uncacheable('input %s is not a Variable' % str(var))
+            self._add(var, 'input %s' % var.type)
+
+    def _add(self, var, line):
+        self.ids[var] = len(self.ids)
+        self.lines.append(line)
+
+    def _digest(self, obj):
+        key = id(obj)
+        if key not in self.digests:
+            if isinstance(obj, numpy.ndarray):
+                data = '%s %s %s' % (obj.dtype.str, obj.shape,
+                                     numpy.ascontiguousarray(obj).tostring())
+            else:
+                try:
+                    data = cPickle.dumps(obj, 2)
+                except Exception, e:
+                    raise _Uncacheable('could not pickle %s: %s' %
+                                       (str(obj), e))
+            # Keep obj alive so that its id isn't reused.
+            self.digests[key] = (hashlib.sha1(data).hexdigest(), obj)
+        return self.digests[key][0]
+
+    def visit(self, root):
+        """Describes `root` and everything it depends on, returns its id."""
+        stack = [root]
+        while stack:
+            var = stack[-1]
+            if var in self.ids:
+                stack.pop()
+                continue
+            node = var.owner
+            if node is None:
+                stack.pop()
+                if isinstance(var, SharedVariable):
+                    self.shared.append(var)
+                    self._add(var, 'shared %s' % var.type)
+                elif isinstance(var, Constant):
+                    self._add(var, 'constant %s %s' %
+                              (var.type, self._digest(var.data)))
+                else:
+                    raise _Uncacheable('%s is neither an input, a shared '
+                                       'variable nor a constant' % str(var))
+                continue
+            missing = [x for x in node.inputs if x not in self.ids]
+            if missing:
+                stack.extend(reversed(missing))
+                continue
+            stack.pop()
+            self.lines.append('apply %s %s' %
+                              (self._digest(node.op),
+                               ' '.join(str(self.ids[x])
+                                        for x in node.inputs)))
+            for out in node.outputs:
+                self._add(out, 'output %s' % out.type)
+        return self.ids[root]
+
+    def digest(self):
+        return hashlib.sha1('\n'.join(self.lines)).hexdigest()
+
+
+def _function_key(inputs, outputs, updates, givens, mode):
+    """
+    Returns the cache key of a function and the shared variables it
+    uses, in the order the key numbers them.
+    """
+    if outputs is None:
+        outputs = []
+    unpack_single = not isinstance(outputs, (list, tuple))
+    if unpack_single:
+        outputs = [outputs]
+    outputs = list(outputs)
+    if updates is None:
+        updates = []
+    elif hasattr(updates, 'items'):
+        updates = updates.items()
+    pairs = []
+    for var, value in updates:
+        if not isinstance(value, theano.Variable):
+            value = theano.tensor.as_tensor_variable(value)
+        pairs.append((var, value))
+    if givens:
+        cloned = theano.clone(outputs + [value for var, value in pairs],
+                              replace=dict(givens))
+        outputs = cloned[:len(outputs)]
+        pairs = zip([var for var, value in pairs], cloned[len(outputs):])
+
+    # Order the updates by their own structure, and by name between
+    # structurally identical ones, so that the key doesn't depend on
+    # the order of a dict.
+    digests = {}
+    ranked = []
+    for var, value in pairs:
+        signature = _Signature(inputs, digests)
+        signature.visit(value)
+        signature.visit(var)
+        ranked.append(((signature.digest(), var.name), var, value))
+    ranked.sort(key=lambda item: item[0])
+    for i in xrange(1, len(ranked)):
+        if ranked[i][0] == ranked[i - 1][0]:
+            raise _Uncacheable('ambiguous order of the updates of %s' %
+                               str(ranked[i][1]))
+
+    signature = _Signature(inputs, digests)
+    for out in outputs:
+        signature.lines.append('result %d' % signature.visit(out))
+    updated = set()
+    for rank, var, value in ranked:
+        updated.add(var)
+        signature.lines.append('update %d %d' % (signature.visit(var),
+                                                 signature.visit(value)))
+    # theano.function also applies the default updates of the shared
+    # variables it finds (e.g. random number generator states).
+    i = 0
+    while i < len(signature.shared):
+        var = signature.shared[i]
+        default = getattr(var, 'default_update', None)
+        if default is not None and var not in updated:
+            signature.lines.append('default_update %d %d' %
+                                   (i, signature.visit(default)))
+        i += 1
+
+    if mode is None:
+        mode = config.mode
+    header = [theano.__version__, sys.version, config.floatX, config.device,
+              config.optimizer, config.linker, str(mode), str(unpack_single)]
+    if not isinstance(mode, basestring) and type(mode) is not Mode:
+        raise _Uncacheable('unsupported mode %s' % str(mode))
+    key = hashlib.sha1('\n'.join(header + signature.lines)).hexdigest()
+    return key, signature.shared
+
+
+def _clone_optimized_graph(env):
+    """
+    Clones the optimized graph of a compiled function, replacing its
+    inputs (including shared variables) by new, value-less variables.
+    """
+    equiv = dict((var, var.type(name=var.name)) for var in env.inputs)
+    for node in graph.io_toposort(env.inputs, env.outputs):
+        for var in node.inputs:
+            if var not in equiv:
+                equiv[var] = var.clone()
+        new_node = node.clone_with_new_inputs([equiv[var]
+                                               for var in node.inputs])
+        equiv.update(zip(node.outputs, new_node.outputs))
+    for var in env.outputs:
+        if var not in equiv:
+            equiv[var] = var.clone()
+    return equiv
+
+
+def _store(path, f, inputs, shared, compile_time):
+    maker = f.maker
+    env = maker.env
+    if len(getattr(maker, 'expanded_inputs', maker.inputs)) != \
+            len(maker.inputs):
+        raise _Uncacheable('symbolic input kits are not supported')
+    input_index = dict((var, i) for i, var in enumerate(inputs))
+    shared_index = dict((var, i) for i, var in enumerate(shared))
+    equiv = _clone_optimized_graph(env)
+    # The optimized graph computes the outputs, then the updates in the
+    # order of the inputs they update.
+    num_outputs = len(maker.outputs)
+    new_updates = iter([equiv[var] for var in env.outputs[num_outputs:]])
+    input_specs = []
+    bindings = []
+    for spec, var in zip(maker.inputs, env.inputs):
+        if spec.variable in input_index:
+            binding = ('input', input_index[spec.variable])
+        elif spec.variable in shared_index:
+            binding = ('shared', shared_index[spec.variable])
+        else:
+            raise _Uncacheable('unknown input %s' % str(spec.variable))
+        spec = copy.copy(spec)
+        spec.variable = equiv[var]
+        if spec.update is not None:
+            spec.update = next(new_updates)
+        if binding[0] == 'shared':
+            # The container is provided by the caller's shared variable.
+            spec.value = None
+        input_specs.append(spec)
+        bindings.append(binding)
+    output_specs = []
+    for spec, var in zip(maker.outputs, env.outputs):
+        spec = copy.copy(spec)
+        spec.variable = equiv[var]
+        output_specs.append(spec)
+    entry = {'inputs': input_specs,
+             'outputs': output_specs,
+             'bindings': bindings,
+             'unpack_single': maker.unpack_single,
+             'compile_time': compile_time}
+    directory = os.path.dirname(path)
+    if not os.path.isdir(directory):
+        try:
+            os.makedirs(directory)
+        except OSError:
+            # Another process may have created it in the meantime.
+            if not os.path.isdir(directory):
+                raise
+    # Write to a temporary file then rename it, so that concurrent
+    # processes never see a partial entry.
+    fd, tmp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            cPickle.dump(entry, f, 2)
+        os.rename(tmp_path, path)
+    except:
+        os.remove(tmp_path)
+        raise
+
+
+def _load(path, shared, mode, name):
+    with open(path, 'rb') as f:
+        entry = cPickle.load(f)
+    defaults = []
+    for spec, (kind, index) in zip(entry['inputs'], entry['bindings']):
+        if kind == 'shared':
+            defaults.append(shared[index].container)
+        else:
+            defaults.append(spec.value)
+    # The stored graph is already optimized.
+    mode = Mode(linker=get_mode(mode).linker, optimizer=None)
+    outputs = entry['outputs']
+    if entry['unpack_single']:
+        outputs = outputs[0]
+    maker = FunctionMaker(entry['inputs'], outputs, mode,
+                          accept_inplace=True)
+    f = maker.create(defaults)
+    f.name = name
+    return f, entry['compile_time']
@@ -36,7 +36,8 @@ class SequentialSubsetIterator(SubsetIterator):
         self.dataset_size = dataset_size
         if batch_size is None:
             if num_batches is not None:
-                batch_size = numpy.ceil(self.dataset_size / num_batches)
+                batch_size = int(numpy.ceil(self.dataset_size /
+                                            num_batches))
             else:
                 raise ValueError("need one of batch_size, num_batches "
                                  "for sequential batch iteration")
@@ -123,10 +124,76 @@ class RandomSliceSubsetIterator(RandomUniformSubsetIterator):
     stochastic = True
 
 
+class ShuffledSequentialSubsetIterator(SequentialSubsetIterator):
+    """
+    Visits every example once per epoch, in the order of a random
+    permutation drawn when the iterator is created. The permutation only
+    depends on the state of `rng` at that point, so that saving the
+    dataset's stream position before an epoch is enough to replay it.
+    """
+    def __init__(self, dataset_size, batch_size, num_batches, rng=None):
+        super(ShuffledSequentialSubsetIterator, self).__init__(dataset_size,
+                                                               batch_size,
+                                                               num_batches)
+        self.batch_size = int(self.batch_size)
+        if rng is not None and hasattr(rng, 'random_integers'):
+            self._rng = rng
+        else:
+            self._rng = numpy.random.RandomState(rng)
+        self._order = self._permutation()
+
+    def _permutation(self):
+        return self._rng.permutation(self.dataset_size)
+
+    def next(self):
+        if self.current >= self.dataset_size:
+            raise StopIteration()
+        else:
+            self._last = self._order[self.current:
+                                     self.current + self.batch_size]
+            self.current += self.batch_size
+            return self._last
+
+    fancy = True
+    stochastic = True
+
+
+class BlockShuffledSubsetIterator(ShuffledSequentialSubsetIterator):
+    """
+    Visits every example once per epoch, in an order that is close to a
+    random permutation but reads the dataset in contiguous blocks: the
+    blocks of `block_size` consecutive examples are visited in random
+    order, and the examples are then shuffled within windows of
+    `window_blocks` blocks. A batch thus only touches a few contiguous
+    ranges of examples, which keeps reads near sequential on
+    memory-mapped or HDF5 data.
+
+    `block_size` defaults to the batch size. Subclass to change the
+    defaults, e.g. to match the chunks of an HDF5 file.
+    """
+    block_size = None
+    window_blocks = 4
+
+    def _permutation(self):
+        block_size = int(self.block_size or self.batch_size)
+        num_blocks = -(-self.dataset_size // block_size)
+        blocks = self._rng.permutation(num_blocks)
+        order = (blocks[:, numpy.newaxis] * block_size +
+                 numpy.arange(block_size)).ravel()
+        order = order[order < self.dataset_size]
+        window = block_size * self.window_blocks
+        for start in xrange(0, self.dataset_size, window):
+            # Shuffles the view in place.
+            self._rng.shuffle(order[start:start + window])
+        return order
+
+
 _iteration_schemes = {
     'sequential': SequentialSubsetIterator,
     'random_slice': RandomSliceSubsetIterator,
     'random_uniform': RandomUniformSubsetIterator,
+    'shuffled_sequential': ShuffledSequentialSubsetIterator,
+    'block_shuffled': BlockShuffledSubsetIterator,
 }
 
 
@@ -140,17 +207,117 @@ def resolve_iterator_class(mode):
     return subset_iter_class
 
 
+def shard_range(dataset_size, shard_index, num_shards):
+    """
+    Returns the (start, stop) range of the examples in shard
+    `shard_index` out of `num_shards`. Shards are contiguous, disjoint,
+    cover the dataset and their sizes differ by at most one example.
+    """
+    if num_shards < 1 or not 0 <= shard_index < num_shards:
+        raise ValueError("invalid shard %s of %s" % (str(shard_index),
+                                                     str(num_shards)))
+    size, extra = divmod(dataset_size, num_shards)
+    start = shard_index * size + min(shard_index, extra)
+    stop = start + size + (1 if shard_index < extra else 0)
+    return start, stop
+
+
+class ShardedSubsetIterator(SubsetIterator):
+    """
+    Runs one of the mode iterators over the examples of a single shard
+    of the dataset (see `shard_range`), and offsets the slices or
+    indices it returns, so that batches only ever touch that shard.
+
+    Every process of a distributed run uses its own shard. Shards don't
+    change across epochs, while the order within them is drawn from
+    `rng`, so that seeding it identically in every process shuffles all
+    of them consistently.
+    """
+    def __init__(self, subset_iterator_class, dataset_size, batch_size,
+                 num_batches, rng, shard_index, num_shards):
+        self.start, self.stop = shard_range(dataset_size, shard_index,
+                                            num_shards)
+        self.dataset_size = self.stop - self.start
+        self._iterator = subset_iterator_class(self.dataset_size,
+                                               batch_size, num_batches, rng)
+        self.fancy = subset_iterator_class.fancy
+        self.stochastic = subset_iterator_class.stochastic
+
+    def next(self):
+        index = self._iterator.next()
+        if isinstance(index, slice):
+            start, stop, step = index.indices(self.dataset_size)
+            return slice(self.start + start, self.start + stop, step)
+        return numpy.asarray(index) + self.start
+
+
+def make_subset_iterator(mode, dataset_size, batch_size, num_batches, rng,
+                         shard_index=None, num_shards=None):
+    """
+    Instantiates the subset iterator for `mode` (see
+    `resolve_iterator_class`), restricted to shard `shard_index` of
+    `num_shards` if they are given.
+    """
+    subset_iter_class = resolve_iterator_class(mode)
+    if num_shards is None:
+        if shard_index is not None:
+            raise ValueError("shard_index given without num_shards")
+        return subset_iter_class(dataset_size, batch_size, num_batches, rng)
+    if shard_index is None:
+        raise ValueError("num_shards given without shard_index")
+    return ShardedSubsetIterator(subset_iter_class, dataset_size,
+                                 batch_size, num_batches, rng,
+                                 shard_index, num_shards)
+
+
 class FiniteDatasetIterator(object):
     """A thin wrapper around one of the mode iterators."""
-    def __init__(self, dataset, subset_iterator, topo=False, targets=False):
+    def __init__(self, dataset, subset_iterator, topo=False, targets=False,
+                 buffers=0):
+        """
+        Parameters
+        ----------
+        dataset : object
+            The dataset to iterate over.
+        subset_iterator : object
+            One of the mode iterators, returning slices or index
+            sequences on every call to next().
+        topo : bool, optional
+            Whether to return batches in a topological view.
+        targets : bool, optional
+            Whether to return (batch, targets) pairs.
+        buffers : int, optional
+            If 0, each batch is a new array. Otherwise, batches are
+            views into a ring of `buffers` arrays owned by the iterator,
+            so that a batch is overwritten `buffers` batches later. Use
+            this when each batch is done with before the next ones are
+            requested, e.g. when it is passed to a Theano function.
+        """
         self._topo = topo
         self._targets = targets
         self._dataset = dataset
         self._subset_iterator = subset_iterator
-        # TODO: More thought about how to handle things where this
-        # fails (gigantic HDF5 files, etc.)
+        self._convert = None
+        self._dequantize = None
+        if getattr(self._dataset, 'quantized', None) is not None:
+            # Only dequantize the batches.
+            self._dequantize = self._dataset.dequantize
         if self._topo:
-            self._raw_data = self._dataset.get_topological_view()
+            X = getattr(self._dataset, 'X', None)
+            view_converter = getattr(self._dataset, 'view_converter', None)
+            if isinstance(X, numpy.ndarray) and view_converter is not None:
+                # Convert batch by batch rather than materializing the
+                # topological view of the whole dataset, which would be
+                # a copy of it and, for a memory-mapped design matrix,
+                # would load it into memory. With DefaultViewConverter
+                # the batches are views of the design matrix batches.
+                self._raw_data = X
+                self._convert = view_converter.design_mat_to_topo_view
+            else:
+                self._raw_data = self._dataset.get_topological_view()
+                self._dequantize = None
+        elif self._dequantize is not None:
+            self._raw_data = self._dataset.X
         else:
             self._raw_data = self._dataset.get_design_matrix()
         if self._targets:
@@ -158,15 +325,69 @@ class FiniteDatasetIterator(object):
             if self._raw_targets is None:
                 raise ValueError("Can't iterate with targets=True on a "
                                  "dataset object with no targets")
+        self._buffers = [None] * buffers
+        self._next_buffer = 0
+        self._gather_buffer = None
 
     def __iter__(self):
         return self
 
+    def _output(self, size):
+        """Returns a floatX array for a batch of `size` examples."""
+        shape = (size,) + self._raw_data.shape[1:]
+        if not self._buffers:
+            return numpy.empty(shape, dtype=config.floatX)
+        i = self._next_buffer
+        self._next_buffer = (i + 1) % len(self._buffers)
+        buf = self._buffers[i]
+        if buf is None or buf.shape[0] < size:
+            buf = numpy.empty(shape, dtype=config.floatX)
+            self._buffers[i] = buf
+        return buf[:size]
+
+    def _gather(self, index, out):
+        """
+        Copies the examples at `index` into `out`, casting them to
+        floatX, without allocating memory in the steady state.
+        """
+        num_examples = self._raw_data.shape[0]
+        if len(index) > 0 and (index.min() < -num_examples or
+                               index.max() >= num_examples):
+            raise IndexError("example index out of range for a dataset of "
+                             "%d examples" % num_examples)
+        if len(index) > 0 and index.min() < 0:
+            index = index % num_examples
+        # numpy.take buffers `out` in its default 'raise' mode, and
+        # can't cast: gather into a buffer of the data's own dtype when
+        # it isn't floatX, and cast while copying it into `out`.
+        if self._raw_data.dtype == out.dtype:
+            numpy.take(self._raw_data, index, axis=0, out=out, mode='clip')
+        else:
+            buf = self._gather_buffer
+            if buf is None or buf.shape[0] < len(index):
+                buf = numpy.empty(out.shape, dtype=self._raw_data.dtype)
+                self._gather_buffer = buf
+            buf = buf[:len(index)]
+            numpy.take(self._raw_data, index, axis=0, out=buf, mode='clip')
+            out[...] = buf
+
     def next(self):
         next_index = self._subset_iterator.next()
-        # TODO: handle fancy-index copies by allocating a buffer and
-        # using numpy.take()
-        features = numpy.cast[config.floatX](self._raw_data[next_index])
+        # Indexing a numpy.memmap only reads the batch from disk.
+        if isinstance(next_index, slice):
+            size = len(xrange(*next_index.indices(self._raw_data.shape[0])))
+            features = self._output(size)
+            features[...] = self._raw_data[next_index]
+        elif getattr(self._subset_iterator, 'fancy', False):
+            index = numpy.asarray(next_index)
+            features = self._output(len(index))
+            self._gather(index, features)
+        else:
+            features = numpy.cast[config.floatX](self._raw_data[next_index])
+        if self._dequantize is not None:
+            features = self._dequantize(features)
+        if self._convert is not None:
+            features = self._convert(features)
         if self._targets:
             return features, self._raw_targets[next_index]
         else:
@@ -0,0 +1,174 @@
+"""
+Background prefetching of minibatches.
+
+Building a minibatch (slicing the design matrix, casting it to floatX,
+converting it to a topological view) is pure numpy work that otherwise
+sits between consecutive calls to a compiled update. `BatchPrefetcher`
+moves that work into producer threads so that it overlaps with the
+update. Most of the numpy operations involved release the GIL.
+"""
+import Queue
+import sys
+import threading
+import numpy
+
+
+# Sentinel put on the ready queue by a producer thread whose source is
+# exhausted.
+_DONE = object()
+
+
+class _Failure(object):
+    """Wraps the exc_info of an exception raised in a producer thread."""
+    def __init__(self, exc_info):
+        self.exc_info = exc_info
+
+
+class BatchPrefetcher(object):
+    """
+    An iterator that prepares the batches of another iterator ahead of
+    time, in background threads, and hands them out from a ring of
+    preallocated buffers.
+
+    A batch returned by `next()` is only valid until the following call
+    to `next()`: at that point its buffer is handed back to the producer
+    threads and will be overwritten. Consumers that need to keep a batch
+    around must copy it.
+    """
+    def __init__(self, source, depth=2, num_threads=1, dtype=None,
+                 transform=None):
+        """
+        Starts the producer threads.
+
+        Parameters
+        ----------
+        source : iterable
+            Iterable yielding the batches (ndarrays) to prefetch. It is
+            only ever advanced by one thread at a time, so it does not
+            need to be thread-safe.
+        depth : int, optional
+            Maximum number of batches prepared ahead of the consumer.
+            With `depth=1` this is plain double buffering: one buffer is
+            being consumed while the other one is being filled.
+        num_threads : int, optional
+            Number of producer threads. With more than one thread,
+            batches may be delivered in a different order than the one
+            in which `source` yields them.
+        dtype : str or dtype, optional
+            If given, batches are cast to this dtype while being copied
+            into their buffer. Defaults to the dtype of each batch.
+        transform : callable, optional
+            A function applied to every batch before it is copied into
+            its buffer (e.g. a design matrix to topological view
+            conversion). It is called outside of the lock protecting
+            `source`, so several threads can run it concurrently.
+        """
+        if depth < 1:
+            raise ValueError("depth must be at least 1, got %d" % depth)
+        if num_threads < 1:
+            raise ValueError("num_threads must be at least 1, got %d" %
+                             num_threads)
+        self._source = iter(source)
+        self._dtype = dtype
+        self._transform = transform
+        self._source_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._ready = Queue.Queue()
+        self._free = Queue.Queue()
+        # One buffer per batch prepared ahead, plus the one held by the
+        # consumer. Buffers are allocated lazily, once the shape of the
+        # batches is known.
+        for i in xrange(depth + 1):
+            self._free.put(None)
+        self._in_use = None
+        self._num_threads = num_threads
+        self._num_done = 0
+        self._exhausted = False
+        self._threads = []
+        for i in xrange(num_threads):
+            thread = threading.Thread(target=self._produce,
+                                      name='BatchPrefetcher-%d' % i)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        if self._in_use is not None:
+            self._free.put(self._in_use)
+            self._in_use = None
+        while not self._exhausted:
+            item = self._get(self._ready)
+            if item is _DONE:
+                self._num_done += 1
+                if self._num_done == self._num_threads:
+                    self._exhausted = True
+            elif isinstance(item, _Failure):
+                self.close()
+                raise item.exc_info[0], item.exc_info[1], item.exc_info[2]
+            else:
+                self._in_use, batch = item
+                return batch
+        raise StopIteration()
+
+    def close(self):
+        """
+        Stops the producer threads. Batches already prepared are
+        discarded.
+        """
+        self._stop.set()
+        self._exhausted = True
+
+    def _get(self, queue):
+        """
+        Blocking get that still wakes up regularly, so that a stopped
+        prefetcher (or a KeyboardInterrupt in the consumer) is noticed.
+        Returns None if the prefetcher was stopped while waiting on a
+        producer-side queue.
+        """
+        while True:
+            try:
+                return queue.get(True, 0.1)
+            except Queue.Empty:
+                if queue is self._free and self._stop.is_set():
+                    return None
+
+    def _produce(self):
+        while not self._stop.is_set():
+            buf = self._get(self._free)
+            if self._stop.is_set():
+                return
+            try:
+                with self._source_lock:
+                    batch = self._source.next()
+                if self._transform is not None:
+                    batch = self._transform(batch)
+                item = self._fill(buf, batch)
+            except StopIteration:
+                # Hand the buffer back so that the other producers can
+                # also reach the end of the source.
+                self._free.put(buf)
+                self._ready.put(_DONE)
+                return
+            except Exception:
+                self._ready.put(_Failure(sys.exc_info()))
+                return
+            self._ready.put(item)
+
+    def _fill(self, buf, batch):
+        """
+        Copies `batch` into `buf`, reallocating `buf` if it cannot hold
+        the batch. Returns the buffer and the view of it holding the
+        batch, which is smaller than the buffer for a short final batch.
+        """
+        batch = numpy.asarray(batch)
+        dtype = numpy.dtype(self._dtype or batch.dtype)
+        if (buf is None or buf.dtype != dtype or
+                buf.shape[1:] != batch.shape[1:] or
+                buf.shape[0] < batch.shape[0]):
+            buf = numpy.empty(batch.shape, dtype=dtype)
+        view = buf[:batch.shape[0]]
+        view[...] = batch
+        return buf, view
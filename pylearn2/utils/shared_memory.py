@@ -0,0 +1,72 @@
+"""
+Numpy arrays backed by anonymous shared memory.
+
+The memory is mapped with MAP_SHARED, so processes forked after the
+arrays are created (e.g. by `multiprocessing` on Unix) see each other's
+writes to them.
+"""
+import mmap
+import numpy
+
+# Alignment, in bytes, of each array within the shared region. Keeps
+# arrays on separate cache lines.
+_ALIGNMENT = 64
+
+
+def shared_arrays(specs):
+    """
+    Allocates arrays in a single anonymous shared memory region.
+
+    Parameters
+    ----------
+    specs : list
+        A list of (shape, dtype) pairs, one per array to allocate.
+
+    Returns
+    -------
+    arrays : list
+        A list of zero-initialized ndarrays with the requested shapes
+        and dtypes. They keep the shared region alive.
+    """
+    offsets = []
+    total = 0
+    for shape, dtype in specs:
+        total = (total + _ALIGNMENT - 1) // _ALIGNMENT * _ALIGNMENT
+        offsets.append(total)
+        total += int(numpy.prod(shape)) * numpy.dtype(dtype).itemsize
+    region = mmap.mmap(-1, max(total, 1))
+    arrays = []
+    for (shape, dtype), offset in zip(specs, offsets):
+        array = numpy.frombuffer(region, dtype=dtype,
+                                 count=int(numpy.prod(shape)),
+                                 offset=offset)
+        arrays.append(array.reshape(shape))
+    return arrays
+
+
+def share_values(shared_variables):
+    """
+    Moves the values of Theano shared variables into shared memory.
+
+    The variables are made to hold (with `borrow=True`) arrays backed by
+    a shared memory region, initialized with their current values.
+    Updates applied in place to the returned arrays in any forked
+    process are seen by the variables of every process.
+
+    Parameters
+    ----------
+    shared_variables : list
+        Theano shared variables with numpy array values (i.e. not on
+        the GPU).
+
+    Returns
+    -------
+    arrays : list
+        The shared memory arrays now held by the variables, in order.
+    """
+    values = [var.get_value(borrow=True) for var in shared_variables]
+    arrays = shared_arrays([(value.shape, value.dtype) for value in values])
+    for var, value, array in zip(shared_variables, values, arrays):
+        array[...] = value
+        var.set_value(array, borrow=True)
+    return arrays
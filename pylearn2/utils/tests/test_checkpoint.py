@@ -0,0 +1,138 @@
+"""Tests for resumable training checkpoints"""
+import cPickle
+import os
+import shutil
+import tempfile
+import numpy as np
+from theano import config
+
+from pylearn2.autoencoder import Autoencoder
+from pylearn2.costs.autoencoder import MeanSquaredReconstructionError
+from pylearn2.datasets.dense_design_matrix import DenseDesignMatrix
+from pylearn2.monitor import MonitorChannel
+from pylearn2.scripts.train import Train
+from pylearn2.training_algorithms.sgd import (EpochCounter,
+                                              UnsupervisedExhaustiveSGD)
+from pylearn2.utils.checkpoint import (load_checkpoint, save_atomically,
+                                       snapshot)
+
+
+class _Interrupted(Exception):
+    pass
+
+
+class _Interrupt(object):
+    """
+    Train callback raising _Interrupted on its `calls`-th call, as if the
+    job had been killed. Disarmed when pickled into a checkpoint.
+    """
+    def __init__(self, calls):
+        self.calls = calls
+
+    def __call__(self, model, dataset, algorithm):
+        if self.calls is None:
+            return
+        self.calls -= 1
+        if self.calls == 0:
+            raise _Interrupted()
+
+    def __getstate__(self):
+        return {'calls': None}
+
+
+def _train(checkpoint_path, interrupt_at=None):
+    rng = np.random.RandomState([1,2,3])
+    dataset = DenseDesignMatrix(X=rng.randn(40, 5).astype(config.floatX))
+    model = Autoencoder(5, 3, act_enc='tanh', act_dec=None, irange=.1,
+                        rng=rng)
+    algorithm = UnsupervisedExhaustiveSGD(
+        learning_rate=.1, cost=MeanSquaredReconstructionError(),
+        batch_size=10, monitoring_batches=2, monitoring_dataset=dataset,
+        termination_criterion=EpochCounter(max_epochs=4))
+    callbacks = []
+    if interrupt_at is not None:
+        callbacks.append(_Interrupt(interrupt_at))
+    return Train(dataset=dataset, model=model, algorithm=algorithm,
+                 callbacks=callbacks, checkpoint_path=checkpoint_path)
+
+
+def _records(train):
+    return dict((name, (channel.val_record, channel.batch_record,
+                        channel.example_record))
+                for name, channel in train.model.monitor.channels.items())
+
+
+def test_resume_channel_records():
+    #tests that a run interrupted after its second checkpoint, then
+    #resumed, ends with the channel records of an uninterrupted run
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        train = _train(os.path.join(tmp_dir, 'full.pkl'))
+        train.main_loop()
+        expected = _records(train)
+
+        path = os.path.join(tmp_dir, 'resumed.pkl')
+        train = _train(path, interrupt_at=3)
+        try:
+            train.main_loop()
+        except _Interrupted:
+            pass
+        else:
+            assert False, "the run was not interrupted"
+        train = _train(path)
+        assert not train.resume()
+        assert train.epochs == 2
+        train.main_loop()
+        records = _records(train)
+
+        assert sorted(records) == sorted(expected)
+        for name in expected:
+            val_record, batch_record, example_record = records[name]
+            assert np.allclose(val_record, expected[name][0])
+            assert batch_record == expected[name][1]
+            assert example_record == expected[name][2]
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+def test_snapshot_is_frozen():
+    #tests that updates of the parameters and of the monitor made after
+    #a snapshot, while it is being written, don't leak into it
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        train = _train(None)
+        train.algorithm.setup(model=train.model, dataset=train.dataset)
+        train.model.monitor()
+        params = [param.get_value() for param in train.model.get_params()]
+        checkpoint = snapshot(train)
+
+        monitor = train.model.monitor
+        monitor.batches_seen += 4
+        monitor.examples_seen += 40
+        for channel in monitor.channels.values():
+            channel.val_record.append(0.)
+        for param in train.model.get_params():
+            param.set_value(param.get_value() + 1.)
+
+        path = os.path.join(tmp_dir, 'checkpoint.pkl')
+        save_atomically(path, checkpoint)
+        model = load_checkpoint(path)['model']
+        assert model.monitor.batches_seen == 0
+        assert model.monitor.examples_seen == 0
+        for channel in model.monitor.channels.values():
+            assert len(channel.val_record) == 1
+        for param, value in zip(model.get_params(), params):
+            assert np.all(param.get_value() == value)
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+def test_unpickle_channel_without_batch_record():
+    #tests that channels pickled before batch_record was saved still
+    #load, with one batch record per value
+    channel = MonitorChannel.__new__(MonitorChannel)
+    channel.__setstate__({'val_record': [1., 2.],
+                          'example_record': [10, 20]})
+    channel = cPickle.loads(cPickle.dumps(channel))
+    assert channel.batch_record == [None, None]
+    assert channel.example_record == [10, 20]
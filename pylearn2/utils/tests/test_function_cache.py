@@ -0,0 +1,41 @@
+"""Tests for the on-disk compiled function cache"""
+import os
+import shutil
+import tempfile
+import numpy as np
+from theano import config
+import theano.tensor as T
+from pylearn2.utils import sharedX
+from pylearn2.utils import function_cache
+from pylearn2.utils.function_cache import cached_function
+
+
+def test_cached_function_hit():
+    cache_dir = tempfile.mkdtemp()
+    old = os.environ.get('PYLEARN2_FUNCTION_CACHE')
+    os.environ['PYLEARN2_FUNCTION_CACHE'] = cache_dir
+    try:
+        def make():
+            W = sharedX(np.zeros((3, 2)), name='W')
+            X = T.matrix()
+            lr = T.scalar()
+            cost = T.sqr(T.dot(X, W) - 1.).sum()
+            updates = {W: W - lr * T.grad(cost, W)}
+            return W, cached_function([X, lr], cost, updates=updates)
+
+        X = np.ones((4, 3), dtype=config.floatX)
+        W1, f1 = make()
+        hits = function_cache.statistics['hits']
+        W2, f2 = make()
+        assert function_cache.statistics['hits'] == hits + 1
+        for i in xrange(3):
+            assert np.allclose(f1(X, 0.01), f2(X, 0.01))
+        # The cached function updates its own shared variable.
+        assert np.allclose(W1.get_value(), W2.get_value())
+        assert not np.allclose(W2.get_value(), 0.)
+    finally:
+        if old is None:
+            del os.environ['PYLEARN2_FUNCTION_CACHE']
+        else:
+            os.environ['PYLEARN2_FUNCTION_CACHE'] = old
+        shutil.rmtree(cache_dir)
@@ -0,0 +1,73 @@
+import copy
+import numpy as np
+
+from pylearn2.utils.iteration import (
+    SequentialSubsetIterator,
+    ShuffledSequentialSubsetIterator,
+    BlockShuffledSubsetIterator,
+    make_subset_iterator,
+    resolve_iterator_class,
+    shard_range
+)
+
+
+def test_shuffled_iteration():
+    #tests that each example is visited once per epoch, and that the
+    #order is replayed from a copy of the rng state
+    for mode in ['shuffled_sequential', 'block_shuffled']:
+        rng = np.random.RandomState([1,2,3])
+        saved = copy.copy(rng)
+        cls = resolve_iterator_class(mode)
+        batches = list(cls(103, 10, None, rng))
+        assert len(batches) == 11
+        assert len(batches[-1]) == 3
+        order = np.concatenate(batches)
+        assert np.all(np.sort(order) == np.arange(103))
+        assert not np.all(order == np.arange(103))
+        replayed = np.concatenate(list(cls(103, 10, None, saved)))
+        assert np.all(order == replayed)
+        # The next epoch uses another order.
+        assert not np.all(np.concatenate(list(cls(103, 10, None, rng))) ==
+                          order)
+
+
+def test_block_shuffled_locality():
+    #tests that a batch only touches the blocks of its window
+    rng = np.random.RandomState([1,2,3])
+    iterator = BlockShuffledSubsetIterator(1000, 10, None, rng)
+    for batch in iterator:
+        blocks = np.unique(batch // 10)
+        assert len(blocks) <= iterator.window_blocks
+    assert ShuffledSequentialSubsetIterator.fancy
+
+
+def test_sharded_iteration():
+    #tests that shards are disjoint and cover the dataset, and that the
+    #batches of a shard stay inside it
+    ranges = [shard_range(103, i, 4) for i in xrange(4)]
+    assert ranges == [(0, 26), (26, 52), (52, 78), (78, 103)]
+    seen = []
+    for i, (start, stop) in enumerate(ranges):
+        batches = list(make_subset_iterator('sequential', 103, 10, None,
+                                            None, i, 4))
+        assert batches[0] == slice(start, start + 10, 1)
+        assert batches[-1].stop == stop
+        seen.extend(range(103)[batch] for batch in batches)
+        for mode, num_batches in [('shuffled_sequential', None),
+                                  ('random_uniform', 3)]:
+            rng = np.random.RandomState([1,2,3])
+            for batch in make_subset_iterator(mode, 103, 5, num_batches,
+                                              rng, i, 4):
+                assert np.all((batch >= start) & (batch < stop))
+    assert sorted(sum(seen, [])) == range(103)
+
+
+def test_sequential_num_batches():
+    #tests that a sequential iterator given only num_batches yields
+    #integer slices covering the dataset, which index arrays
+    batches = list(SequentialSubsetIterator(103, None, 10))
+    assert len(batches) == 10
+    assert batches[0] == slice(0, 11)
+    assert batches[-1].stop >= 103
+    X = np.arange(103)
+    assert np.all(np.concatenate([X[batch] for batch in batches]) == X)
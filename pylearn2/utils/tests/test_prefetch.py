@@ -0,0 +1,48 @@
+"""Tests for the background batch prefetcher."""
+import numpy as np
+from pylearn2.utils.prefetch import BatchPrefetcher
+
+
+def test_prefetch_order_and_cast():
+    rng = np.random.RandomState([1, 2, 3])
+    batches = [rng.randn(4, 3) for i in xrange(7)]
+    prefetcher = BatchPrefetcher(iter(batches), depth=2, dtype='float32')
+    seen = []
+    for batch in prefetcher:
+        assert batch.dtype == 'float32'
+        # batches are only valid until the next call to next()
+        seen.append(batch.copy())
+    assert len(seen) == len(batches)
+    for batch, expected in zip(seen, batches):
+        assert np.allclose(batch, expected)
+
+
+def test_prefetch_short_last_batch():
+    X = np.arange(20.).reshape(10, 2)
+    source = (X[i:i + 4] for i in xrange(0, 10, 4))
+    shapes = [batch.shape for batch in BatchPrefetcher(source, depth=1)]
+    assert shapes == [(4, 2), (4, 2), (2, 2)]
+
+
+def test_prefetch_transform_multithreaded():
+    batches = [np.ones((2, 3)) * i for i in xrange(20)]
+    prefetcher = BatchPrefetcher(iter(batches), depth=3, num_threads=3,
+                                 transform=lambda b: b.reshape(2, 3, 1))
+    values = []
+    for batch in prefetcher:
+        assert batch.shape == (2, 3, 1)
+        values.append(batch[0, 0, 0])
+    assert sorted(values) == range(20)
+
+
+def test_prefetch_propagates_errors():
+    def source():
+        yield np.zeros((2, 2))
+        raise ValueError('broken source')
+    prefetcher = BatchPrefetcher(source())
+    prefetcher.next()
+    try:
+        prefetcher.next()
+    except ValueError:
+        return
+    assert False
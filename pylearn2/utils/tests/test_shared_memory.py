@@ -0,0 +1,56 @@
+"""Tests for the numpy arrays backed by shared memory"""
+import multiprocessing
+import numpy as np
+from theano import shared
+
+from pylearn2.utils.shared_memory import shared_arrays, share_values
+
+
+def _write(arrays):
+    for i, array in enumerate(arrays):
+        array[...] = i + 1
+
+
+def test_shared_arrays():
+    #tests the shapes, dtypes and alignment of the arrays, and that
+    #writes from a forked process are seen by its parent
+    specs = [((3, 4), 'float32'), ((5,), 'int64'), ((2, 3), 'float64'),
+             ((), 'uint8')]
+    arrays = shared_arrays(specs)
+    assert len(arrays) == len(specs)
+    for array, (shape, dtype) in zip(arrays, specs):
+        assert array.shape == shape
+        assert array.dtype == np.dtype(dtype)
+        assert np.all(array == 0)
+    assert arrays[1].ctypes.data % 64 == 0
+    process = multiprocessing.Process(target=_write, args=(arrays,))
+    process.start()
+    process.join()
+    assert process.exitcode == 0
+    for i, array in enumerate(arrays):
+        assert np.all(array == i + 1)
+
+
+def _add_one(shared_variables):
+    for var in shared_variables:
+        var.get_value(borrow=True)[...] += 1
+
+
+def test_share_values():
+    #tests that the variables keep their values once moved into shared
+    #memory, and that in-place updates by a forked process are seen by
+    #the variables of its parent
+    rng = np.random.RandomState([1,2,3])
+    values = [rng.randn(3, 2).astype('float32'), np.arange(4.)]
+    variables = [shared(value.copy()) for value in values]
+    arrays = share_values(variables)
+    for var, array, value in zip(variables, arrays, values):
+        assert var.get_value(borrow=True) is array
+        assert array.dtype == value.dtype
+        assert np.all(var.get_value() == value)
+    process = multiprocessing.Process(target=_add_one, args=(variables,))
+    process.start()
+    process.join()
+    assert process.exitcode == 0
+    for var, value in zip(variables, values):
+        assert np.allclose(var.get_value(), value + 1)
@@ -0,0 +1,70 @@
+"""Tests for the timing instrumentation of training runs"""
+import json
+import os
+import shutil
+import tempfile
+import numpy as np
+from theano import config
+
+from pylearn2.autoencoder import Autoencoder
+from pylearn2.costs.autoencoder import MeanSquaredReconstructionError
+from pylearn2.datasets.dense_design_matrix import DenseDesignMatrix
+from pylearn2.scripts.train import Train
+from pylearn2.training_algorithms.sgd import (EpochCounter,
+                                              UnsupervisedExhaustiveSGD)
+from pylearn2.utils import timing
+from pylearn2.utils.timing import TrainingTimer, record_compile
+
+
+def test_train_timing():
+    #tests that Train writes one record per epoch next to save_path,
+    #with the phases, counts and compilation times of that epoch
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        rng = np.random.RandomState([1,2,3])
+        dataset = DenseDesignMatrix(X=rng.randn(40, 5).astype(config.floatX))
+        model = Autoencoder(5, 3, act_enc='tanh', act_dec=None, irange=.1,
+                            rng=rng)
+        algorithm = UnsupervisedExhaustiveSGD(
+            learning_rate=.05, cost=MeanSquaredReconstructionError(),
+            batch_size=5, monitoring_batches=2, monitoring_dataset=dataset,
+            termination_criterion=EpochCounter(max_epochs=2))
+        train = Train(dataset=dataset, model=model, algorithm=algorithm,
+                      save_path=os.path.join(tmp_dir, 'model.pkl'))
+        train.main_loop()
+        with open(os.path.join(tmp_dir, 'model_timing.jsonl')) as f:
+            records = [json.loads(line) for line in f]
+        # The setup, then the two training passes.
+        assert [record['epoch'] for record in records] == [0, 1, 2]
+        assert records == train.timer.records
+        for record in records:
+            for phase in ['data', 'update', 'monitor']:
+                assert record[phase + '_time'] >= 0.
+            assert record['compile_time'] == sum(
+                seconds for name, seconds in record['compile_times'])
+        assert records[0]['batches'] == 0
+        assert 'sgd_update' in [name for name, seconds
+                                in records[0]['compile_times']]
+        for record in records[1:]:
+            assert record['batches'] == 8
+            assert record['examples'] == 40
+            assert record['batches_per_sec'] > 0
+            assert record['data_time'] > 0.
+            assert record['update_time'] > 0.
+            assert record['compile_times'] == []
+        assert records[1]['monitor_time'] > 0.
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+def test_compile_times_released():
+    #tests that compilation times are only kept by open timers, for
+    #their running epoch
+    timer = TrainingTimer()
+    record_compile('f', 1.)
+    assert timer.end_epoch(0, 0, 0)['compile_times'] == [['f', 1.]]
+    assert timer.end_epoch(1, 0, 0)['compile_times'] == []
+    timer.close()
+    record_compile('g', 1.)
+    assert timer._compiles == []
+    assert timer not in timing._timers
@@ -0,0 +1,42 @@
+"""Tests for the binary array framing in wire.py"""
+import socket
+import numpy as np
+from pylearn2.utils.wire import send_arrays, recv_arrays
+
+
+def test_send_recv_roundtrip():
+    a, b = socket.socketpair()
+    try:
+        rng = np.random.RandomState([1, 2, 3])
+        arrays = [rng.randn(3, 4).astype('float32'),
+                  np.arange(5, dtype='int64'),
+                  np.array(7, dtype='uint8'),
+                  np.zeros((0, 2)),
+                  rng.randn(2, 3, 4)[:, ::2]]
+        send_arrays(a, arrays, tag=3)
+        send_arrays(a, [], tag=1)
+        tag, received = recv_arrays(b)
+        assert tag == 3
+        assert len(received) == len(arrays)
+        for x, y in zip(arrays, received):
+            assert x.dtype == y.dtype
+            assert x.shape == y.shape
+            assert np.all(x == y)
+        tag, received = recv_arrays(b)
+        assert tag == 1
+        assert received == []
+    finally:
+        a.close()
+        b.close()
+
+
+def test_recv_closed_connection():
+    a, b = socket.socketpair()
+    a.close()
+    try:
+        recv_arrays(b)
+    except EOFError:
+        return
+    finally:
+        b.close()
+    assert False
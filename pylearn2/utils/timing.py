@@ -0,0 +1,159 @@
+"""
+Timing and throughput instrumentation of training runs.
+
+`TrainingTimer` splits the wall time of every epoch of
+`pylearn2.scripts.train.Train.main_loop` into phases (data fetching,
+update calls, monitoring, callbacks and saving), and records throughput,
+compilation times and the peak resident memory of the process. Records
+are kept in memory and, optionally, appended to a JSON-lines file, one
+line per epoch, so that runs can be compared across code and
+configuration changes.
+"""
+import json
+import resource
+import sys
+import time
+import weakref
+from contextlib import contextmanager
+
+# The open TrainingTimers, which collect the compilation times reported
+# by `record_compile`. Weak, so that a timer dropped without being
+# closed stops collecting them.
+_timers = weakref.WeakSet()
+
+
+def record_compile(name, seconds):
+    """
+    Reports that compiling (or loading) the function `name` took
+    `seconds`. Picked up by the open TrainingTimers, for their running
+    epoch.
+    """
+    for timer in list(_timers):
+        timer._compiles.append((name, seconds))
+
+
+def peak_rss():
+    """Returns the peak resident set size of this process, in bytes."""
+    usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        return usage
+    # Linux reports kilobytes.
+    return usage * 1024
+
+
+class TrainingTimer(object):
+    """
+    Accumulates per-phase times for the current epoch, and one record
+    per finished epoch in `records`.
+
+    Each record is a dictionary with the epoch number, its wall time,
+    the time spent in each phase (`<phase>_time`), the number of batches
+    and examples processed and the corresponding rates (per second of
+    data fetching and updating), the functions compiled during the
+    epoch with their compilation times, and the peak RSS in bytes.
+    """
+    PHASES = ('setup', 'data', 'update', 'monitor', 'callbacks', 'save')
+
+    def __init__(self, path=None, append=False):
+        """
+        Parameters
+        ----------
+        path : str, optional
+            If given, each record is also written as a line of JSON to
+            this file.
+        append : bool, optional
+            Whether to append to `path` rather than overwrite it, e.g.
+            when resuming a run.
+        """
+        self.path = path
+        self.records = []
+        self._file = None
+        if path is not None:
+            self._file = open(path, 'a' if append else 'w')
+        # (name, seconds) pairs reported during the running epoch.
+        self._compiles = []
+        _timers.add(self)
+        self.start_epoch()
+
+    def start_epoch(self):
+        """Starts timing a new epoch."""
+        self._times = dict((phase, 0.) for phase in self.PHASES)
+        self._start = time.time()
+
+    @contextmanager
+    def phase(self, name):
+        """
+        Context manager adding the time spent in its block to phase
+        `name`. Time spent in the 'data' phase within an 'update' block
+        is only counted as data time.
+        """
+        t1 = time.time()
+        try:
+            yield
+        finally:
+            self._times[name] += time.time() - t1
+
+    def timed(self, iterable, phase='data'):
+        """
+        Yields the elements of `iterable`, adding the time spent
+        getting each of them to `phase`.
+        """
+        iterator = iter(iterable)
+        while True:
+            t1 = time.time()
+            try:
+                item = iterator.next()
+            except StopIteration:
+                self._times[phase] += time.time() - t1
+                return
+            self._times[phase] += time.time() - t1
+            yield item
+
+    def end_epoch(self, epoch, batches, examples):
+        """
+        Finishes the current epoch, stores its record (also returned)
+        and starts timing the next one.
+
+        Parameters
+        ----------
+        epoch : int
+            Number of the epoch, 0 for the setup before training.
+        batches : int
+            Number of batches processed during the epoch.
+        examples : int
+            Number of examples processed during the epoch.
+        """
+        times = dict(self._times)
+        times['update'] = max(times['update'] - times['data'], 0.)
+        train_time = times['data'] + times['update']
+        compiles, self._compiles = self._compiles, []
+        record = {'epoch': epoch,
+                  'wall_time': time.time() - self._start,
+                  'batches': batches,
+                  'examples': examples,
+                  'batches_per_sec': None,
+                  'examples_per_sec': None,
+                  'compile_times': [list(pair) for pair in compiles],
+                  'compile_time': sum(seconds for name, seconds in compiles),
+                  'peak_rss': peak_rss()}
+        if train_time > 0:
+            record['batches_per_sec'] = batches / train_time
+            record['examples_per_sec'] = examples / train_time
+        for phase in self.PHASES:
+            record[phase + '_time'] = times[phase]
+        self.records.append(record)
+        if self._file is not None:
+            self._file.write(json.dumps(record, sort_keys=True) + '\n')
+            self._file.flush()
+        self.start_epoch()
+        return record
+
+    def close(self):
+        """
+        Closes the JSON-lines file, and stops collecting compilation
+        times.
+        """
+        _timers.discard(self)
+        if self._file is not None:
+            self._file.close()
+            self._file = None
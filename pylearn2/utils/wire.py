@@ -0,0 +1,114 @@
+"""
+Compact binary framing for exchanging lists of numpy arrays over
+sockets, used by the multi-process and multi-node training algorithms.
+
+A message is a small integer tag followed by a list of arrays. Each
+array is sent as its dtype string, its shape and its raw (C-ordered)
+bytes, so that no pickling is involved on either side.
+"""
+import socket
+import struct
+import numpy
+
+# tag, number of arrays
+_MESSAGE = struct.Struct('!BI')
+# length of the dtype string, number of dimensions
+_ARRAY = struct.Struct('!BB')
+
+
+def connect(address, timeout=None):
+    """
+    Opens a TCP connection to `address`, a (host, port) pair, suitable
+    for `send_arrays` and `recv_arrays`.
+    """
+    sock = socket.create_connection(address, timeout)
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    return sock
+
+
+def listen(address, backlog=16):
+    """
+    Returns a TCP socket listening on `address`, a (host, port) pair.
+    Use port 0 to let the OS pick a free port, and `getsockname()` to
+    find out which one it picked.
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind(address)
+    sock.listen(backlog)
+    return sock
+
+
+def accept(server):
+    """Accepts a connection on `server`, configured like `connect`."""
+    sock, address = server.accept()
+    # Blocking, whatever the timeout of `server`.
+    sock.settimeout(None)
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    return sock
+
+
+def send_arrays(sock, arrays, tag=0):
+    """
+    Sends a message made of `tag` (an int in [0, 255]) and `arrays`, a
+    list of ndarrays (or values convertible to ndarrays).
+    """
+    arrays = [numpy.ascontiguousarray(array) for array in arrays]
+    header = [_MESSAGE.pack(tag, len(arrays))]
+    for array in arrays:
+        dtype = array.dtype.str
+        header.append(_ARRAY.pack(len(dtype), array.ndim))
+        header.append(dtype)
+        header.append(struct.pack('!%dQ' % array.ndim, *array.shape))
+    sock.sendall(''.join(header))
+    for array in arrays:
+        if array.size > 0:
+            sock.sendall(buffer(array))
+
+
+def recv_arrays(sock):
+    """
+    Receives a message sent by `send_arrays`.
+
+    Returns
+    -------
+    tag : int
+        The tag of the message.
+    arrays : list
+        The arrays of the message.
+
+    Raises
+    ------
+    EOFError
+        If the connection was closed by the other end.
+    """
+    tag, num_arrays = _MESSAGE.unpack(_recv_bytes(sock, _MESSAGE.size))
+    specs = []
+    for i in xrange(num_arrays):
+        dtype_len, ndim = _ARRAY.unpack(_recv_bytes(sock, _ARRAY.size))
+        dtype = numpy.dtype(_recv_bytes(sock, dtype_len))
+        shape = struct.unpack('!%dQ' % ndim, _recv_bytes(sock, 8 * ndim))
+        specs.append((dtype, shape))
+    arrays = []
+    for dtype, shape in specs:
+        array = numpy.empty(shape, dtype=dtype)
+        if array.size > 0:
+            _recv_into(sock, array.reshape(-1).view(numpy.uint8))
+        arrays.append(array)
+    return tag, arrays
+
+
+def _recv_bytes(sock, num_bytes):
+    buf = bytearray(num_bytes)
+    _recv_into(sock, buf)
+    return str(buf)
+
+
+def _recv_into(sock, buf):
+    """Fills `buf`, a writable bytearray or uint8 ndarray."""
+    view = memoryview(buf)
+    while len(view) > 0:
+        received = sock.recv_into(view)
+        if received == 0:
+            raise EOFError("connection closed by peer")
+        view = view[received:]